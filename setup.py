@@ -49,6 +49,7 @@ setup(
     download_url= "http://github.com/sebastien/%s/tarball/%s" % (PROJECT.lower(),VERSION) ,
     package_dir = { "": "src" },
     packages    = [PROJECT.lower()],
+    extras_require = {"brotli": ["brotli"]},
     classifiers = [
       # See <http://pypi.python.org/pypi?:action=list_classifiers>
       "Development Status :: 5 - Production/Stable",
@@ -1,4 +1,7 @@
 from wwwclient.browse import Session, fix, quote, retry
 from wwwclient.scrape import HTML, URL
+from wwwclient.compat import IS_PYTHON3
+if IS_PYTHON3:
+	from wwwclient.asyncbrowse import AsyncSession
 __version___ = "1.0.4"
 # EOF
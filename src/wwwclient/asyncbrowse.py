@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# Encoding: utf8
+# -----------------------------------------------------------------------------
+# Project   : WWWClient
+# -----------------------------------------------------------------------------
+# Author    : Sebastien Pierre                               <sebastien@ivy.fr>
+# -----------------------------------------------------------------------------
+# License   : GNU Lesser General Public License
+# Credits   : Xprima.com
+# -----------------------------------------------------------------------------
+# Creation  : 17-Oct-2026
+# Last mod  : 17-Oct-2026
+# -----------------------------------------------------------------------------
+
+import asyncio
+from   wwwclient import scrape, asyncclient
+from   wwwclient.scheduler import Scheduler
+from   wwwclient.browse import Session, SessionException, Transaction, GET, POST, HEAD
+
+__doc__ = """\
+An 'asyncio' version of the 'browse' module: an 'AsyncSession' has the same
+interface as a 'browse.Session', except that the methods that send requests
+('get', 'head', 'post', 'submit') are coroutines. Many transactions can then
+run concurrently within a single thread, the number of requests in flight
+being bounded by the session 'concurrency'.
+
+--
+	session = AsyncSession(concurrency=20)
+	pages   = await session.fetchAll(urls)
+--
+"""
+
+# -----------------------------------------------------------------------------
+#
+# TRANSACTION
+#
+# -----------------------------------------------------------------------------
+
+class AsyncTransaction(Transaction):
+	"""A transaction executed by an 'AsyncSession', where 'do' is a
+	coroutine. Its status is taken from its own response, as the client is
+	shared by concurrent transactions."""
+
+	async def do( self ):
+		if self._done: return
+		responses = await self._send()
+		return self._receive(responses, str(responses[-1].status()))
+
+# -----------------------------------------------------------------------------
+#
+# SESSION
+#
+# -----------------------------------------------------------------------------
+
+class AsyncSession(Session):
+	"""A session whose requests are sent by an 'asyncclient.HTTPClient'. At
+	most 'concurrency' requests are in flight at the same time, the others
+	wait for their turn.
+
+	As transactions can complete in any order, 'last()' (and the methods
+	that rely on it, like 'forms' or 'links') returns the last *created*
+	transaction. URLs should be given as absolute URLs when requests are
+	made concurrently."""
+
+	CONCURRENCY    = 10
+	RETRY_ON       = (asyncio.IncompleteReadError, asyncio.TimeoutError)
+
+	def __init__( self, verbose=0, personality="random", follow=True, do=True, delay=None, cache=None, exceptions=True, client=None, pool=None, scheduler=None, concurrency=None ):
+		Session.__init__(self, None, verbose=verbose, personality=personality,
+			follow=follow, do=do, delay=delay, cache=cache, exceptions=exceptions,
+			scheduler=scheduler,
+			client=client or asyncclient.HTTPClient,
+			pool=asyncclient.ConnectionPool() if pool is None else pool
+		)
+		self._concurrency = asyncio.Semaphore(concurrency or self.CONCURRENCY)
+
+	async def head( self, url="/", params=None, headers=None, follow=None, do=None, cookies=None, retry=[], cache=True ):
+		return await self.get(url=url, params=params, headers=headers, follow=follow, do=do, cookies=cookies, retry=retry, method=HEAD, cache=cache)
+
+	async def get( self, url="/", params=None, headers=None, follow=None, do=None, cookies=None, retry=[], method=GET, cache=True ):
+		"""See 'Session.get'."""
+		if follow is None: follow = self._follow
+		if do is None: do = self._do
+		url = self._processURL(url)
+		request     = self._createRequest( url=url, params=params, headers=headers, cookies=cookies, method=method )
+		transaction = AsyncTransaction( self, request )
+		self._addTransaction(transaction)
+		if do:
+			try:
+				await self._doTransaction(transaction, retry)
+			except Exception as e:
+				return self._failTransaction(transaction, e)
+			visited   = [url]
+			iteration = 0
+			while transaction.redirect() and follow and iteration < self.REDIRECT_LIMIT:
+				redirect_url = self._processURL(transaction.redirect(), store=False)
+				if not (redirect_url in visited):
+					visited.append(redirect_url)
+					transaction = await self.get(redirect_url, headers=headers, cookies=cookies, do=True, method=method, follow=False)
+					iteration  += 1
+				else:
+					break
+		return transaction
+
+	async def post( self, url=None, params=None, data=None, mimetype=None,
+	fields=None, attach=None, headers=None, follow=None, do=None, cookies=None, retry=[], cache=True ):
+		"""See 'Session.post'."""
+		if follow is None: follow = self._follow
+		if do is None: do = self._do
+		url = self._processURL(url)
+		request     = self._createRequest(
+			method=POST, url=url, fields=fields, params=params, attach=attach,
+			data=data, mimetype=mimetype, headers=headers, cookies=cookies
+		)
+		transaction = AsyncTransaction( self, request )
+		self._addTransaction(transaction)
+		if do:
+			await self._doTransaction(transaction, retry)
+			visited = [url]
+			while transaction.redirect() and follow:
+				redirect_url = self._processURL(transaction.redirect(), store=False)
+				if not (redirect_url in visited):
+					visited.append(redirect_url)
+					transaction = await self.post(redirect_url, data=data, mimetype=mimetype, fields=fields, attach=attach, headers=headers, cookies=cookies, do=True)
+				else:
+					break
+		return transaction
+
+	async def submit( self, form, values={}, attach=[], action=None,  method=POST,
+	do=None, cookies=None, strip=True ):
+		"""See 'Session.submit'."""
+		if do is None: do = self._do
+		if type(form) is str:
+			forms = scrape.HTML.forms(self.last().data())
+			if form not in forms:
+				raise SessionException("Form {0} not found, available forms are: {1}".format(form, list(forms.keys())))
+			form = forms[form]
+		url    = form.action or self.referer()
+		fields = form.submit(action=action, strip=strip, **values)
+		if method == POST or attach:
+			return await self.post( url, fields=fields, attach=attach, do=do, cookies=cookies )
+		elif method in (GET, HEAD):
+			assert not attach, "Attachments are incompatible with GET submission"
+			return await self.get( url,  params=fields, do=do, cookies=cookies )
+		else:
+			raise SessionException("Unsupported method for submit: " + method)
+
+	async def fetchAll( self, urls, **options ):
+		"""Gets all the given URLs concurrently (within the limit of the
+		session concurrency), and returns the list of transactions in the
+		same order as the URLs. The options are passed to 'get'."""
+		return await asyncio.gather(*(self.get(url, **options) for url in urls))
+
+	async def close( self ):
+		"""Closes the idle connections kept alive by this session."""
+		Session.close(self)
+		return self
+
+	async def _doTransaction( self, transaction, retry=None ):
+		"""Does the given transaction when the session scheduler allows it and
+		a slot is free, retrying on timeouts, incomplete reads and
+		'Retry-After' answers. Waiting for a host does not hold a slot, so
+		that requests to other hosts can go ahead."""
+		host  = Scheduler.Host(transaction.url())
+		retry = retry or self.DEFAULT_RETRIES
+		for i, r in enumerate(retry):
+			await asyncio.sleep(self._scheduler.reserve(host))
+			try:
+				async with self._concurrency:
+					await transaction.do()
+			except self.RETRY_ON as e:
+				if i == len(retry) - 1: raise e
+				await asyncio.sleep(r)
+				continue
+			wait = self._scheduler.update(host, transaction.response())
+			if wait is None or wait > self._scheduler.MAX_RETRY_AFTER or i == len(retry) - 1:
+				break
+			transaction.reset()
+		if self.MERGE_COOKIES: self._cookies.merge(transaction.newCookies())
+		return transaction
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
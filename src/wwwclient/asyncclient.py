@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# Encoding: utf8
+# -----------------------------------------------------------------------------
+# Project   : WWWClient
+# -----------------------------------------------------------------------------
+# Author    : Sebastien Pierre                               <sebastien@ivy.fr>
+# -----------------------------------------------------------------------------
+# License   : GNU Lesser General Public License
+# Credits   : Xprima.com
+# -----------------------------------------------------------------------------
+# Creation  : 17-Oct-2026
+# Last mod  : 17-Oct-2026
+# -----------------------------------------------------------------------------
+
+import time, asyncio
+import urllib.parse as urlparse
+import wwwclient.client as client
+from   wwwclient.defaultclient import ConnectionPool as _ConnectionPool
+
+__doc__ = """\
+An HTTP/1.1 client built on 'asyncio' streams, where the 'GET', 'HEAD' and
+'POST' methods are coroutines. Connections are kept alive in a
+'ConnectionPool', so that many concurrent requests can be multiplexed on a
+few connections by a single thread. This is the client used by
+'asyncbrowse.AsyncSession'.
+
+As the client can be used by concurrent requests, the state it aggregates
+(status, url, etc) only reflects the last completed request: use the
+returned 'client.Response' objects instead."""
+
+# -----------------------------------------------------------------------------
+#
+# CONNECTION POOL
+#
+# -----------------------------------------------------------------------------
+
+class ConnectionPool:
+	"""Keeps the idle (keep-alive) '(reader, writer)' stream pairs, indexed by
+	'(scheme, host, port)'. This is the 'asyncio' counterpart of
+	'defaultclient.ConnectionPool', and it is meant to be used by the
+	coroutines of a single event loop."""
+
+	MAX_IDLE     = _ConnectionPool.MAX_IDLE
+	IDLE_TIMEOUT = _ConnectionPool.IDLE_TIMEOUT
+
+	Key = staticmethod(_ConnectionPool.Key)
+
+	def __init__( self, maxIdle=None, idleTimeout=None ):
+		self.maxIdle     = self.MAX_IDLE     if maxIdle     is None else maxIdle
+		self.idleTimeout = self.IDLE_TIMEOUT if idleTimeout is None else idleTimeout
+		self._idle       = []
+
+	def acquire( self, key ):
+		"""Returns an idle '(reader, writer)' pair for the given key, or 'None'."""
+		now   = time.time()
+		found = None
+		for i in range(len(self._idle)-1, -1, -1):
+			k, connection, released = self._idle[i]
+			if now - released > self.idleTimeout or not self.isAlive(connection):
+				del self._idle[i]
+				connection[1].close()
+			elif k == key and found is None:
+				del self._idle[i]
+				found = connection
+		return found
+
+	def release( self, key, connection ):
+		"""Gives back the given '(reader, writer)' pair to the pool."""
+		if self.maxIdle <= 0 or not self.isAlive(connection):
+			connection[1].close()
+			return
+		self._idle.append((key, connection, time.time()))
+		while len(self._idle) > self.maxIdle:
+			self._idle.pop(0)[1][1].close()
+
+	def isAlive( self, connection ):
+		"""Tells if the given idle connection can still be used (the server
+		did not close it)."""
+		reader, writer = connection
+		return not (reader.at_eof() or writer.is_closing())
+
+	def close( self ):
+		"""Closes all the idle connections."""
+		idle       = self._idle
+		self._idle = []
+		for _, connection, _ in idle:
+			connection[1].close()
+
+	def size( self ):
+		"""Returns the number of idle connections in this pool."""
+		return len(self._idle)
+
+# -----------------------------------------------------------------------------
+#
+# HTTP CLIENT
+#
+# -----------------------------------------------------------------------------
+
+class HTTPClient(client.HTTPClient):
+	"""Sends HTTP/1.1 requests using 'asyncio' streams. The request methods
+	are coroutines returning the list of 'client.Response' (like the other
+	clients, minus the provisional '1xx' responses). Responses are not
+	streamed: the 'stream' option is ignored and the body is always read.
+
+	Without a pool (as set by 'browse.AsyncSession(pool=False)'), each
+	request is sent over a new connection, which is then closed."""
+
+	TIMEOUT    = 10
+	CHUNK_SIZE = 64 * 1024
+
+	# These are raised when the server closed a kept-alive connection before
+	# we sent the request (or before it answered).
+	STALE_CONNECTION_ERRORS = (ConnectionError, asyncio.IncompleteReadError)
+
+	def __init__( self, encoding="utf-8" ):
+		client.HTTPClient.__init__(self, encoding)
+		self._pool = ConnectionPool()
+
+	async def GET  ( self, url, headers=None, stream=False ):
+		return await self._request(url, headers, "GET")
+
+	async def HEAD ( self, url, headers=None, stream=False ):
+		return await self._request(url, headers, "HEAD")
+
+	async def POST ( self, url, data=None, mimetype=None, fields=None, attach=None, headers=None, stream=False ):
+		data, headers = self._encodeSubmit(data, mimetype, fields, attach, headers)
+		return await self._request(url, headers, "POST", data)
+
+	async def _request( self, url, headers=None, method="GET", body=None ):
+		url        = self._absoluteURL(url)
+		url_parsed = urlparse.urlsplit(url)
+		if url_parsed.scheme not in ("http", "https"):
+			raise Exception("Protocol not supported: {0}".format(url_parsed.scheme))
+		key      = ConnectionPool.Key(url_parsed.scheme, url_parsed.netloc)
+		path     = url_parsed.path or "/"
+		if url_parsed.query: path += "?" + url_parsed.query
+		if body is not None and not isinstance(body, (bytes, client.MultipartBody)):
+			body = body.encode(self.encoding)
+		cache    = self._cache
+		entry    = cache.get(method, url, headers) if cache else None
+		if entry and cache.isFresh(entry, headers):
+			response = entry.response(method)
+		else:
+			request_time = time.time()
+			message  = self._formatRequest(method, path, url_parsed.netloc, cache.validate(entry, headers) if entry else (headers or ()), body)
+			response = await self._exchange(key, message, method, body)
+			if cache: response = cache.store(method, url, headers, response, entry, request_time)
+		self._url        = url
+		self._method     = method
+		self._status     = str(response.status())
+		self._redirect   = response.location()
+		self._newCookies = response.cookies()
+		self._responses  = [response]
+		self._protocol, self._host = url_parsed.scheme, url_parsed.netloc
+		if self.verbose >= 1: self._log(self.info())
+		return self._responses
+
+	def _formatRequest( self, method, path, host, headers, body ):
+		"""Returns the request line, headers and body as bytes. Multipart
+		bodies are not included: they are written by '_send'."""
+		lines = ["{0} {1} HTTP/1.1".format(method, path)]
+		names = set()
+		for header in headers:
+			name, _, value = header.partition(":")
+			name = name.strip()
+			lines.append("{0}: {1}".format(name, value.strip()))
+			names.add(name.lower())
+		if "host" not in names:
+			lines.insert(1, "Host: " + host)
+		if body is not None and "content-length" not in names:
+			lines.append("Content-Length: {0}".format(len(body)))
+		message = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+		return message + body if body and isinstance(body, bytes) else message
+
+	async def _exchange( self, key, message, method, body=None ):
+		"""Sends the given request message over a (reused) connection for the
+		given key and returns the response, retrying once over a new
+		connection when a reused one was closed by the server. As the
+		request may have been processed, only idempotent requests are sent
+		again."""
+		connection = self._pool.acquire(key) if self._pool is not None else None
+		reused     = connection is not None
+		while True:
+			if connection is None:
+				connection = await self._connect(key)
+			try:
+				return await self._send(key, connection, message, method, body)
+			except self.STALE_CONNECTION_ERRORS as e:
+				connection[1].close()
+				if not (reused and method in self.IDEMPOTENT_METHODS): raise e
+				connection, reused = None, False
+			except BaseException as e:
+				connection[1].close()
+				raise e
+
+	async def _connect( self, key ):
+		scheme, host, port = key
+		return await asyncio.wait_for(
+			asyncio.open_connection(host, port, ssl=(scheme == "https") or None),
+			self.TIMEOUT
+		)
+
+	async def _send( self, key, connection, message, method, body=None ):
+		reader, writer = connection
+		writer.write(message)
+		await writer.drain()
+		if isinstance(body, client.MultipartBody):
+			# The attached files are written by chunks, as they are read
+			body.seek(0)
+			for chunk in body.iterChunks(self.CHUNK_SIZE):
+				writer.write(chunk)
+				await self._read(writer.drain())
+		# We skip the provisional (1xx) responses
+		while True:
+			first_line, headers = await self._readHead(reader)
+			response = client.Response(first_line, headers=headers, body=b"")
+			status   = response.status() or 0
+			if status >= 200 or status == 101: break
+		keep_alive = self._isKeepAlive(first_line, headers)
+		chunked    = False
+		if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+			body = b""
+		elif "chunked" in (headers.get("Transfer-Encoding") or "").lower():
+			body    = await self._readChunked(reader, headers)
+			chunked = True
+		elif headers.get("Content-Length", "").strip().isdigit():
+			body = await self._readBody(reader, int(headers.get("Content-Length")))
+		else:
+			# The body is delimited by the end of the connection
+			body       = await self._readBody(reader)
+			keep_alive = False
+		if keep_alive and self._pool is not None:
+			self._pool.release(key, connection)
+		else:
+			connection[1].close()
+		return self._decodeResponse(response, body, chunked)
+
+	async def _readHead( self, reader ):
+		"""Reads the status line and the headers of a response."""
+		first_line = await self._read(reader.readline())
+		if not first_line:
+			raise ConnectionResetError("Connection closed by the server")
+		lines = []
+		while True:
+			line = await self._read(reader.readline())
+			if not line:
+				raise asyncio.IncompleteReadError(b"", None)
+			if line in (b"\r\n", b"\n"): break
+			lines.append(line)
+		headers = client.Headers.Parse(b"".join(lines).decode("latin-1"))
+		return first_line.decode("latin-1").strip(), headers
+
+	async def _readChunked( self, reader, headers ):
+		"""Reads a chunked body without reading past its end, adding its
+		trailers to the given headers."""
+		decoder = client.ChunkedDecoder()
+		while not decoder.isDone():
+			size = decoder.remaining()
+			if size:
+				data = await self._read(reader.read(min(size, self.CHUNK_SIZE)))
+			else:
+				data = await self._read(reader.readline())
+			if not data:
+				raise client.ChunkedDecoderError("Incomplete chunked body")
+			decoder.feed(data)
+		for name, value in decoder.trailers:
+			headers.add(name, value)
+		return bytes(decoder.data())
+
+	def _isKeepAlive( self, firstLine, headers ):
+		connection = (headers.get("Connection") or "").lower()
+		if firstLine.startswith("HTTP/1.0"):
+			return "keep-alive" in connection
+		else:
+			return "close" not in connection
+
+	async def _readBody( self, reader, size=None ):
+		"""Reads a body of the given size, or up to the end of the connection,
+		by chunks. The timeout applies to each chunk, so that large bodies
+		can take as long as they need while they keep coming."""
+		body = bytearray()
+		while size is None or len(body) < size:
+			data = await self._read(reader.read(self.CHUNK_SIZE if size is None else min(self.CHUNK_SIZE, size - len(body))))
+			if not data:
+				if size is None: break
+				raise asyncio.IncompleteReadError(bytes(body), size)
+			body += data
+		return bytes(body)
+
+	async def _read( self, awaitable ):
+		"""Waits for the given read, for at most 'TIMEOUT' seconds."""
+		return await asyncio.wait_for(awaitable, self.TIMEOUT)
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
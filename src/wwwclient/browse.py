@@ -16,16 +16,20 @@
 # TODO: Add   sessoin.status, session.headers, session.links(), session.scrape()
 # TODO: Add   session.select() to select a form before submit
 
-import mimetypes, re, os, sys, time, json, random, hashlib, base64, socket, tempfile, webbrowser
+import mimetypes, re, os, sys, time, json, random, hashlib, base64, socket, tempfile, webbrowser, threading, heapq, itertools
 from   wwwclient import client, defaultclient, scrape, agents
+from   wwwclient.scheduler import Scheduler
+from   wwwclient.compat import ensure_bytes, ensure_unicode
 
 if sys.version_info.major < 3:
 	import urlparse, urllib
 	import httplib as http_client
+	import Queue as queue
 	url_quote = urllib.quote
 else:
 	import urllib.parse as urlparse
 	import http.client as http_client
+	import queue
 	url_quote = urlparse.quote
 	unicode   = str
 
@@ -340,6 +344,7 @@ class Transaction:
 	- 'cookies':  cookies
 	- 'redirect': for the redirection (None by default)
 	- 'done':     if the transaction was executed or not
+	- 'stream':   if the response body is read on demand (see 'iterContent')
 
 	"""
 
@@ -347,10 +352,11 @@ class Transaction:
 	HEADERS = 1
 	BODY    = 2
 
-	def __init__( self, session, request ):
-		self._client     = session._httpClient
+	def __init__( self, session, request, stream=False, client=None ):
+		self._client     = client or session._httpClient
 		self._session    = session
 		self._request    = request
+		self._stream     = stream
 		self._status     = None
 		self._cookies    = Pairs()
 		self._newCookies = None
@@ -387,14 +393,16 @@ class Transaction:
 
 	def headers( self ):
 		"""Returns the headers received by the response."""
-		headers = self._responses[-1][self.HEADERS]
-		headers = self._client._parseHeaders(headers)
-		return Pairs(headers)
+		return Pairs(self._responses[-1].headers.items())
 
 	def newCookies( self ):
 		"""Returns the list of new cookies."""
 		return self._newCookies
 
+	def response( self ):
+		"""Returns the last 'client.Response' received by this transaction."""
+		return self._responses[-1] if self._responses else None
+
 	def forms( self, name=None ):
 		"""Returns a dictionary with the forms contained in the response. If a
 		'name' is given the form with the given name will be returned."""
@@ -413,12 +421,72 @@ class Transaction:
 
 	def body( self ):
 		"""Returns the response data (implies that the transaction was
-		previously done)"""
+		previously done). Text bodies are decoded using the response charset,
+		while other bodies are returned as bytes (see also 'content'). The body
+		of a streamed transaction is read completely (unless it was already
+		consumed with 'iterContent')."""
+		if self._responses:
+			response = self._responses[-1]
+			if response.isText():
+				return response.text(self._client.encoding)
+			else:
+				return self.content()
+		else:
+			return None
+
+	def content( self ):
+		"""Returns the response body as bytes, as it was received."""
 		if self._responses:
-			return self._responses[-1][self.BODY]
+			return ensure_bytes(self._responses[-1].read(), self._client.encoding)
 		else:
 			return None
 
+	def iterContent( self, size=None ):
+		"""Iterates on the response body as chunks of bytes of at most 'size'
+		bytes. For a streamed transaction, the chunks are read from the
+		connection as they are consumed, so that the body is never held in
+		memory as a whole."""
+		response = self._responses[-1]
+		if response.stream is not None:
+			for chunk in response.stream.iterChunks(size):
+				yield chunk
+		else:
+			# Buffers (like the 'memoryview' bodies of the curl client) are
+			# only copied chunk by chunk
+			body = response.body or b""
+			if not isinstance(body, memoryview): body = ensure_bytes(body, response.charset(self._client.encoding))
+			size = size or client.BodyStream.CHUNK_SIZE
+			for i in range(0, len(body), size):
+				yield ensure_bytes(body[i:i+size])
+
+	def iterLines( self, size=None ):
+		"""Iterates on the lines (as bytes, without their line ending) of the
+		response body. See 'iterContent'."""
+		response = self._responses[-1]
+		if response.stream is not None:
+			for line in response.stream.iterLines(size):
+				yield line
+		else:
+			body = ensure_bytes(response.body or b"", response.charset(self._client.encoding))
+			for line in body.splitlines():
+				yield line
+
+	def close( self ):
+		"""Closes the streamed responses of this transaction, discarding their
+		unread body."""
+		for response in self._responses:
+			if response.stream is not None:
+				response.stream.close()
+		return self
+
+	def reset( self ):
+		"""Discards the responses of this transaction, so that it can be done
+		again (for instance after a '503 Service Unavailable')."""
+		self.close()
+		self._responses = []
+		self._done      = False
+		return self
+
 	def data( self ):
 		"""Returns the response data (implies that the transaction was
 		previously done)"""
@@ -432,7 +500,8 @@ class Transaction:
 
 	def redirect( self ):
 		"""Returns the URL to which the response redirected, if any."""
-		return self._client.redirect()
+		location = self._responses[-1].location() if self._responses else None
+		return urlparse.urljoin(self.url(), location) if location else None
 
 	def url( self ):
 		"""Returns the requested URL."""
@@ -443,42 +512,56 @@ class Transaction:
 		actually sends the data to the transport layer."""
 		# We do not do a transaction twice
 		if self._done: return
+		return self._receive(self._send())
+
+	def _send( self ):
+		"""Sends the request through the client, and returns what the client
+		returned (the responses, or an awaitable for asynchronous clients)."""
 		# We prepare the headers
 		request  = self.request()
-		headers  = request.headers()
-		response = None
 		# if self._verbose >= 1:
 		# 	self._session._log(request.method(), request.url())
 		# We merge the session cookies into the request
 		request.cookies().merge(self.session().cookies())
 		# As well as this transaction cookies
 		request.cookies().merge(self.cookies())
+		# Only clients that support streaming are given the option
+		options = {"stream":True} if self._stream else {}
 		# We send the request as a GET
 		if request.method() == GET:
-			responses = self._client.GET(
+			return self._client.GET(
 				request.url(),
-				headers=request.headers().asHeaders()
+				headers=request.headers().asHeaders(),
+				**options
 			)
 		elif request.method() == HEAD:
-			responses = self._client.HEAD(
+			return self._client.HEAD(
 				request.url(),
-				headers=request.headers().asHeaders()
+				headers=request.headers().asHeaders(),
+				**options
 			)
 		# Or as a POST
 		elif request.method() == POST:
-			responses = self._client.POST(
+			return self._client.POST(
 				request.url(),
 				data=request.data(),
 				attach=request.attachments(),
 				fields=request.fields().asFields(),
-				headers=request.headers().asHeaders()
+				headers=request.headers().asHeaders(),
+				**options
 			)
 		# The method may be unsupported
 		else:
 			raise Exception("Unsupported method:", request.method())
+
+	def _receive( self, responses, status=None ):
+		"""Updates this transaction with the responses returned by the client.
+		The status is the client status unless given."""
 		# We merge the new cookies if necessary
-		self._status     = self._client.status()
-		self._newCookies = Pairs(self._client.newCookies())
+		self._status     = self._client.status() if status is None else status
+		self._newCookies = Pairs()
+		for response in responses:
+			self._newCookies.merge(response.cookies())
 		self._done       = True
 		self._responses += responses
 		return self
@@ -500,9 +583,11 @@ class Transaction:
 		return self.asTree().query(selector)
 
 	def save( self, path ):
-		"""Saves the current transaction data to the current file"""
-		with file(path,"wb") as f:
-			f.write(self.data())
+		"""Saves the current transaction data to the given file. Streamed
+		bodies are written as they are read."""
+		with open(path, "wb") as f:
+			for chunk in self.iterContent():
+				f.write(chunk)
 
 	def __str__( self ):
 		return self.data()
@@ -527,26 +612,38 @@ class Session:
 	- 'transactions':    List of transactions
 	- 'maxTransactions': Maximum number of transactions in registered in
 	                     this session
-	- 'cache':           Cache contained last requests
+	- 'cache':           HTTP cache of the responses (see 'cache.HTTPCache')
+	- 'pool':            Pool of keep-alive connections reused across
+	                     transactions
+	- 'scheduler':       Spaces the requests sent to each host
 	- 'cookies':         List of cookies for this session
 	- 'userAgent':       String for this user session agent
 
 	"""
 
 	MAX_TRANSACTIONS = 10
+	WORKERS          = 4
 	REDIRECT_LIMIT   = 5
 	DEFAULT_RETRIES  = [0.25, 0.5, 1.0, 1.5, 2.0]
 	DEFAULT_DELAY    = 1
 	CACHE            = None
 
-	def __init__( self, url=None, verbose=0, personality="random", follow=True, do=True, delay=None, cache=None, exceptions=True, client=None ):
+	def __init__( self, url=None, verbose=0, personality="random", follow=True, do=True, delay=None, cache=None, exceptions=True, client=None, pool=None, scheduler=None ):
 		"""Creates a new session at the given host, and for the given
 		protocol.
 		Keyword arguments::
-			'delay':  the range of delay between two requests e.g: (1.5, 3)"""
+			'delay':     the range of delay between two requests to the
+			             same host e.g: (1.5, 3)
+			'pool':      the 'defaultclient.ConnectionPool' used to keep
+			             connections alive, 'False' disables keep-alive
+			'scheduler': the 'scheduler.Scheduler' that spaces the requests
+			             to each host (created from 'delay' by default)"""
 		self._httpClient      = (client or DEFAULT_HTTP_CLIENT)()
 		cache                 = cache if cache else self.CACHE
 		if cache: self._httpClient.setCache(cache)
+		if pool is None: pool = defaultclient.ConnectionPool()
+		self._pool            = pool if pool is not False else None
+		self._httpClient.setPool(self._pool)
 		self._host            = None
 		self._port            = 80
 		self._protocol        = None
@@ -560,8 +657,10 @@ class Session:
 		self._follow          = follow
 		self._do              = do
 		self._delay           = delay
+		self._scheduler       = scheduler or Scheduler(delay)
 		self._headers         = []
 		self._throwExceptions = True
+		self._lock            = threading.RLock()
 		if type(personality) in (unicode,str): personality = Personality.Get(personality)
 		self._personality     = personality
 		self.MERGE_COOKIES    = True
@@ -614,6 +713,19 @@ class Session:
 	def cookies( self ):
 		return self._cookies
 
+	def pool( self ):
+		"""Returns the pool of keep-alive connections of this session (if any)."""
+		return self._pool
+
+	def scheduler( self ):
+		"""Returns the scheduler that spaces the requests of this session."""
+		return self._scheduler
+
+	def close( self ):
+		"""Closes the idle connections kept alive by this session."""
+		if self._pool is not None: self._pool.close()
+		return self
+
 	def last( self ):
 		"""Returns the last transaction of the session, or None if there is not
 		transaction in the session."""
@@ -693,7 +805,8 @@ class Session:
 		mimetype=mimetype)
 
 	def dump( self, path, data=None, overwrite=True ):
-		"""Dumps the last retrieved data to the given file."""
+		"""Dumps the last retrieved data (or the given data) to the given file,
+		streaming the body if the last transaction is streamed."""
 		count = 0
 		if not overwrite:
 			while os.path.exists(path):
@@ -707,10 +820,12 @@ class Session:
 				if v != None: base = base[:i]
 				path = base + "-" + str(count) + ext
 				count += 1
-		f = open(path, "wb")
-		data = self.last().data()
-		f.write(data)
-		f.close()
+		if data is None:
+			self.last().save(path)
+		else:
+			with open(path, "wb") as f:
+				f.write(ensure_bytes(data))
+		return path
 
 	def referer( self, value=client ):
 		"""Returns/sets the referer for the next request."""
@@ -727,55 +842,77 @@ class Session:
 	def head( self, url="/", params=None, headers=None, follow=None, do=None, cookies=None, retry=[], cache=True ):
 		return self.get(url=url, params=params, headers=headers, follow=follow, do=do, cookies=cookies, retry=retry, method=HEAD, cache=cache)
 
-	def get( self, url="/", params=None, headers=None, follow=None, do=None, cookies=None, retry=[], method=GET, cache=True):
+	def get( self, url="/", params=None, headers=None, follow=None, do=None, cookies=None, retry=[], method=GET, cache=True, stream=False):
 		"""Gets the page at the given URL, with the optional params (as a `Pair`
 		instance), with the given headers.
 
 		The `follow` and `do` options tell if redirects should be followed and
 		if the request should be sent right away.
 
+		When `stream` is true, the headers are available as soon as the
+		transaction is done, but the body is only read when accessed, see
+		`Transaction.iterContent`.
+
 		This returns a `Transaction` object, which is `done` if the `do`
 		parameter is true."""
 		if follow is None: follow = self._follow
 		if do is None: do = self._do
 		# TODO: Return data instead of session
-		url = self.__processURL(url)
+		url = self._processURL(url)
 		request     = self._createRequest( url=url, params=params, headers=headers, cookies=cookies, method=method )
-		transaction = Transaction( self, request )
-		self.__addTransaction(transaction)
+		transaction = Transaction( self, request, stream=stream )
+		self._addTransaction(transaction)
 		# FIXME: Redo on timeout
 		if do:
-			# We do the transaction
-			# set a delay to do the transaction if _delay is specified
-			if self._delay: time.sleep(random.uniform(*self._delay))
-			# ensure that transaction.do retries after a fail
-			retry = retry or self.DEFAULT_RETRIES
-			for i,r in enumerate(retry):
-				try:
-					transaction.do()
-					break
-				except Exception as e:
-					if isinstance(e, http_client.IncompleteRead) or isinstance(e, socket.timeout):
-						# We retry only on socket timeout or incomplete read
-						if i >= len(retry):
-							return self._failTransaction(transaction, e)
-						else:
-							time.sleep(r)
-					else:
-						return self._failTransaction(transaction, e)
-			if self.MERGE_COOKIES: self._cookies.merge(transaction.newCookies())
+			# We do the transaction, retrying only on socket timeout or
+			# incomplete read
+			try:
+				self._doTransaction(transaction, retry, (http_client.IncompleteRead, socket.timeout))
+			except Exception as e:
+				return self._failTransaction(transaction, e)
 			visited   = [url]
 			iteration = 0
 			while transaction.redirect() and follow and iteration < self.REDIRECT_LIMIT:
-				redirect_url = self.__processURL(transaction.redirect(), store=False)
+				redirect_url = self._processURL(transaction.redirect(), store=False)
 				if not (redirect_url in visited):
 					visited.append(redirect_url)
-					transaction = self.get(redirect_url, headers=headers, cookies=cookies, do=True, method=method, follow=False)
+					transaction.close()
+					transaction = self.get(redirect_url, headers=headers, cookies=cookies, do=True, method=method, follow=False, stream=stream)
 					iteration  += 1
 				else:
 					break
 		return transaction
 
+	def _doTransaction( self, transaction, retry=None, retryOn=(http_client.IncompleteRead, socket.timeout) ):
+		"""Does the given transaction when the session scheduler allows it,
+		retrying when one of the 'retryOn' exceptions is raised, waiting
+		for the delays given by 'retry' ('DEFAULT_RETRIES' by default), or
+		when the server answers with a 'Retry-After'. The new cookies are
+		merged into the session cookies."""
+		host  = Scheduler.Host(transaction.url())
+		# ensure that transaction.do retries after a fail
+		retry = retry or self.DEFAULT_RETRIES
+		for i,r in enumerate(retry):
+			# waits for the delay since the last request to this host
+			self._scheduler.wait(host)
+			try:
+				transaction.do()
+			except retryOn as e:
+				if i == len(retry) - 1:
+					raise e
+				else:
+					time.sleep(r)
+					continue
+			# the server may ask us to come back later (429/503 + Retry-After)
+			wait = self._scheduler.update(host, transaction.response())
+			if wait is None or wait > self._scheduler.MAX_RETRY_AFTER or i == len(retry) - 1:
+				break
+			transaction.reset()
+		if self.MERGE_COOKIES:
+			with self._lock:
+				self._cookies.merge(transaction.newCookies())
+		return transaction
+
 	def _failTransaction( self, transaction, exception ):
 		transaction.fail(exception)
 		if self._throwExceptions:
@@ -783,7 +920,7 @@ class Session:
 		return transaction
 
 	def post( self, url=None, params=None, data=None, mimetype=None,
-	fields=None, attach=None, headers=None, follow=None, do=None, cookies=None, retry=[], cache=True):
+	fields=None, attach=None, headers=None, follow=None, do=None, cookies=None, retry=[], cache=True, stream=False):
 		"""Posts data to the given URL. The optional `params` (`Pairs`) or `data`
 		contain the posted data. The `mimetype` describes the mimetype of the data
 		(if it is a special kind of data). The `fields` is a `Pairs` instance of
@@ -791,47 +928,226 @@ class Session:
 		attachements created before using the `attach()` method.
 
 		You should have a look at the `wwwclient.client` module for more
-		information on how the parameters are processed.
+		information on how the parameters are processed. The `stream` option is
+		the same as for `get`.
 
 		As always, this returns a new `Transaction` instance."""
 		if follow is None: follow = self._follow
 		if do is None: do = self._do
-		url = self.__processURL(url)
+		url = self._processURL(url)
 		if params != None and not isinstance(params, Pairs):
 			params = Pairs(params)
 		request     = self._createRequest(
 			method=POST, url=url, fields=fields, params=params, attach=attach,
 			data=data, mimetype=mimetype, headers=headers, cookies=cookies
 		)
-		transaction = Transaction( self, request )
-		self.__addTransaction(transaction)
+		transaction = Transaction( self, request, stream=stream )
+		self._addTransaction(transaction)
 		if do:
-			# We do the transaction
-			# set a delay to do the transaction if _delay is specified
-			if self._delay: time.sleep(random.uniform(*self._delay))
-			# ensure that transaction.do retries after a fail
-			retry = retry or self.DEFAULT_RETRIES
-			for i,r in enumerate(retry):
-				try:
-					transaction.do()
-					break
-				except http_client.IncompleteRead as e:
-					if i >= len(retry):
-						raise e
-					else:
-						time.sleep(r)
-			if self.MERGE_COOKIES: self._cookies.merge(transaction.newCookies())
+			# We do the transaction, retrying on incomplete read
+			self._doTransaction(transaction, retry, (http_client.IncompleteRead,))
 			# And follow the redirect if any
 			visited = [url]
 			while transaction.redirect() and follow:
-				redirect_url = self.__processURL(transaction.redirect(), store=False)
+				redirect_url = self._processURL(transaction.redirect(), store=False)
 				if not (redirect_url in visited):
 					visited.append(redirect_url)
-					transaction = self.post(redirect_url, data=data, mimetype=mimetype, fields=fields, attach=attach, headers=headers, cookies=cookies, do=True)
+					transaction.close()
+					transaction = self.post(redirect_url, data=data, mimetype=mimetype, fields=fields, attach=attach, headers=headers, cookies=cookies, do=True, stream=stream)
 				else:
 					break
 		return transaction
 
+	def fetchAll( self, targets, workers=None, ordered=True, follow=None, retry=None, stream=False ):
+		"""Fetches the given URLs (or `Request` instances) concurrently, using
+		a pool of at most `workers` threads, and yields the transactions as
+		they are completed. When `ordered` is true, the transactions are
+		yielded in the order of the targets, otherwise in completion order.
+
+		Each worker has its own HTTP client (clients are stateful), but the
+		workers share the session cookies, cache and connection pool. The
+		session delay, retries and redirects apply to each request as for
+		`get` (POST requests are resent to the redirect URL, as `post`
+		does)."""
+		return self.map(None, targets, workers=workers, ordered=ordered, follow=follow, retry=retry, stream=stream)
+
+	def map( self, function, targets, workers=None, ordered=True, follow=None, retry=None, stream=False ):
+		"""Like `fetchAll`, but yields the result of `function(transaction)`
+		for each completed transaction. The function is applied within the
+		worker thread, so that processing the responses (for instance
+		scraping them) is done concurrently as well.
+
+		Clients that can send many requests at once (those with a `deferred`
+		method, like `curlclient.HTTPClient`) do all the transactions from
+		the calling thread instead, with at most `workers` targets in
+		progress (see `_mapBatch`). Responses are not streamed then."""
+		if getattr(self._httpClient, "deferred", None):
+			for value in self._mapBatch(function, targets, workers, ordered, follow, retry):
+				yield value
+			return
+		workers  = min(workers or self.WORKERS, len(targets)) if hasattr(targets, "__len__") else (workers or self.WORKERS)
+		targets  = enumerate(targets)
+		results  = queue.Queue()
+		lock     = threading.Lock()
+		stop     = threading.Event()
+		def worker():
+			client = self._createClient()
+			try:
+				while not stop.is_set():
+					with lock:
+						i, target = next(targets, (None, None))
+					if i is None: break
+					try:
+						transaction = self._fetch(target, client, follow, retry, stream)
+						value, error = (function(transaction) if function else transaction), None
+					except Exception as e:
+						value, error = None, e
+					results.put((i, value, error))
+			finally:
+				results.put(None)
+		threads = [threading.Thread(target=worker) for _ in range(max(1, workers))]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		running = len(threads)
+		pending = {}
+		index   = 0
+		try:
+			while running:
+				result = results.get()
+				if result is None:
+					running -= 1
+					continue
+				if ordered:
+					pending[result[0]] = result
+					while index in pending:
+						_, value, error = pending.pop(index)
+						index += 1
+						if error: raise error
+						yield value
+				else:
+					_, value, error = result
+					if error: raise error
+					yield value
+		finally:
+			stop.set()
+
+	def _mapBatch( self, function, targets, workers=None, ordered=True, follow=None, retry=None ):
+		"""Does the work of `map` with the session client, whose `deferred`
+		view queues the requests so that they are sent together. Each target
+		goes through the same steps as in `_fetch` (scheduler delay, retries,
+		`Retry-After` and redirects), but the waits are kept in a heap of due
+		times instead of blocking a thread.
+
+		When the iteration stops early (an error is raised, or the generator
+		is closed), the transfers in flight are cancelled."""
+		if follow is None: follow = self._follow
+		retry    = retry or self.DEFAULT_RETRIES
+		retry_on = (http_client.IncompleteRead, socket.timeout)
+		client   = self._httpClient.deferred()
+		limit    = workers or client.engine().maxTransfers
+		targets  = enumerate(targets)
+		due      = []
+		sent     = set()
+		results  = {}
+		running  = 0
+		index    = 0
+		order    = itertools.count()
+		def schedule( state, delay=0 ):
+			# The state is (index, request, transaction, attempt, visited)
+			host = Scheduler.Host(state[1].url())
+			heapq.heappush(due, (time.time() + max(delay, self._scheduler.reserve(host)), next(order), state))
+		def start( i, request, visited ):
+			transaction = Transaction(self, request, client=client)
+			with self._lock:
+				self._addTransaction(transaction)
+			schedule([i, request, transaction, 0, visited])
+		def finish( state, error=None ):
+			i, transaction = state[0], state[2]
+			if error is not None:
+				transaction.fail(error)
+				if self._throwExceptions:
+					results[i] = (None, error)
+					return
+			try:
+				results[i] = ((function(transaction) if function else transaction), None)
+			except Exception as e:
+				results[i] = (None, e)
+		def complete( transfer ):
+			sent.discard(transfer)
+			state = transfer.context
+			i, request, transaction, attempt, visited = state
+			host  = Scheduler.Host(request.url())
+			if transfer.error is not None:
+				if isinstance(transfer.error, retry_on) and attempt < len(retry) - 1:
+					state[3] += 1
+					schedule(state, retry[attempt])
+				else:
+					finish(state, transfer.error)
+				return
+			transaction._receive(transfer.responses, str(transfer.status))
+			# The server may ask us to come back later (429/503 + Retry-After)
+			wait = self._scheduler.update(host, transaction.response())
+			if wait is not None and wait <= self._scheduler.MAX_RETRY_AFTER and attempt < len(retry) - 1:
+				transaction.reset()
+				state[3] += 1
+				schedule(state)
+				return
+			if self.MERGE_COOKIES:
+				with self._lock:
+					self._cookies.merge(transaction.newCookies())
+			visited.append(request.url())
+			location = transaction.redirect()
+			url      = self._processURL(location, store=False) if follow and location else None
+			if url is None or url in visited or len(visited) > self.REDIRECT_LIMIT:
+				finish(state)
+				return
+			transaction.close()
+			start(i, self._redirectRequest(request, url), visited)
+		try:
+			while True:
+				# We take new targets as long as there is room for them
+				while running < limit:
+					i, target = next(targets, (None, None))
+					if i is None: break
+					if isinstance(target, Request):
+						request = target
+					else:
+						request = self._createRequest(url=self._processURL(target, store=False), method=GET)
+					running += 1
+					start(i, request, [])
+				# We send the requests that are due
+				now = time.time()
+				while due and due[0][0] <= now:
+					state    = heapq.heappop(due)[2]
+					try:
+						transfer = state[2]._send()
+					except Exception as e:
+						finish(state, e)
+						continue
+					transfer.context = state
+					sent.add(transfer)
+				if client.engine().count():
+					timeout = max(0, due[0][0] - now) if due else None
+					for transfer in client.perform(timeout):
+						complete(transfer)
+				elif due:
+					time.sleep(max(0, due[0][0] - time.time()))
+				elif not results:
+					break
+				# And yield the results that are ready
+				for i in (sorted(results.keys()) if ordered else list(results.keys())):
+					if ordered and i != index: break
+					value, error = results.pop(i)
+					running -= 1
+					index   += 1
+					if error: raise error
+					yield value
+		finally:
+			# The transfers that are still queued or in flight are dropped
+			client.cancel(list(sent))
+			del due[:]
+
 	def submit( self, form, values={}, attach=[], action=None,  method=POST,
 	do=None, cookies=None, strip=True ):
 		"""Submits the given form with the current values and action (first
@@ -883,10 +1199,7 @@ class Session:
 		"""Saves the page from the given transaction (default it 'last()') to
 		the given file."""
 		if transaction is None: transaction = self.last()
-		d = transaction.data()
-		f = file(path,'w')
-		f.write(d)
-		f.close()
+		transaction.save(path)
 
 	def preview( self, transaction=None ):
 		"""Opens a web browser to preview the request."""
@@ -899,7 +1212,7 @@ class Session:
 		time.sleep(5)
 		os.unlink(path)
 
-	def __processURL( self, url, store=True ):
+	def _processURL( self, url, store=True ):
 		"""Processes the given URL, by storing the host and protocol, and
 		returning a normalized, absolute URL"""
 		# FIXME: Should infer the URL based on the current URL
@@ -949,6 +1262,57 @@ class Session:
 		if fragment:    url += "#" + fragment
 		return url
 
+	def _createClient( self ):
+		"""Returns a new HTTP client of the same class and configuration as
+		this session's client, sharing its cache and connection pool."""
+		http_client         = self._httpClient.__class__()
+		http_client.verbose = self._httpClient.verbose
+		http_client._onLog  = self._httpClient._onLog
+		if self._httpClient._cache: http_client.setCache(self._httpClient._cache)
+		http_client.setPool(self._pool)
+		return http_client
+
+	def _fetch( self, target, client, follow=None, retry=None, stream=False ):
+		"""Does the transaction for the given URL or `Request` using the given
+		HTTP client, following redirects. This is used by the `fetchAll`
+		workers, and does not change the session host."""
+		if follow is None: follow = self._follow
+		if isinstance(target, Request):
+			request = target
+		else:
+			request = self._createRequest(url=self._processURL(target, store=False), method=GET)
+		visited = []
+		while True:
+			transaction = Transaction(self, request, stream=stream, client=client)
+			with self._lock:
+				self._addTransaction(transaction)
+			try:
+				self._doTransaction(transaction, retry)
+			except Exception as e:
+				return self._failTransaction(transaction, e)
+			visited.append(request.url())
+			location = transaction.redirect()
+			if not (follow and location) or len(visited) > self.REDIRECT_LIMIT:
+				return transaction
+			url = self._processURL(location, store=False)
+			if url in visited:
+				return transaction
+			transaction.close()
+			request = self._redirectRequest(request, url)
+
+	def _redirectRequest( self, request, url ):
+		"""Returns the request that follows the redirection of the given
+		request to the given URL. It keeps the method, data, headers and
+		cookies of the request (as 'get' does), the session headers and
+		cookies being added again when it is created and sent."""
+		with self._lock:
+			session = set(name for name, value in self._cookies.pairs)
+		return self._createRequest(url=url, method=request.method(),
+			data=request.data(), fields=request.fields().asFields(),
+			attach=request.attachments(),
+			headers=[_ for _ in request._headers.pairs if _[0].lower() != "referer"],
+			cookies=[_ for _ in request.cookies().pairs if _[0] not in session])
+
 	def _createRequest( self, **kwargs ):
 		# We copyt the session headers (ie. authentication)
 		kwargs["headers"] = (kwargs.get("headers") or []) + self._headers
@@ -958,7 +1322,7 @@ class Session:
 		if self._personality: self._personality.apply(request)
 		return request
 
-	def __addTransaction( self, transaction ):
+	def _addTransaction( self, transaction ):
 		"""Adds a transaction to this session."""
 		if len(self._transactions) > self._maxTransactions:
 			self._transactions = self._transactions[1:]
@@ -995,7 +1359,13 @@ class Personality:
 		return self.agent[-1]
 
 	def apply( self, request ):
-		pass
+		self.acceptEncoding(request)
+
+	def acceptEncoding( self, request ):
+		"""Asks for the content encodings the clients can decode (see
+		'client.ContentDecoder'), unless the request says otherwise."""
+		if request.header("Accept-Encoding") is None:
+			request.header("Accept-Encoding", client.ContentDecoder.ACCEPT)
 
 class Firefox(Personality):
 	"""Simulates the way Firefox would behave."""
@@ -1009,7 +1379,7 @@ class Firefox(Personality):
 		"text/xml,application/xml,application/xhtml+xml,text/html;q=0.9,text/plain;q=0.8,image/png,*/*;q=0.5"
 		)
 		request.header( "Accept-Language", "en-us,en;q=0.5")
-		#request.header( "Accept-Encoding", "gzip,deflate")
+		self.acceptEncoding(request)
 		request.header( "Accept-Charset", "ISO-8859-1,utf-8;q=0.7,*;q=0.7")
 		request.header( "Keep-Alive", "300")
 		request.header( "Connection", "keep-alive")
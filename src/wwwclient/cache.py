@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+# Encoding: utf8
+# -----------------------------------------------------------------------------
+# Project   : WWWClient
+# -----------------------------------------------------------------------------
+# Author    : Sebastien Pierre                               <sebastien@ivy.fr>
+# -----------------------------------------------------------------------------
+# License   : GNU Lesser General Public License
+# Credits   : Xprima.com
+# -----------------------------------------------------------------------------
+# Creation  : 17-Oct-2026
+# Last mod  : 17-Oct-2026
+# -----------------------------------------------------------------------------
+
+import os, sys, time, mmap, pickle, hashlib, tempfile, threading, email.utils
+from   collections import OrderedDict
+from   wwwclient import client
+from   wwwclient.compat import ensure_bytes
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+if sys.version_info.major < 3:
+	import urlparse
+else:
+	import urllib.parse as urlparse
+
+__doc__ = """\
+The 'cache' module implements a private HTTP cache (following RFC 7234) for
+the HTTP clients, as given to 'browse.Session(cache=...)'.
+
+The 'HTTPCache' decides which responses can be stored and for how long they
+are fresh ('Cache-Control', 'Expires', or a heuristic based on
+'Last-Modified'). Fresh responses are served without contacting the server,
+and stale responses are revalidated with 'If-None-Match' and
+'If-Modified-Since': a '304 Not Modified' answer reuses the stored body.
+Unsafe requests (like 'POST') invalidate the stored response for their URL.
+
+The responses are kept by a storage backend, which is any object with
+'get(key)', 'set(key, entry)' and (optionally) 'remove(key)' methods:
+
+ - 'MemoryStorage' keeps the entries in memory, evicting the least recently
+   used ones beyond a total size in bytes
+ - 'DiskStorage' keeps one file per entry in a directory
+ - 'SegmentStorage' keeps the bodies in content-addressed files, read through
+   memory maps, and evicts the least recently used entries beyond a total size
+
+--
+	session = browse.Session(cache=HTTPCache(MemoryStorage(maxSize=50e6)))
+	session = browse.Session(cache=DiskStorage("/tmp/cache"))
+--
+
+A storage given directly (or any legacy object with 'get' and 'set') is
+wrapped in an 'HTTPCache'.
+"""
+
+CACHEABLE_STATUS   = (200, 203, 204, 300, 301, 404, 405, 410, 414, 501)
+CACHEABLE_METHODS  = ("GET", "HEAD")
+# Headers of a '304' response that must not replace the stored ones
+NOT_UPDATED        = ("content-length", "content-encoding", "transfer-encoding", "content-range")
+
+# -----------------------------------------------------------------------------
+#
+# ENTRY
+#
+# -----------------------------------------------------------------------------
+
+class Entry:
+	"""A stored response, along with the time at which it was received and
+	the values of the request headers it varies on. Entries only hold simple
+	values, so that they can be pickled by storage backends."""
+
+	def __init__( self, url, response, requestHeaders=None, requestTime=None, responseTime=None ):
+		self.url          = url
+		self.firstLine    = response.firstLine
+		self.headers      = list(response.headers.items())
+		self.body         = response.body
+		self.responseTime = responseTime or time.time()
+		self.requestTime  = requestTime  or self.responseTime
+		self.vary         = {}
+		for name in self.varyNames():
+			self.vary[name] = (requestHeaders or client.Headers()).get(name)
+
+	def response( self, method="GET" ):
+		"""Returns a new 'client.Response' for this entry, as an answer to a
+		request with the given method: 'HEAD' responses have no body."""
+		body = b"" if method == "HEAD" else self.body
+		return client.Response(self.firstLine, body=body, headers=client.Headers(self.headers))
+
+	def header( self, name, default=None ):
+		name = name.lower()
+		for k, v in self.headers:
+			if k.lower() == name: return v
+		return default
+
+	def cacheControl( self ):
+		return CacheControl(",".join(v for k, v in self.headers if k.lower() == "cache-control"))
+
+	def varyNames( self ):
+		vary = self.header("Vary")
+		if not vary: return ()
+		return tuple(_.strip().lower() for _ in vary.split(",") if _.strip())
+
+	def matches( self, requestHeaders ):
+		"""Tells if this entry can be used for a request with the given
+		headers (see the 'Vary' header)."""
+		for name, value in self.vary.items():
+			if name == "*" or requestHeaders.get(name) != value:
+				return False
+		return True
+
+	def size( self ):
+		"""Returns the approximate size of this entry, in bytes."""
+		return len(self.body or b"") + sum(len(k) + len(v) + 4 for k, v in self.headers)
+
+	def age( self, now=None ):
+		"""Returns the current age of this entry, in seconds."""
+		now          = now or time.time()
+		date         = _parseDate(self.header("Date"))
+		apparent_age = max(0, self.responseTime - date) if date else 0
+		age_value    = _parseInt(self.header("Age")) or 0
+		corrected    = max(apparent_age, age_value + (self.responseTime - self.requestTime))
+		return corrected + (now - self.responseTime)
+
+	def lifetime( self ):
+		"""Returns the freshness lifetime of this entry, in seconds."""
+		cache_control = self.cacheControl()
+		if "no-cache" in cache_control: return 0
+		if "max-age" in cache_control: return _parseInt(cache_control["max-age"]) or 0
+		date    = _parseDate(self.header("Date")) or self.responseTime
+		expires = self.header("Expires")
+		if expires is not None:
+			expires = _parseDate(expires)
+			return max(0, expires - date) if expires else 0
+		# Heuristic freshness: 10% of the time since the last modification
+		last_modified = _parseDate(self.header("Last-Modified"))
+		if last_modified:
+			return max(0, (date - last_modified) / 10.0)
+		return 0
+
+	def isFresh( self, now=None ):
+		return self.lifetime() > self.age(now)
+
+	def update( self, response, requestTime=None ):
+		"""Updates this entry with the headers of the given '304' response."""
+		updated = dict((k.lower(), v) for k, v in response.headers.items() if k.lower() not in NOT_UPDATED)
+		headers = [(k, v) for k, v in self.headers if k.lower() not in updated]
+		for name, value in response.headers.items():
+			if name.lower() in updated: headers.append((name, value))
+		self.headers      = headers
+		self.responseTime = time.time()
+		self.requestTime  = requestTime or self.responseTime
+		return self
+
+# -----------------------------------------------------------------------------
+#
+# CACHE CONTROL
+#
+# -----------------------------------------------------------------------------
+
+class CacheControl(dict):
+	"""The directives of a 'Cache-Control' header, as a dictionary mapping
+	the lowercase directive names to their value (or 'None')."""
+
+	def __init__( self, value ):
+		dict.__init__(self)
+		for directive in (value or "").split(","):
+			directive = directive.strip()
+			if not directive: continue
+			name, _, arg = directive.partition("=")
+			self[name.strip().lower()] = arg.strip().strip('"') if _ else None
+
+# -----------------------------------------------------------------------------
+#
+# HTTP CACHE
+#
+# -----------------------------------------------------------------------------
+
+class HTTPCache:
+	"""A private HTTP cache, storing the responses in the given storage (a
+	'MemoryStorage' by default). The cache is used by the HTTP clients
+	as follows:
+
+	1. 'get' returns the stored entry for a request, if any,
+	2. if the entry is fresh, its response is used,
+	3. otherwise 'validate' adds the conditional headers to the request,
+	4. and 'store' stores the response from the server, returning the stored
+	   response when the server answered '304'.
+	"""
+
+	def __init__( self, storage=None ):
+		self.storage = storage if storage is not None else MemoryStorage()
+
+	@classmethod
+	def Ensure( cls, cache ):
+		"""Returns the given cache if it is an 'HTTPCache', or an 'HTTPCache'
+		using it as storage."""
+		if cache is None or isinstance(cache, HTTPCache): return cache
+		return cls(cache)
+
+	def key( self, method, url ):
+		"""Returns the storage key for the given request: 'HEAD' requests are
+		served by the 'GET' responses, and the URL is normalized (lowercase
+		scheme and host, no default port, no fragment)."""
+		scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+		scheme = scheme.lower()
+		netloc = netloc.lower()
+		if (scheme, netloc.rsplit(":", 1)[-1]) in (("http", "80"), ("https", "443")):
+			netloc = netloc.rsplit(":", 1)[0]
+		url    = urlparse.urlunsplit((scheme, netloc, path or "/", query, ""))
+		return "{0} {1}".format("GET" if method == "HEAD" else method, url)
+
+	def get( self, method, url, headers=None ):
+		"""Returns the stored entry that can be used for the given request,
+		or 'None'."""
+		if method not in CACHEABLE_METHODS: return None
+		headers = _requestHeaders(headers)
+		if "no-store" in CacheControl(headers.get("Cache-Control")): return None
+		entry   = self.storage.get(self.key(method, url))
+		if not isinstance(entry, Entry) or not entry.matches(headers):
+			return None
+		return entry
+
+	def isFresh( self, entry, headers=None ):
+		"""Tells if the given entry can be used without revalidation for a
+		request with the given headers."""
+		cache_control = CacheControl(_requestHeaders(headers).get("Cache-Control"))
+		if "no-cache" in cache_control: return False
+		if "max-age" in cache_control and entry.age() > (_parseInt(cache_control["max-age"]) or 0):
+			return False
+		return entry.isFresh()
+
+	def validate( self, entry, headers=None ):
+		"""Returns the given request headers (as a list of strings) with the
+		conditional headers for the given stale entry."""
+		headers = list(headers or ())
+		etag    = entry.header("ETag")
+		if etag is not None:
+			headers.append("If-None-Match: " + etag)
+		last_modified = entry.header("Last-Modified")
+		if last_modified is not None:
+			headers.append("If-Modified-Since: " + last_modified)
+		return headers
+
+	def store( self, method, url, headers, response, entry=None, requestTime=None ):
+		"""Stores the given response to the given request, and returns the
+		response to use: the stored one if the server answered '304' for
+		the given entry."""
+		status = response.status()
+		key    = self.key(method, url)
+		if method not in CACHEABLE_METHODS:
+			# Unsafe methods invalidate the stored response (RFC 7234 4.4)
+			if status < 400: self.invalidate(url)
+			return response
+		if status == 304 and entry is not None:
+			entry.update(response, requestTime)
+			self.storage.set(key, entry)
+			return entry.response(method)
+		# Only 'GET' responses are stored: the (empty) body of a 'HEAD'
+		# response must not replace the stored one
+		if method == "GET" and self.isStorable(response, _requestHeaders(headers)):
+			self.storage.set(key, Entry(url, response, _requestHeaders(headers), requestTime))
+		elif entry is not None:
+			self.invalidate(url)
+		return response
+
+	def isStorable( self, response, requestHeaders ):
+		"""Tells if the given (complete) response can be stored."""
+		if response.status() not in CACHEABLE_STATUS or response.body is None:
+			return False
+		cache_control = CacheControl(",".join(response.headers.getAll("Cache-Control")))
+		if "no-store" in cache_control:
+			return False
+		if "no-store" in CacheControl(requestHeaders.get("Cache-Control")):
+			return False
+		if "*" in (response.headers.get("Vary") or ""):
+			return False
+		if requestHeaders.get("Authorization") and "public" not in cache_control:
+			return False
+		return bool(
+			"max-age" in cache_control or response.headers.get("Expires")
+			or response.headers.get("ETag") or response.headers.get("Last-Modified")
+		)
+
+	def invalidate( self, url ):
+		"""Removes the stored response for the given URL."""
+		remove = getattr(self.storage, "remove", None)
+		if remove: remove(self.key("GET", url))
+		else: self.storage.set(self.key("GET", url), None)
+		return self
+
+# -----------------------------------------------------------------------------
+#
+# STORAGE
+#
+# -----------------------------------------------------------------------------
+
+class MemoryStorage:
+	"""Keeps the entries in memory, evicting the least recently used ones when
+	their total size exceeds 'maxSize' bytes. This storage is thread-safe."""
+
+	MAX_SIZE = 32 * 1024 * 1024
+
+	def __init__( self, maxSize=None ):
+		self.maxSize  = int(self.MAX_SIZE if maxSize is None else maxSize)
+		self._entries = OrderedDict()
+		self._size    = 0
+		self._lock    = threading.Lock()
+
+	def get( self, key ):
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is not None:
+				self._entries[key] = entry
+			return entry
+
+	def set( self, key, entry ):
+		with self._lock:
+			self._remove(key)
+			if entry is None or entry.size() > self.maxSize: return
+			self._entries[key] = entry
+			self._size        += entry.size()
+			while self._size > self.maxSize:
+				self._remove(next(iter(self._entries)))
+
+	def remove( self, key ):
+		with self._lock:
+			self._remove(key)
+
+	def size( self ):
+		"""Returns the total size of the stored entries, in bytes."""
+		return self._size
+
+	def _remove( self, key ):
+		entry = self._entries.pop(key, None)
+		if entry is not None: self._size -= entry.size()
+
+class DiskStorage:
+	"""Keeps each entry as a pickled file in the given directory, named after
+	the hash of its key. Files are written atomically, so that the directory
+	can be shared by several processes."""
+
+	def __init__( self, path ):
+		self.path = path
+		if not os.path.exists(path): os.makedirs(path)
+
+	def get( self, key ):
+		try:
+			with open(self._path(key), "rb") as f:
+				return pickle.load(f)
+		except (IOError, OSError, EOFError, pickle.UnpicklingError):
+			return None
+
+	def set( self, key, entry ):
+		if entry is None: return self.remove(key)
+		fd, path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+		with os.fdopen(fd, "wb") as f:
+			pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+		os.rename(path, self._path(key))
+
+	def remove( self, key ):
+		try:
+			os.unlink(self._path(key))
+		except OSError:
+			pass
+
+	def _path( self, key ):
+		return os.path.join(self.path, hashlib.sha1(key.encode("utf8")).hexdigest())
+
+class SegmentEntry(Entry):
+	"""An entry stored by a 'SegmentStorage': its body is kept in a separate
+	segment file, named after the hash of its content ('digest'), and is
+	only read (through a memory map) when the response body is read."""
+
+	def __init__( self, entry, digest, bodySize ):
+		self.__dict__.update(entry.__dict__)
+		self.body     = None
+		self.digest   = digest
+		self.bodySize = bodySize
+		self.bodyPath = None
+
+	def response( self, method="GET" ):
+		"""Returns a new 'client.Response' whose body is streamed from the
+		memory-mapped segment file ('HEAD' responses have no body)."""
+		headers = client.Headers(self.headers)
+		if not self.bodySize or method == "HEAD":
+			return client.Response(self.firstLine, body=b"", headers=headers)
+		with open(self.bodyPath, "rb") as f:
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		return client.Response(self.firstLine, body=None, headers=headers,
+			stream=client.BodyStream(data, lambda complete: data.close()))
+
+	def size( self ):
+		return self.bodySize + sum(len(k) + len(v) + 4 for k, v in self.headers)
+
+	def __getstate__( self ):
+		state = dict(self.__dict__)
+		state["bodyPath"] = None
+		return state
+
+class SegmentStorage:
+	"""Keeps the entries in the given directory, which survives restarts and
+	can be shared by several processes:
+
+	- 'index/' has one small file per key (named after the hash of the key)
+	  holding the response headers and the digest of its body,
+	- 'data/' has the bodies, named after the hash of their content, so that
+	  identical bodies are stored once.
+
+	Files are written to a temporary file and renamed, so that readers never
+	see partial files. Reading an entry touches its index file, and when the
+	total size exceeds 'maxSize' the least recently used entries are removed
+	(see 'collect'), under a lock file shared by the processes."""
+
+	MAX_SIZE = 512 * 1024 * 1024
+	# Bodies more recent than this are never collected, as their index may
+	# be being written by another process.
+	GRACE    = 60
+
+	def __init__( self, path, maxSize=None ):
+		self.path    = path
+		self.maxSize = int(self.MAX_SIZE if maxSize is None else maxSize)
+		self._added  = 0
+		self._size   = None
+		self._lock   = threading.Lock()
+		for name in ("index", "data"):
+			directory = os.path.join(path, name)
+			if not os.path.exists(directory): os.makedirs(directory)
+
+	def get( self, key ):
+		path = self._indexPath(key)
+		try:
+			with open(path, "rb") as f:
+				entry = pickle.load(f)
+		except (IOError, OSError, EOFError, pickle.UnpicklingError):
+			return None
+		entry.bodyPath = self._dataPath(entry.digest)
+		if entry.bodySize and not os.path.exists(entry.bodyPath):
+			return None
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+		return entry
+
+	def set( self, key, entry ):
+		if entry is None: return self.remove(key)
+		added = 0
+		if not isinstance(entry, SegmentEntry):
+			body   = ensure_bytes(entry.body or b"")
+			digest = hashlib.sha1(body).hexdigest()
+			path   = self._dataPath(digest)
+			if body and not os.path.exists(path):
+				self._write(path, lambda f:f.write(body))
+				added = len(body)
+			entry  = SegmentEntry(entry, digest, len(body))
+		self._write(self._indexPath(key), lambda f:pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL))
+		with self._lock:
+			if self._size is None: self._size = self.size()
+			else: self._size += added
+			full = self._size > self.maxSize
+		if full: self.collect()
+
+	def remove( self, key ):
+		"""Removes the index of the given key. Its body is removed by the next
+		'collect' (if no other entry has the same body)."""
+		try:
+			os.unlink(self._indexPath(key))
+		except OSError:
+			pass
+
+	def size( self ):
+		"""Returns the total size of the stored bodies, in bytes."""
+		total = 0
+		for name in os.listdir(os.path.join(self.path, "data")):
+			try:
+				total += os.path.getsize(os.path.join(self.path, "data", name))
+			except OSError:
+				pass
+		return total
+
+	def collect( self, maxSize=None ):
+		"""Removes the least recently used entries until the total size is
+		below 90% of 'maxSize', and then the bodies that are not referenced
+		anymore. This returns the new total size."""
+		limit = (self.maxSize if maxSize is None else maxSize) * 0.9
+		with self._lock, self._fileLock():
+			index   = os.path.join(self.path, "index")
+			entries = []
+			for name in os.listdir(index):
+				path = os.path.join(index, name)
+				try:
+					with open(path, "rb") as f:
+						entry = pickle.load(f)
+					entries.append((os.path.getmtime(path), path, entry.digest, entry.bodySize))
+				except (IOError, OSError, EOFError, pickle.UnpicklingError, AttributeError):
+					continue
+			# The size of each body is counted once, even if shared
+			sizes = dict((digest, size) for _, _, digest, size in entries)
+			total = sum(sizes.values())
+			refs  = {}
+			for _, _, digest, _ in entries:
+				refs[digest] = refs.get(digest, 0) + 1
+			entries.sort()
+			for _, path, digest, size in entries:
+				if total <= limit: break
+				os.unlink(path)
+				refs[digest] -= 1
+				if refs[digest] == 0: total -= size
+			# We remove the bodies that are not referenced (and not recent)
+			data = os.path.join(self.path, "data")
+			now  = time.time()
+			for name in os.listdir(data):
+				path = os.path.join(data, name)
+				try:
+					if not refs.get(name) and now - os.path.getmtime(path) > self.GRACE:
+						os.unlink(path)
+				except OSError:
+					pass
+			self._size = total
+		return total
+
+	def _write( self, path, writer ):
+		fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				writer(f)
+			os.rename(temp, path)
+		except Exception as e:
+			os.unlink(temp)
+			raise e
+
+	def _fileLock( self ):
+		return _FileLock(os.path.join(self.path, "lock"))
+
+	def _indexPath( self, key ):
+		return os.path.join(self.path, "index", hashlib.sha1(key.encode("utf8")).hexdigest())
+
+	def _dataPath( self, digest ):
+		return os.path.join(self.path, "data", digest)
+
+class _FileLock:
+	"""An exclusive lock on the given file, shared by processes (this does
+	nothing where 'fcntl' is not available)."""
+
+	def __init__( self, path ):
+		self.path = path
+		self._file = None
+
+	def __enter__( self ):
+		if fcntl:
+			self._file = open(self.path, "a")
+			fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+		return self
+
+	def __exit__( self, *args ):
+		if self._file:
+			fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+			self._file.close()
+			self._file = None
+
+# -----------------------------------------------------------------------------
+#
+# HELPERS
+#
+# -----------------------------------------------------------------------------
+
+def _requestHeaders( headers ):
+	"""Returns the given request headers (a list of 'Name: value' strings)
+	as a 'client.Headers'."""
+	if isinstance(headers, client.Headers): return headers
+	return client.Headers.Parse("\r\n".join(headers or ()))
+
+def _parseDate( value ):
+	if not value: return None
+	date = email.utils.parsedate_tz(value)
+	return email.utils.mktime_tz(date) if date else None
+
+def _parseInt( value ):
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return None
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
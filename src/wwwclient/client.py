@@ -12,9 +12,14 @@
 # Last mod  : 17-Apr-2017
 # -----------------------------------------------------------------------------
 
-import os, re, mimetypes, urllib, zlib, gzip, tempfile
+import os, re, mimetypes, urllib, zlib
 from .compat import *
 
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
 __doc__ = """\
 This modules defines an abstract class for HTTP clients, that creates a simple,
 easy to understand, low-level wrapper for existing HTTP implementation. It
@@ -35,18 +40,762 @@ among different sessions.
 FILE_ATTACHMENT    = 0
 CONTENT_ATTACHMENT = 1
 
-RE_CONTENT_LENGTH  = re.compile("^\s*Content-Length\s*:\s*([0-9]+)", re.I|re.MULTILINE)
-RE_CONTENT_ENCODING= re.compile("^\s*Content-Encoding\s*:(.*)\r\n", re.I|re.MULTILINE)
 RE_CONTENT_TYPE    = re.compile("^\s*Content-Type\s*:(.*)\r\n",   re.I|re.MULTILINE)
-RE_CHARSET         = re.compile("\s*charset=([\w\d_-]+)",           re.I|re.MULTILINE)
-RE_LOCATION        = re.compile("^\s*Location\s*:(.*)\r\n",          re.I|re.MULTILINE)
-RE_SET_COOKIE      = re.compile("^\s*Set-Cookie\s*:(.*)\r\n",        re.I|re.MULTILINE)
-RE_CHUNKED         = re.compile("^\s*Transfer-Encoding\s*:\s*chunked\s*\r\n", re.I|re.MULTILINE)
 CRLF               = "\r\n"
 BOUNDARY           = '----------fbb6cc131b52e5a980ac702bedde498032a88158$'
 DEFAULT_MIMETYPE   = 'text/plain'
 DEFAULT_ATTACH_MIMETYPE = 'application/octet-stream'
 
+# -----------------------------------------------------------------------------
+#
+# HEADERS
+#
+# -----------------------------------------------------------------------------
+
+class Headers:
+	"""A case-insensitive multi-map of HTTP headers. Headers keep the order and
+	the case in which they were received, and a header can have more than one
+	value (like 'Set-Cookie')."""
+
+	@classmethod
+	def Parse( self, text ):
+		"""Parses the given header block (the lines following the status line)
+		in a single pass. Lines can be separated by CRLF or LF, and folded
+		(continuation) lines are joined to the previous header."""
+		headers = self()
+		name    = None
+		value   = None
+		for line in text.split("\n"):
+			if not line or line == "\r": continue
+			if line[0] in " \t":
+				if name is not None: value = value + " " + line.strip()
+				continue
+			if name is not None: headers.add(name, value)
+			colon = line.find(":")
+			if colon <= 0:
+				name = None
+				continue
+			name  = line[:colon].strip()
+			value = line[colon+1:].strip()
+		if name is not None: headers.add(name, value)
+		return headers
+
+	def __init__( self, pairs=None ):
+		self._pairs = []
+		self._index = {}
+		if pairs:
+			for name, value in pairs:
+				self.add(name, value)
+
+	def add( self, name, value ):
+		"""Adds the given value to the header with the given name."""
+		self._pairs.append((name, value))
+		key = name.lower()
+		values = self._index.get(key)
+		if values is None:
+			self._index[key] = [value]
+		else:
+			values.append(value)
+		return self
+
+	def set( self, name, value ):
+		"""Replaces the values of the header with the given name by the given
+		value."""
+		return self.remove(name).add(name, value)
+
+	def remove( self, name ):
+		"""Removes all the values of the header with the given name."""
+		key = name.lower()
+		if key in self._index:
+			del self._index[key]
+			self._pairs = [_ for _ in self._pairs if _[0].lower() != key]
+		return self
+
+	def get( self, name, default=None ):
+		"""Returns the first value of the header with the given name."""
+		values = self._index.get(name.lower())
+		return values[0] if values else default
+
+	def getAll( self, name ):
+		"""Returns the list of values of the header with the given name."""
+		return self._index.get(name.lower()) or []
+
+	def has( self, name ):
+		return name.lower() in self._index
+
+	def items( self ):
+		"""Returns the list of (name, value) pairs, in received order."""
+		return list(self._pairs)
+
+	def __contains__( self, name ):
+		return self.has(name)
+
+	def __getitem__( self, name ):
+		return self.get(name)
+
+	def __iter__( self ):
+		return iter(self._pairs)
+
+	def __len__( self ):
+		return len(self._pairs)
+
+	def __repr__( self ):
+		return repr(self._pairs)
+
+# -----------------------------------------------------------------------------
+#
+# RESPONSE
+#
+# -----------------------------------------------------------------------------
+
+class Response:
+	"""A response as returned by an 'HTTPClient'. The response headers are
+	parsed once, when the response is created, into a 'Headers' instance
+	available as 'headers'.
+
+	When the response is streamed, the body is not read by the client: it is
+	'None' and 'stream' is a 'BodyStream' from which it can be read. Clients
+	may also give the body as a 'memoryview' of their receive buffer, which
+	is only copied or decoded when asked for (see 'text').
+
+	When the client decodes the body (chunked 'Transfer-Encoding' or
+	'Content-Encoding'), the headers describe the decoded body and the headers
+	as received are kept as 'originalHeaders' (see 'markDecoded').
+
+	For compatibility, a response also behaves as the triple
+	'(firstline, headers, body)' where the headers are the unparsed header
+	block."""
+
+	TEXT_TYPES = ("text/", "json", "xml", "javascript", "x-www-form-urlencoded")
+
+	def __init__( self, firstLine, rawHeaders=None, body="", headers=None, stream=None ):
+		self.firstLine   = firstLine
+		self.headers     = Headers.Parse(rawHeaders or "") if headers is None else headers
+		self.body        = body
+		self.stream      = stream
+		self._rawHeaders = rawHeaders
+		self._text       = None
+		self.originalHeaders = None
+
+	@property
+	def rawHeaders( self ):
+		"""The unparsed header block (rebuilt from 'headers' when the response
+		was not created from a string)."""
+		if self._rawHeaders is None:
+			self._rawHeaders = "".join("%s: %s\r\n" % (k, v) for k, v in self.headers)
+		return self._rawHeaders
+
+	@rawHeaders.setter
+	def rawHeaders( self, value ):
+		self._rawHeaders = value
+
+	def isEncoded( self ):
+		"""Tells if the body, as received, is chunked or has a
+		'Content-Encoding' that the client decodes."""
+		return "chunked" in (self.headers.get("Transfer-Encoding") or "").lower() \
+			or ContentDecoder.Create(self.headers.get("Content-Encoding")) is not None
+
+	def markDecoded( self, length=None ):
+		"""Updates the headers once the body was decoded: the received headers
+		are kept as 'originalHeaders', the 'Transfer-Encoding' and
+		'Content-Encoding' are removed and the 'Content-Length' is set to the
+		given length of the decoded body (or removed when it is not known,
+		as for streamed bodies)."""
+		if self.originalHeaders is None:
+			self.originalHeaders = Headers(self.headers.items())
+		self.headers.remove("Transfer-Encoding").remove("Content-Encoding")
+		if length is None:
+			self.headers.remove("Content-Length")
+		else:
+			self.headers.set("Content-Length", str(length))
+		self._rawHeaders = None
+		return self
+
+	def isText( self ):
+		"""Tells if the body is text, based on the content type (a response
+		without a content type is considered as text)."""
+		if self.charset(): return True
+		content_type = self.contentType()
+		if not content_type: return True
+		for _ in self.TEXT_TYPES:
+			if _ in content_type: return True
+		return False
+
+	def text( self, encoding=None ):
+		"""Returns the body decoded as text using the response charset, or the
+		given default encoding. The decoded text is kept, so that it is only
+		decoded once."""
+		if self.stream is not None: self.read()
+		body = self.body
+		if body is None or isinstance(body, unicode): return body
+		if self._text is None:
+			charset = self.charset(encoding) or "latin-1"
+			try:
+				self._text = ensure_unicode(body, charset)
+			except LookupError:
+				self._text = ensure_unicode_safe(body, encoding or "latin-1")
+			except UnicodeDecodeError:
+				self._text = ensure_unicode_safe(body, charset)
+		return self._text
+
+	def read( self ):
+		"""Reads the rest of a streamed body (see 'BodyStream') into 'body',
+		and returns the body."""
+		if self.stream is not None:
+			self.body   = self.stream.read()
+			self.stream = None
+			self._text  = None
+		return self.body
+
+	def status( self ):
+		"""Returns the status code of this response, as an integer."""
+		status = self.firstLine.split(None, 2)
+		return int(status[1]) if len(status) > 1 and status[1].isdigit() else None
+
+	def contentType( self ):
+		"""Returns the mime type given by the 'Content-Type' header (without
+		its parameters)."""
+		content_type = self.headers.get("Content-Type")
+		return content_type.split(";", 1)[0].strip().lower() if content_type else None
+
+	def charset( self, default=None ):
+		"""Returns the charset given by the 'Content-Type' header."""
+		content_type = self.headers.get("Content-Type")
+		if content_type:
+			for param in content_type.split(";")[1:]:
+				name, _, value = param.partition("=")
+				if name.strip().lower() == "charset":
+					return value.strip().strip("\"'") or default
+		return default
+
+	def location( self ):
+		"""Returns the value of the 'Location' header (if any)."""
+		return self.headers.get("Location")
+
+	def cookies( self ):
+		"""Returns the list of (name, value) pairs set by the 'Set-Cookie'
+		headers of this response. Cookie attributes (path, expires, etc) are
+		not included."""
+		res = []
+		for cookie in self.headers.getAll("Set-Cookie"):
+			name, equal, value = cookie.split(";", 1)[0].partition("=")
+			name = name.strip()
+			if equal and name: res.append((name, value.strip()))
+		return res
+
+	def __getitem__( self, index ):
+		return (self.firstLine, self.rawHeaders, self.body)[index]
+
+	def __setitem__( self, index, value ):
+		index = index % 3
+		if   index == 0: self.firstLine  = value
+		elif index == 1: self.rawHeaders = value
+		else:
+			self.body  = value
+			self._text = None
+
+	def __iter__( self ):
+		return iter((self.firstLine, self.rawHeaders, self.body))
+
+	def __len__( self ):
+		return 3
+
+	def __repr__( self ):
+		return "<Response %s>" % (self.firstLine)
+
+# -----------------------------------------------------------------------------
+#
+# CONTENT DECODER
+#
+# -----------------------------------------------------------------------------
+
+class ContentDecoderError(Exception): pass
+class ContentDecoder:
+	"""An incremental decoder for the 'Content-Encoding' of a body, which can
+	be 'gzip', 'deflate' (with or without the zlib header), 'br' (when the
+	optional 'brotli' module is installed) or a list of these codings. The
+	body is decoded in memory, as it is fed to 'decompress'."""
+
+	# The value of the 'Accept-Encoding' header for the supported codings
+	ACCEPT = "gzip, deflate, br" if brotli else "gzip, deflate"
+
+	@classmethod
+	def Create( cls, contentEncoding ):
+		"""Returns a decoder for the given 'Content-Encoding' header value,
+		or 'None' when the body is not encoded."""
+		codings = [_.strip().lower() for _ in (contentEncoding or "").split(",")]
+		codings = [_ for _ in codings if _ and _ != "identity"]
+		return cls(codings) if codings else None
+
+	def __init__( self, codings ):
+		# The codings are applied in order, so they are decoded in reverse
+		self._decoders = [self._createDecoder(_) for _ in reversed(codings)]
+
+	def decompress( self, data ):
+		"""Returns the decoded data available after feeding the given data."""
+		for decoder in self._decoders:
+			if not data: break
+			data = decoder.decompress(data)
+		return data
+
+	def flush( self ):
+		"""Returns the rest of the decoded data, once the whole body was
+		fed."""
+		data = b""
+		for decoder in self._decoders:
+			data = decoder.decompress(data) + decoder.flush() if data else decoder.flush()
+		return data
+
+	def decode( self, data ):
+		"""Decodes the given (complete) body."""
+		return self.decompress(data) + self.flush()
+
+	def _createDecoder( self, coding ):
+		if coding in ("gzip", "x-gzip", "deflate"):
+			return _ZlibDecoder()
+		elif coding == "br" and brotli:
+			return _BrotliDecoder()
+		else:
+			raise ContentDecoderError("Unsupported content encoding: " + coding)
+
+class _ZlibDecoder:
+	"""Decodes gzip and zlib streams (the header is detected), as well as
+	the raw deflate streams some servers send for 'deflate'. Concatenated
+	gzip members are decoded as well."""
+
+	GZIP_MAGIC = b"\x1f\x8b"
+
+	def __init__( self ):
+		self._zlib  = zlib.decompressobj(32 + zlib.MAX_WBITS)
+		# The data fed until the format is known, in case it is raw deflate
+		self._head  = b""
+
+	def decompress( self, data ):
+		if self._head is not None: self._head += data
+		try:
+			res = self._zlib.decompress(data)
+		except zlib.error as e:
+			if self._head is None: raise ContentDecoderError(str(e))
+			self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+			try:
+				res = self._zlib.decompress(self._head)
+			except zlib.error as e:
+				raise ContentDecoderError(str(e))
+			self._head = None
+		if res: self._head = None
+		# A new gzip member may start after the end of the previous one
+		while self._zlib.unused_data.startswith(self.GZIP_MAGIC):
+			data       = self._zlib.unused_data
+			self._zlib = zlib.decompressobj(32 + zlib.MAX_WBITS)
+			res       += self._zlib.decompress(data)
+		return res
+
+	def flush( self ):
+		return self._zlib.flush()
+
+class _BrotliDecoder:
+
+	def __init__( self ):
+		self._brotli = brotli.Decompressor()
+		# The 'brotli' and 'brotlicffi' modules name the method differently
+		self._decompress = getattr(self._brotli, "process", None) or self._brotli.decompress
+
+	def decompress( self, data ):
+		return self._decompress(data)
+
+	def flush( self ):
+		return b""
+
+# -----------------------------------------------------------------------------
+#
+# BODY STREAM
+#
+# -----------------------------------------------------------------------------
+
+class BodyStream:
+	"""Gives incremental access to a response body that was not read by the
+	client. The body is read from the given 'stream' (an object with a
+	'read(size)' method, like an 'http.client' response), and can only be
+	read once.
+
+	The 'onClose' callback is invoked when the stream is closed, with a
+	boolean telling if the body was read completely (in which case the
+	underlying connection can be reused). Closing a stream drains at most
+	'DRAIN_LIMIT' bytes of unread body, so that small bodies do not prevent
+	the connection from being kept alive.
+
+	When a 'ContentDecoder' is given, the body is decoded as it is read."""
+
+	CHUNK_SIZE  = 64 * 1024
+	DRAIN_LIMIT = 64 * 1024
+
+	def __init__( self, stream, onClose=None, decoder=None ):
+		self._stream  = stream
+		self._onClose = onClose
+		self._decoder = decoder
+		self._pending = b""
+		self._eof     = False
+		self._closed  = False
+
+	def read( self, size=-1 ):
+		"""Reads at most 'size' bytes from the body, or the rest of the body
+		when size is negative. This returns an empty string once the whole
+		body was read."""
+		if self._decoder is None:
+			return self._read(size)
+		if size is None or size < 0:
+			data          = self._pending + self._decode(self._read())
+			self._pending = b""
+			return data
+		# The decoded data is buffered, as its size is not known in advance
+		while len(self._pending) < size and not self._closed:
+			self._pending += self._decode(self._read(self.CHUNK_SIZE))
+		data, self._pending = self._pending[:size], self._pending[size:]
+		return data
+
+	def _read( self, size=-1 ):
+		"""Reads the raw (encoded) body."""
+		if self._closed: return b""
+		if size is None or size < 0:
+			data      = self._stream.read()
+			self._eof = True
+		else:
+			data      = self._stream.read(size)
+			self._eof = not data
+		if self._eof: self.close()
+		return data
+
+	def _decode( self, data ):
+		data = self._decoder.decompress(data) if data else b""
+		return data + self._decoder.flush() if self._eof else data
+
+	def iterChunks( self, size=None ):
+		"""Iterates on the body, yielding chunks of at most 'size' bytes."""
+		size = size or self.CHUNK_SIZE
+		while True:
+			data = self.read(size)
+			if not data: break
+			yield data
+
+	def iterLines( self, size=None ):
+		"""Iterates on the lines of the body (without their line endings)."""
+		pending = b""
+		for data in self.iterChunks(size):
+			lines   = (pending + data).split(b"\n")
+			pending = lines.pop()
+			for line in lines:
+				yield line[:-1] if line.endswith(b"\r") else line
+		if pending: yield pending
+
+	def isClosed( self ):
+		return self._closed
+
+	def close( self ):
+		"""Closes this stream, discarding the rest of the body."""
+		if self._closed: return
+		drained = 0
+		while not self._eof and drained < self.DRAIN_LIMIT:
+			data      = self._stream.read(self.CHUNK_SIZE)
+			drained  += len(data)
+			self._eof = not data
+		self._closed = True
+		if self._onClose: self._onClose(self._eof)
+
+# -----------------------------------------------------------------------------
+#
+# CHUNKED TRANSFER-ENCODING
+#
+# -----------------------------------------------------------------------------
+
+class ChunkedDecoderError(Exception): pass
+class ChunkedDecoder:
+	"""An incremental decoder for the 'chunked' transfer-encoding (RFC 7230,
+	section 4.1). Chunk extensions are ignored and trailers are parsed into
+	the 'trailers' headers.
+
+	The decoder can be fed with the raw data as it comes ('feed', suitable
+	for a curl WRITEFUNCTION), or read a whole body from a stream that
+	supports 'readline' and 'readinto' ('readFrom', suitable for an
+	'http.client' response), in which case chunk payloads are read straight
+	into the decoded body buffer.
+
+	The decoded body is a single 'bytearray', grown as chunk data arrives
+	(or preallocated with the 'size' hint), and returned by 'data'. The
+	chunk sizes given by the server are not trusted: at most 'CHUNK_SIZE'
+	bytes are reserved ahead of the data that was actually received."""
+
+	SIZE       = 0
+	DATA       = 1
+	DATA_END   = 2
+	TRAILER    = 3
+	DONE       = 4
+
+	MAX_LINE   = 65536
+	CHUNK_SIZE = 64 * 1024
+
+	def __init__( self, size=0 ):
+		self.trailers   = Headers()
+		self._state     = self.SIZE
+		self._remaining = 0
+		self._length    = 0
+		self._line      = bytearray()
+		self._body      = bytearray(size)
+
+	def isDone( self ):
+		"""Tells if the last chunk (and the trailers) were decoded."""
+		return self._state == self.DONE
+
+	def remaining( self ):
+		"""Returns the number of bytes of chunk data expected next, or 0 when
+		the decoder expects a line (chunk size, chunk end or trailer)."""
+		return self._remaining if self._state == self.DATA else 0
+
+	def data( self ):
+		"""Returns the decoded body as a 'bytearray'."""
+		if len(self._body) > self._length:
+			del self._body[self._length:]
+		return self._body
+
+	def feed( self, data ):
+		"""Decodes the given bytes, and returns the number of bytes that were
+		consumed. Once the decoder is done, the rest of the data is not
+		consumed (it belongs to whatever follows the body)."""
+		offset = 0
+		length = len(data)
+		while offset < length and self._state != self.DONE:
+			if self._state == self.DATA:
+				n = min(self._remaining, length - offset)
+				self._write(memoryview(data)[offset:offset+n])
+				offset += n
+			else:
+				eol = data.find(b"\n", offset)
+				end = length if eol == -1 else eol + 1
+				self._line.extend(memoryview(data)[offset:end])
+				if len(self._line) > self.MAX_LINE:
+					raise ChunkedDecoderError("Chunk line too long")
+				offset = end
+				if eol != -1:
+					line       = bytes(self._line)
+					self._line = bytearray()
+					self._processLine(line)
+		return offset
+
+	def readFrom( self, stream ):
+		"""Reads and decodes a complete chunked body from the given stream,
+		returning the decoded body."""
+		while self._state != self.DONE:
+			if self._state == self.DATA:
+				size = min(self._remaining, self.CHUNK_SIZE)
+				view = memoryview(self._reserve(size))[self._length:self._length + size]
+				n    = stream.readinto(view)
+				del view
+				if not n: raise ChunkedDecoderError("Incomplete chunked body")
+				self._length    += n
+				self._remaining -= n
+				if self._remaining == 0: self._state = self.DATA_END
+			else:
+				line = stream.readline(self.MAX_LINE + 1)
+				if not line: raise ChunkedDecoderError("Incomplete chunked body")
+				if len(line) > self.MAX_LINE: raise ChunkedDecoderError("Chunk line too long")
+				self._processLine(line)
+		return self.data()
+
+	def _processLine( self, line ):
+		line = line.strip()
+		if self._state == self.SIZE:
+			size = line.split(b";", 1)[0].strip()
+			# Python also parses signs, underscores and '0x', which are not
+			# valid chunk sizes
+			if not size or size.strip(b"0123456789abcdefABCDEF"):
+				raise ChunkedDecoderError("Invalid chunk size: %r" % (line))
+			size = int(size, 16)
+			if size == 0:
+				self._state = self.TRAILER
+			else:
+				self._remaining = size
+				self._state     = self.DATA
+				self._reserve(min(size, self.CHUNK_SIZE))
+		elif self._state == self.DATA_END:
+			if line: raise ChunkedDecoderError("Missing CRLF after chunk data")
+			self._state = self.SIZE
+		elif self._state == self.TRAILER:
+			if not line:
+				self._state = self.DONE
+			else:
+				name, colon, value = line.decode("latin-1").partition(":")
+				if colon: self.trailers.add(name.strip(), value.strip())
+
+	def _reserve( self, size ):
+		"""Ensures the body buffer has room for 'size' more bytes, growing it
+		geometrically so that appends are amortized."""
+		needed = self._length + size
+		if needed > len(self._body):
+			self._body.extend(bytearray(max(needed - len(self._body), len(self._body))))
+		return self._body
+
+	def _write( self, data ):
+		n = len(data)
+		self._reserve(n)
+		self._body[self._length:self._length + n] = data
+		self._length    += n
+		self._remaining -= n
+		if self._remaining == 0: self._state = self.DATA_END
+
+# -----------------------------------------------------------------------------
+#
+# MULTIPART BODY
+#
+# -----------------------------------------------------------------------------
+
+class MultipartBody:
+	"""A 'multipart/form-data' request body that is produced as it is read,
+	so that attached files are never loaded in memory: each file is opened
+	when its part is reached, and read by chunks. The length of the body is
+	known in advance ('len(body)'), from the size of the files.
+
+	The body is read like a file (which is what 'http.client' and curl's
+	'READFUNCTION' expect), and can be rewound with 'seek(0)' to be sent
+	again."""
+
+	CHUNK_SIZE = 64 * 1024
+
+	def __init__( self, boundary=BOUNDARY, encoding="latin-1" ):
+		self.boundary = boundary
+		self.encoding = encoding
+		# The parts are either bytes, or (path, size) couples for files
+		self._parts   = []
+		self._length  = 0
+		self._ended   = False
+		self._index   = 0
+		self._offset  = 0
+		self._file    = None
+
+	def contentType( self ):
+		return "multipart/form-data; boundary=%s" % (self.boundary)
+
+	def addField( self, name, value ):
+		"""Adds a form field with the given value."""
+		self._add(self._header('Content-Disposition: form-data; name="%s"' % (name)))
+		self._add(self._bytes(value) + b"\r\n")
+		return self
+
+	def addContent( self, name, filename, mimetype, value ):
+		"""Adds a file attachment with the given content."""
+		self._add(self._fileHeader(name, filename, mimetype))
+		self._add(self._bytes(value) + b"\r\n")
+		return self
+
+	def addFile( self, name, path, mimetype=None ):
+		"""Adds the file at the given path as an attachment. The file is only
+		read when the body is."""
+		mimetype = mimetype or mimetypes.guess_type(path)[0] or DEFAULT_ATTACH_MIMETYPE
+		self._add(self._fileHeader(name, path, mimetype))
+		self._add((path, os.path.getsize(path)))
+		self._add(b"\r\n")
+		return self
+
+	def parts( self ):
+		"""Returns the parts of the body, which are either bytes, or
+		'(path, size)' couples for the attached files. This allows clients
+		to send the files on their own (see 'defaultclient.HTTPClient')."""
+		return list(self._parts)
+
+	def end( self ):
+		"""Adds the closing boundary, once all the parts were added."""
+		if not self._ended:
+			self._add(self._bytes("--%s--\r\n" % (self.boundary)))
+			self._ended = True
+		return self
+
+	def read( self, size=-1 ):
+		"""Reads at most 'size' bytes of the body, or the rest of the body
+		when size is negative. This returns an empty string once the whole
+		body was read."""
+		if size is None: size = -1
+		chunks = []
+		while size != 0 and self._index < len(self._parts):
+			part = self._parts[self._index]
+			if isinstance(part, bytes):
+				end  = len(part) if size < 0 else min(len(part), self._offset + size)
+				data = part[self._offset:end]
+			else:
+				# The file is read up to the size it had when it was added, so
+				# that the body has the announced length
+				path, length = part
+				if self._file is None: self._file = open(path, "rb")
+				count = length - self._offset if size < 0 else min(size, length - self._offset)
+				data  = self._file.read(count)
+				if len(data) < count:
+					raise IOError("File changed while being sent: %s" % (path))
+			self._offset += len(data)
+			if size > 0: size -= len(data)
+			if data: chunks.append(data)
+			if self._offset >= self._partLength(part): self._next()
+		return b"".join(chunks)
+
+	def iterChunks( self, size=None ):
+		"""Iterates on the (rest of the) body, yielding chunks of at most
+		'size' bytes."""
+		size = size or self.CHUNK_SIZE
+		while True:
+			data = self.read(size)
+			if not data: break
+			yield data
+
+	def seek( self, offset, whence=0 ):
+		"""Rewinds the body. Only 'seek(0)' is supported."""
+		if offset != 0 or whence != 0:
+			raise IOError("MultipartBody can only be rewound")
+		self.close()
+		self._index  = 0
+		self._offset = 0
+		return 0
+
+	def close( self ):
+		"""Closes the file being read (if any)."""
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+	def __len__( self ):
+		return self._length
+
+	def __iter__( self ):
+		return self.iterChunks()
+
+	def _add( self, part ):
+		self._parts.append(part)
+		self._length += self._partLength(part)
+
+	def _next( self ):
+		self.close()
+		self._index += 1
+		self._offset = 0
+
+	def _partLength( self, part ):
+		return len(part) if isinstance(part, bytes) else part[1]
+
+	def _header( self, disposition, *lines ):
+		return self._bytes(CRLF.join(("--" + self.boundary, disposition) + lines + ("", "")))
+
+	def _fileHeader( self, name, filename, mimetype ):
+		return self._header(
+			'Content-Disposition: form-data; name="%s"; filename="%s"' % (name, filename),
+			'Content-Type: %s' % (mimetype),
+			'Content-Transfer-Encoding: binary'
+		)
+
+	def _bytes( self, value ):
+		if value is None: return b""
+		if isinstance(value, (bytes, bytearray, memoryview)): return ensure_bytes(value)
+		return ensure_bytes(value if is_string(value) else str(value), self.encoding)
+
+# -----------------------------------------------------------------------------
+#
+# HTTP CLIENT
+#
+# -----------------------------------------------------------------------------
+
 # NOTE: A useful reference for understanding HTTP is the following website
 # <http://www.jmarshall.com/easy/http>
 class HTTPClient:
@@ -56,6 +805,10 @@ class HTTPClient:
 	in the sense that it aggregates the status resulting from requests and
 	responses."""
 
+	# The requests that can be sent again when it is not known whether the
+	# server processed them
+	IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE")
+
 	def __init__( self, encoding="latin-1" ):
 		"""Creates a new HTTPClient with the given 'encoding' as default
 		encofing ('latin-1' is the default)."""
@@ -69,6 +822,7 @@ class HTTPClient:
 		self._responses  = None
 		self._onLog      = None
 		self._cache      = None
+		self._pool       = None
 		self.verbose     = 0
 		self.encoding    = encoding
 		self.retryDelay  = 0.100
@@ -82,8 +836,15 @@ class HTTPClient:
 			sys.stdout.write(" ".join(map(str,args)))
 
 	def setCache( self, cache ):
-		"""Set a cache"""
-		self._cache = cache
+		"""Sets the 'cache.HTTPCache' used by this client. Other objects (with
+		'get' and 'set' methods) are used as the storage of an 'HTTPCache'."""
+		from wwwclient.cache import HTTPCache
+		self._cache = HTTPCache.Ensure(cache)
+
+	def setPool( self, pool ):
+		"""Sets the pool of keep-alive connections used by this client. Clients
+		that manage their connections on their own can ignore it."""
+		self._pool = pool
 
 	def method( self ):
 		"""Returns the method of the last request by this HTTP client."""
@@ -120,7 +881,8 @@ class HTTPClient:
 
 	def responses( self ):
 		"""Returns the list of responses to the last request. The list is
-		composed of triples (firstline, headers, body)."""
+		composed of 'Response' objects, which can be used as triples
+		(firstline, headers, body)."""
 		return self._responses
 
 	def data( self ):
@@ -130,13 +892,14 @@ class HTTPClient:
 		elif len(self._responses) == 1:
 			return self._responses[0][-1]
 		else:
-			return "".join(r[-1] for r in self._responses)
+			bodies = [r[-1] for r in self._responses if r[-1]]
+			return (b"" if bodies and not isinstance(bodies[0], unicode) else "").join(bodies)
 
 	def dataSize( self ):
 		"""Returns the total size of the responses."""
 		total = 0
 		for r in self._responses:
-			total += len(r)
+			total += len(r[-1] or "")
 		return total
 
 	def info( self, level=1 ):
@@ -153,46 +916,37 @@ class HTTPClient:
 		"""Encodes the given fields and attachments (as given to POST) and
 		returns the request body and content type for sending the encoded
 		data.  This method can be used to bypass Curl own form encoding
-		techniques."""
-		content = []
+		techniques.
+
+		The body is a 'MultipartBody', which reads the attached files only as
+		it is sent."""
 		if not fields and not attach: return "", DEFAULT_MIMETYPE
+		body = MultipartBody(encoding=self.encoding)
 		if fields:
 			for name, value in fields:
-				content.append("--" + BOUNDARY)
-				content.append('Content-Disposition: form-data; name="%s"' % name)
-				content.append('')
-				content.append(self._valueToString(value))
+				body.addField(name, value)
 		if attach:
 			attach = self._ensureAttachment(attach)
 			for name, filename, atype in attach:
-				content.append("--" + BOUNDARY)
 				if atype == FILE_ATTACHMENT:
-					f     = file(filename, 'r')
-					value = f.read()
-					f.close()
-					mime_type = mimetypes.guess_type(filename)[0] or DEFAULT_ATTACH_MIMETYPE
+					body.addFile(name, filename)
 				elif atype == CONTENT_ATTACHMENT:
 					filename, mime_type, value = filename
-				content.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (name, filename))
-				content.append('Content-Type: %s' % (mime_type))
-				content.append('Content-Transfer-Encoding: binary')
-				content.append('')
-				content.append(self._valueToString(value))
-		content.append('--' + BOUNDARY + '--')
-		content.append('')
-		body         = CRLF.join(content)
-		content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
-		return body, content_type
-
-	def GET( self, url, headers=None ):
+					body.addContent(name, filename, mime_type, value)
+		body.end()
+		return body, body.contentType()
+
+	def GET( self, url, headers=None, stream=False ):
 		"""Gets the given URL, setting the given headers (as a list of
-		strings)."""
+		strings). When 'stream' is true, the body of the response is not read:
+		the response has a 'stream' ('BodyStream') instead. Clients that do not
+		support streaming ignore it."""
 		raise Exception("GET method must be implemented by HTTPClient subclasses.")
 
-	def POST( self, url, data=None, mimetype=None, fields=None, attach=None, headers=None ):
+	def POST( self, url, data=None, mimetype=None, fields=None, attach=None, headers=None, stream=False ):
 		"""Posts the given data (as urlencoded string), or fields as list of
 		(name, value) pairs and/or attachments as list of (name, value, type)
-		triples. Headers attributes are the same as for the @GET
+		triples. Headers and stream attributes are the same as for the @GET
 		method.
 
 		The @attach parameter is quite special, as the value will depend on the
@@ -202,6 +956,32 @@ class HTTPClient:
 		"""
 		raise Exception("GET method must be implemented by HTTPClient subclasses.")
 
+	def _encodeSubmit( self, data=None, mimetype=None, fields=None, attach=None, headers=None ):
+		"""Returns the body and the list of headers for submitting the given
+		data, or the given fields and attachments encoded as multipart (see
+		@POST). The 'Content-Type' and 'Content-Length' headers are set
+		accordingly."""
+		# If there is already data given, we check that there is no fields or
+		# attachments
+		if data:
+			assert not fields, "Fields must be empty when data is provided"
+			assert not attach, "No attachment is allowed when data is provided"
+			data = self._valueToPostData(data)
+		# Otherwise we encode the data as multipart
+		if data == None:
+			assert mimetype == None, "Mimetype is ignored when no data is given."
+			attach = self._ensureAttachment(attach)
+			data, mimetype = self.encode(fields, attach)
+		headers = list(headers or ())
+		# In case we have a mimetype, we update the list of headers
+		# appropriately
+		if mimetype:
+			headers = list(filter(lambda x: RE_CONTENT_TYPE.match(x) == None, headers))
+			headers.append("Content-Type: " + mimetype)
+		# We add the Content-Length header to the headers list
+		headers.append("Content-Length: " + self._valueToString(len(data)))
+		return data, headers
+
 	def _ensureAttachment( self, attach ):
 		"""Ensures that the given attachment is a list of attachments. For
 		instance if attach is a single attachment, it will be returned as
@@ -256,8 +1036,8 @@ class HTTPClient:
 	def _parseResponse( self, message):
 		"""Parse the message, and return a list of responses and headers. This
 		might occur when there is a provisional response in between, or when
-		location are followed. The result is a list of (firstline, headers,
-		body), all as unparsed stings."""
+		location are followed. The result is a list of 'Response' objects,
+		which can be used as (firstline, headers, body) triples."""
 		res     = []
 		off     = 0
 		self._newCookies = []
@@ -270,92 +1050,98 @@ class HTTPClient:
 			if eol == -1: break
 			if eoh == -1: eoh = len(message)
 			first_line       = message[off:eol]
-			headers          = message[eol+2:eoh]
-			# FIXME: This is not very efficient, we should parse all headers
-			# into a structure, rahter than searching
-			charset          = RE_CHARSET.search(headers)
-			is_chunked       = RE_CHUNKED.search(headers)
-			content_length   = RE_CONTENT_LENGTH.search(headers)
-			content_encoding = RE_CONTENT_ENCODING.search(headers)
-			content_type     = RE_CONTENT_TYPE.search(headers)
-			if content_encoding:
-				content_encoding = content_encoding.group(1)
-			if content_type:
-				content_type     = content_type.group(1)
-			if charset:
-				encoding   = charset.group(1)
-			else:
-				encoding   = self.encoding
+			raw_headers      = message[eol+2:eoh]
+			# All the headers are parsed in a single pass, the rest of the
+			# processing only looks them up.
+			headers          = Headers.Parse(raw_headers)
+			response         = Response(first_line, raw_headers, body, headers=headers)
+			is_chunked       = "chunked" in (headers.get("Transfer-Encoding") or "").lower()
+			content_length   = headers.get("Content-Length")
+			content_encoding = headers.get("Content-Encoding")
+			encoding         = response.charset(self.encoding)
+			chunked          = False
 			# If there is a content-length specified, we use it
-			if content_length:
-				content_length = int(content_length.group(1))
+			if content_length and content_length.isdigit():
+				content_length = int(content_length)
 				off        = eoh + 4 + content_length
 				body       = self._decodeBody(message[eoh+4:off], content_encoding, encoding)
 			# Otherwise, the transfer type may be chunks
 			elif is_chunked:
-				# FIXME: For the moment, chunks are supposed to be separated by
-				# CRLF + CRLF only (this is what google.com returns)
-				off        = message.find(CRLF + CRLF, eoh + 4)
-				if off == -1: off = len(message)
-				body       = self._decodeBody(message[eoh+4:off], content_encoding, encoding)
+				body, consumed = self._decodeChunked(message[eoh+4:], headers, encoding)
+				chunked    = True
+				off        = eoh + 4 + consumed
+				body       = self._decodeBody(body, content_encoding, encoding)
 			# Otherwise the body is simply what's left after the headers
 			else:
 				if len(message) > eoh+4:
 					body = self._decodeBody(message[eoh+4:], content_encoding, encoding)
 				off = len(message)
-			location, cookies = self._parseStatefulHeaders(headers)
-			# WTF:
-			self._redirect    = location
-			self._newCookies.extend(self._parseCookies(cookies))
 			# FIXME: I don't know if it works properly, but at least it handles
 			# responses from <http://www.contactor.se/~dast/postit.cgi> properly.
 			if first_line and first_line.startswith("HTTP"):
-				res.append([first_line, headers, body])
+				response.body     = body
+				if chunked or (body and ContentDecoder.Create(content_encoding)):
+					response.markDecoded(len(body))
+				self._redirect    = response.location()
+				self._newCookies.extend(response.cookies())
+				res.append(response)
 			# If the first line does not start with HTTP, then this may be
 			# the rest of the body from a previous response
 			else:
 				assert res, "There must be a first line"
 				res[-1][-1] = res[-1][-1] + CRLF + CRLF + first_line
-				if headers: res[-1][-1] = res[-1][-1] + headers
+				if raw_headers: res[-1][-1] = res[-1][-1] + raw_headers
 				if body: res[-1][-1] = res[-1][-1] + body
 		# TODO: It would be good to communicate headers and first_line back
 		self._responses = res
 		return res
 
-	def _decodeBody( self, body, contentEncoding=None, encoding=None ):
-		if contentEncoding:
-			if contentEncoding.lower().strip() == "gzip":
-				try:
-					return zlib.decompress(body)
-				except:
-					path = tempfile.mktemp()
-					with open(path, "wb") as f:
-						f.write(body)
-					result = None
-					with gzip.open(path, "rb") as f:
-						result = f.read()
-					os.unlink(path)
-					return result
-				#if encoding: return body.decode(encoding)
-				#else: return body
-			else:
-				raise Exception("Unsupported content encoding: " + contentEncoding)
+	def _decodeChunked( self, data, headers=None, encoding=None ):
+		"""Decodes the given chunked data, returning the decoded body and the
+		number of characters of 'data' it spanned. The trailers are added to
+		the given headers. Text data is decoded as bytes using the given
+		encoding, and the body is returned as text as well."""
+		is_text  = not isinstance(data, bytes)
+		raw      = data.encode(encoding or self.encoding) if is_text else data
+		decoder  = ChunkedDecoder()
+		consumed = decoder.feed(raw)
+		if headers is not None:
+			for name, value in decoder.trailers:
+				headers.add(name, value)
+		body = decoder.data()
+		if is_text:
+			body     = body.decode(encoding or self.encoding)
+			consumed = len(raw[:consumed].decode(encoding or self.encoding, "ignore"))
 		else:
+			body     = bytes(body)
+		return body, consumed
+
+	def _decodeResponse( self, response, body, chunked=False ):
+		"""Sets the body of the given response to the given (de-chunked) body,
+		decoded according to its 'Content-Encoding', and updates the headers
+		of the response to match the decoded body (see
+		'Response.markDecoded')."""
+		encoding      = response.headers.get("Content-Encoding")
+		response.body = self._decodeBody(body, encoding)
+		if chunked or (body and ContentDecoder.Create(encoding)):
+			response.markDecoded(len(response.body))
+		return response
+
+	def _decodeBody( self, body, contentEncoding=None, encoding=None ):
+		"""Decodes the given body according to its 'Content-Encoding' (see
+		'ContentDecoder')."""
+		decoder = ContentDecoder.Create(contentEncoding)
+		if decoder is None or not body:
 			# FIXME: Should not force encoding, only if it's a string
 			#if encoding: return body.decode(encoding)
 			return body
+		return decoder.decode(body)
 
 	def _parseStatefulHeaders( self, headers ):
 		"""Return the Location and Set-Cookie headers from the given header
-		string."""
-		# We add an extra carriage, because some regexes will expect a carriage
-		# return at the end
-		headers += "\r\n"
-		location    = RE_LOCATION.search(headers)
-		if location: location = location.group(1).strip()
-		cookies    = RE_SET_COOKIE.findall(headers)
-		set_cookie = ";".join(cookies)
-		return location, set_cookie
+		string or 'Headers' instance."""
+		if not isinstance(headers, Headers): headers = Headers.Parse(headers)
+		return headers.get("Location"), ";".join(headers.getAll("Set-Cookie"))
 
 	def _parseCookies( self, cookies ):
 		"""Returns a pair (name, value) for the given cookies, given as text."""
@@ -375,13 +1161,6 @@ class HTTPClient:
 	def _parseHeaders( self, headers ):
 		"""Parses all headers and returns a list of (key, value) representing
 		them."""
-		res = []
-		for header in headers.split("\n"):
-			colon = header.find(":")
-			name  = header[:colon].strip()
-			value = header[colon+1:-1]
-			if not name: continue
-			res.append((name,value))
-		return res
+		return Headers.Parse(headers).items()
 
 # EOF - vim: tw=80 ts=4 sw=4 noet
@@ -19,12 +19,13 @@ def ensure_str_safe ( t, encoding=ENCODING ):
 	return t.encode("utf8", "ignore") if isinstance (t, unicode) else str(t)
 
 def ensure_unicode( t, encoding=ENCODING ):
-	return t if isinstance(t, unicode) else str(t).decode(encoding)
+	return t if isinstance(t, unicode) else ensure_bytes(t).decode(encoding)
 
 def ensure_unicode_safe( t, encoding=ENCODING ):
-	return t if isinstance(t, unicode) else str(t).decode(encoding, "ignore")
+	return t if isinstance(t, unicode) else ensure_bytes(t).decode(encoding, "ignore")
 def ensure_bytes( t, encoding=ENCODING ):
-	return t if isinstance(t, bytes) else bytes(t)
+	if isinstance(t, bytes): return t
+	return t.tobytes() if isinstance(t, memoryview) else bytes(t)
 
 def is_string( t ):
 	return isinstance(t, unicode) or isinstance(t, str)
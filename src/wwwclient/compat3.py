@@ -5,7 +5,8 @@ ENCODING = "UTF-8"
 async def asyncio_await(value):
 	return await value
 
-asyncio_coroutine   = asyncio.coroutine
+# NOTE: 'asyncio.coroutine' was removed in Python 3.11
+asyncio_coroutine   = getattr(asyncio, "coroutine", types.coroutine)
 asyncio_iscoroutine = asyncio.iscoroutine
 
 def asyncio_isgenerator(value):
@@ -27,7 +28,8 @@ def ensure_unicode_safe( t, encoding=ENCODING ):
 	return t if isinstance(t, str) else str(t, encoding, "ignore")
 
 def ensure_bytes( t, encoding=ENCODING ):
-	return t if isinstance(t, bytes) else bytes(t, encoding)
+	if isinstance(t, bytes): return t
+	return bytes(t) if isinstance(t, (bytearray, memoryview)) else bytes(t, encoding)
 
 def is_string( t ):
 	return isinstance(t, str)
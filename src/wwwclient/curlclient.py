@@ -9,10 +9,20 @@
 # Credits   : Xprima.com
 # -----------------------------------------------------------------------------
 # Creation  : 20-Jun-2006
-# Last mod  : 04-Jul-2006
+# Last mod  : 17-Oct-2026
 # -----------------------------------------------------------------------------
 
-import StringIO, urlparse, time, client, pycurl
+import sys, time, socket, collections
+import wwwclient.client as client
+from   wwwclient.compat import ensure_bytes
+import pycurl
+
+if sys.version_info.major < 3:
+	import urlparse
+	import httplib as http_client
+else:
+	import urllib.parse as urlparse
+	import http.client as http_client
 
 # TODO: Find more use cases for chunked mode
 # TODO: Add cookie encode/decode functions
@@ -32,6 +42,7 @@ It features:
  - Custom headers support
  - Custom request modification callback
  - Custom form/data encoding function (when there are troubles with Curl)
+ - Many concurrent transfers driven by a single thread
 
 The basic usage is to instanciate a HTTClient class, and then call GET and POST
 methods on the instance.
@@ -57,110 +68,430 @@ know what kind of value is expected, as headers are expected to be a list of
 strings, and attachements are expected to be of a specific format (details in
 POST).
 
+Requests are sent by a 'CurlEngine', which drives all the transfers of a
+client with a 'pycurl.CurlMulti' and reuses its easy handles, so that the
+connections, DNS lookups and TLS sessions are cached across requests. Many
+requests can be sent at once with 'submit' and 'wait':
+
+--
+	c         = HTTPClient()
+	transfers = [c.submit("GET", url) for url in urls]
+	for transfer in c.wait(transfers):
+		print transfer.url, transfer.responses[-1].status()
+--
+
+Sessions created with this client ('browse.Session(client=HTTPClient)')
+send the requests of 'fetchAll' and 'map' this way, from the calling thread.
 """
 
+# -----------------------------------------------------------------------------
+#
+# ERRORS
+#
+# -----------------------------------------------------------------------------
+
+class CurlError(Exception):
+	"""A curl error, with the libcurl error 'code'."""
+
+	def __init__( self, code, message ):
+		Exception.__init__(self, "curl error %s: %s" % (code, message))
+		self.code = code
+
+def curlError( code, message ):
+	"""Returns the exception for the given libcurl error code. Timeouts and
+	interrupted transfers are given as the same exceptions as the other
+	clients, so that sessions retry them."""
+	if code == pycurl.E_OPERATION_TIMEDOUT:
+		return socket.timeout(message)
+	elif code in (pycurl.E_PARTIAL_FILE, pycurl.E_GOT_NOTHING, pycurl.E_RECV_ERROR):
+		return http_client.IncompleteRead(b"")
+	else:
+		return CurlError(code, message)
+
+# -----------------------------------------------------------------------------
+#
+# TRANSFER
+#
+# -----------------------------------------------------------------------------
+
+class CurlTransfer:
+	"""A request sent by a 'CurlEngine'. Once the transfer is 'done', it
+	has either the list of 'client.Response' as 'responses' (provisional
+	responses excluded), or the exception that made it fail as 'error'.
+
+	The 'callback' is invoked with the transfer once it is done, and the
+	'context' can hold any data the caller needs."""
+
+	def __init__( self, client, method, url, headers=None, body=None, form=None, callback=None, context=None ):
+		self.client    = client
+		self.method    = method
+		self.url       = url
+		self.headers   = list(headers or ())
+		self.body      = body
+		self.form      = form
+		self.callback  = callback
+		self.context   = context
+		self.responses = None
+		self.error     = None
+		self.status    = None
+		self._marks    = []
+		self._buffer   = None
+		self._done     = False
+
+	def prepare( self, curl ):
+		"""Sets the options of the given (reset) easy handle for this
+		transfer."""
+		self._marks  = []
+		self._buffer = bytearray()
+		curl.setopt(pycurl.URL, self.url)
+		curl.setopt(pycurl.FOLLOWLOCATION, 0)
+		curl.setopt(pycurl.NOSIGNAL, 1)
+		curl.setopt(pycurl.CONNECTTIMEOUT, self.client.TIMEOUT)
+		# Transfers stalled for more than the timeout are aborted
+		curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+		curl.setopt(pycurl.LOW_SPEED_TIME, self.client.TIMEOUT)
+		curl.setopt(pycurl.HEADERFUNCTION, self._onHeader)
+		curl.setopt(pycurl.WRITEFUNCTION, self._buffer.extend)
+		# The 'Expect: 100-continue' handshake only delays the requests
+		headers = self.headers + ["Expect:"]
+		curl.setopt(pycurl.HTTPHEADER, headers)
+		if self.method == "HEAD":
+			curl.setopt(pycurl.NOBODY, 1)
+		elif self.form is not None:
+			curl.setopt(pycurl.HTTPPOST, self.form)
+		elif isinstance(self.body, client.MultipartBody):
+			# Multipart bodies are read by curl as they are sent
+			self.body.seek(0)
+			curl.setopt(pycurl.POST, 1)
+			curl.setopt(pycurl.POSTFIELDSIZE_LARGE, len(self.body))
+			curl.setopt(pycurl.READFUNCTION, self.body.read)
+		elif self.body is not None:
+			curl.setopt(pycurl.POST, 1)
+			curl.setopt(pycurl.POSTFIELDS, self.body)
+		if self.method not in ("GET", "HEAD", "POST"):
+			curl.setopt(pycurl.CUSTOMREQUEST, self.method)
+		if self.client.verbose >= 2:
+			curl.setopt(pycurl.VERBOSE, 1)
+		return curl
+
+	def complete( self, curl, error=None ):
+		"""Completes this transfer with the given easy handle, once curl is done
+		with it, or with the given error."""
+		self._done = True
+		if error is None:
+			self.status    = curl.getinfo(pycurl.RESPONSE_CODE)
+			self.url       = curl.getinfo(pycurl.EFFECTIVE_URL)
+			self.responses = self._responses()
+		else:
+			self.error     = error
+		self._buffer = None
+		if isinstance(self.body, client.MultipartBody): self.body.close()
+		if self.callback: self.callback(self)
+		return self
+
+	def done( self ):
+		"""Tells if this transfer is done (successfully or not)."""
+		return self._done
+
+	def result( self ):
+		"""Returns the responses of this transfer, or raises its error."""
+		if self.error is not None: raise self.error
+		return self.responses
+
+	def _onHeader( self, line ):
+		# The headers go to the same buffer as the body, and we record where
+		# each response starts, and where its body starts and ends (trailers
+		# of chunked bodies are given after the body).
+		if line.startswith(b"HTTP/"):
+			self._marks.append([len(self._buffer), None, None])
+		elif self._marks and self._marks[-1][1] is not None and self._marks[-1][2] is None:
+			self._marks[-1][2] = len(self._buffer)
+		self._buffer.extend(line)
+		if self._marks and self._marks[-1][1] is None and not line.strip():
+			self._marks[-1][1] = len(self._buffer)
+
+	def _responses( self ):
+		"""Returns the final response, whose body is a 'memoryview' of the
+		receive buffer (unless it had to be decoded). Provisional responses
+		are skipped."""
+		view = memoryview(self._buffer)
+		for i, (start, body, end) in enumerate(self._marks):
+			last = self._marks[i + 1][0] if i + 1 < len(self._marks) else len(view)
+			if end  is None: end  = last
+			if body is None: body = end
+			head = view[start:body].tobytes().decode("latin-1")
+			first_line, _, headers = head.partition("\n")
+			response = client.Response(first_line.strip(), headers)
+			if not (100 <= (response.status() or 0) < 200) or i == len(self._marks) - 1:
+				break
+		if end < last:
+			# The trailers of a chunked body are added to the headers, as
+			# the default client does
+			trailers = client.Headers.Parse(view[end:last].tobytes().decode("latin-1"))
+			for name, value in trailers.items():
+				response.headers.add(name, value)
+			response.rawHeaders = None
+		# Curl gives chunked bodies already de-chunked
+		chunked = "chunked" in (response.headers.get("Transfer-Encoding") or "").lower()
+		chunked = chunked and (body < end or end < last)
+		if chunked or response.headers.get("Content-Encoding"):
+			self.client._decodeResponse(response, view[body:end], chunked)
+		else:
+			response.body = view[body:end]
+		return [response]
+
+# -----------------------------------------------------------------------------
+#
+# CURL ENGINE
+#
+# -----------------------------------------------------------------------------
+
+class CurlEngine:
+	"""Drives the transfers of a client concurrently, from the thread that
+	calls 'perform' (or 'run'), using a 'pycurl.CurlMulti'. At most
+	'maxTransfers' transfers are in flight, the others are queued.
+
+	Easy handles are kept once their transfer is done and reused for the
+	next ones, and the handles share their DNS and TLS session caches (as
+	well as their connections, when libcurl supports it). An engine must
+	only be used by one thread at a time."""
+
+	MAX_TRANSFERS  = 16
+	MAX_IDLE       = 16
+	SELECT_TIMEOUT = 1.0
+
+	def __init__( self, maxTransfers=None ):
+		self.maxTransfers = maxTransfers or self.MAX_TRANSFERS
+		self._multi       = pycurl.CurlMulti()
+		self._share       = pycurl.CurlShare()
+		self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+		self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+		if hasattr(pycurl, "LOCK_DATA_CONNECT"):
+			self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+		self._idle        = []
+		self._queue       = collections.deque()
+		self._active      = {}
+
+	def submit( self, transfer ):
+		"""Queues the given transfer, which is started by the next call to
+		'perform'."""
+		self._queue.append(transfer)
+		return transfer
+
+	def perform( self, timeout=None ):
+		"""Starts the queued transfers (within the limit), and lets curl work
+		on the transfers in flight until some of them are done, or until the
+		given timeout expires. This returns the list of transfers that were
+		completed."""
+		self._start()
+		if not self._active: return []
+		done = self._perform()
+		if not done:
+			self._multi.select(self.SELECT_TIMEOUT if timeout is None else min(timeout, self.SELECT_TIMEOUT))
+			done = self._perform()
+		return done
+
+	def run( self, transfers=None ):
+		"""Performs the transfers until the given ones (or all of them) are
+		done, and returns the list of completed transfers."""
+		done = []
+		while self._queue or self._active:
+			done.extend(self.perform())
+			if transfers is not None and all(_.done() for _ in transfers): break
+		return done
+
+	def count( self ):
+		"""Returns the number of transfers that are queued or in flight."""
+		return len(self._queue) + len(self._active)
+
+	def cancel( self, transfer ):
+		"""Removes the given transfer (queued or in flight) from this engine,
+		giving its easy handle back for the next transfers. The transfer is
+		not completed."""
+		if transfer in self._queue:
+			self._queue.remove(transfer)
+		for curl, active in list(self._active.items()):
+			if active is transfer:
+				self._multi.remove_handle(curl)
+				del self._active[curl]
+				self._release(curl)
+		return transfer
+
+	def close( self ):
+		"""Closes the easy handles and the multi handle of this engine."""
+		for curl in list(self._active.keys()):
+			self._multi.remove_handle(curl)
+			curl.close()
+		for curl in self._idle:
+			curl.close()
+		self._active = {}
+		self._idle   = []
+		self._multi.close()
+
+	def _start( self ):
+		while self._queue and len(self._active) < self.maxTransfers:
+			transfer = self._queue.popleft()
+			curl     = self._acquire()
+			transfer.prepare(curl)
+			self._active[curl] = transfer
+			self._multi.add_handle(curl)
+
+	def _perform( self ):
+		while True:
+			status, _ = self._multi.perform()
+			if status != pycurl.E_CALL_MULTI_PERFORM: break
+		done = []
+		while True:
+			queued, succeeded, failed = self._multi.info_read()
+			for curl in succeeded:
+				done.append(self._complete(curl))
+			for curl, code, message in failed:
+				done.append(self._complete(curl, curlError(code, message)))
+			if not queued: break
+		return done
+
+	def _complete( self, curl, error=None ):
+		self._multi.remove_handle(curl)
+		transfer = self._active.pop(curl)
+		try:
+			transfer.complete(curl, error)
+		finally:
+			self._release(curl)
+		return transfer
+
+	def _acquire( self ):
+		if self._idle: return self._idle.pop()
+		curl = pycurl.Curl()
+		curl.setopt(pycurl.SHARE, self._share)
+		return curl
+
+	def _release( self, curl ):
+		if len(self._idle) < self.MAX_IDLE:
+			# Resetting the options keeps the caches and the share of the
+			# handle
+			curl.reset()
+			self._idle.append(curl)
+		else:
+			curl.close()
+
+# -----------------------------------------------------------------------------
+#
+# HTTP CLIENT
+#
+# -----------------------------------------------------------------------------
+
 # NOTE: A useful reference for understanding HTTP is the following website
 # <http://www.jmarshall.com/easy/http>
 class HTTPClient(client.HTTPClient):
 	"""Sends and manages HTTP requests using the PyCURL library. Each instance
-	should be used in a single thread (no sharing), because the same Curl
-	instance is kept by all methods."""
+	should be used in a single thread (no sharing), as its 'CurlEngine' is
+	driven by the thread that sends the requests.
 
-	def __init__( self, encoding="latin-1" ):
+	Besides the 'GET', 'HEAD' and 'POST' methods, which send one request and
+	return its responses, 'submit' queues a request that is sent along with
+	the other requests, once 'perform' or 'wait' are called."""
+
+	TIMEOUT = 10
+
+	def __init__( self, encoding="latin-1", engine=None ):
 		client.HTTPClient.__init__(self, encoding)
-		self._curl       = None
-		self._buffer     = None
+		self._engine = engine or CurlEngine()
+
+	def engine( self ):
+		"""Returns the 'CurlEngine' that sends the requests of this client."""
+		return self._engine
+
+	def GET( self, url, headers=None, stream=False ):
+		"""Gets the given URL, setting the given headers (as a list of
+		strings), and returns the list of responses. Responses are not
+		streamed by this client: 'stream' is ignored and the body is always
+		read."""
+		return self._perform(self.submit("GET", url, headers))
 
-	def GET( self, url, headers=None ):
-		"""Gets the given URL, setting the given headers (as a list of strings),
-		and optionnaly following redirects (false by default)."""
-		r, s = self._prepareRequest( url, headers )
-		self._performRequest()
-		return self.data()
+	def HEAD( self, url, headers=None, stream=False ):
+		return self._perform(self.submit("HEAD", url, headers))
 
 	def POST( self, url, data=None, mimetype=None, fields=None, attach=None,
-	headers=None, curlEncode=False ):
+	headers=None, stream=False, curlEncode=False ):
 		"""Posts the given data (as urlencoded string), or fields as list of
 		(name, value) pairs and/or attachments as list of (name, value, type)
 		triples. Headers attributes are the same as for the @GET
 		method.
-		
+
 		The @attach parameter is quite special, as the value will depend on the
 		type: if type is @FILE_ATTACHMENT, then value is simply the path to the
 		file, but if the type is @CONTENT_ATTACHMENT, the value is expected to
 		be a triple (filename, mimetype, value).
 		"""
-		# If there is data, we expect it to be already encoded
-		if data != None:
-			assert not fields, "Fields must be empty when data is provided"
-			assert not attach, "No attachment is allowed when data is provided"
-			if not headers: headers = []
-			headers = list(headers)
-			if mimetype: headers.append("Content-Type: " + mimetype)
-			r, s = self._prepareRequest( url, headers )
-			r.setopt(pycurl.POST, 1)
-			r.setopt(pycurl.POSTFIELDS, data)
-		# If there is no data, we let Curl encode the given fields and
-		# attachments
-		# TODO: Try to see how to succeed with file given by content using Curl
-		elif curlEncode:
-			assert mimetype == None, "Mimetype is ignored when no data is given."
-			post_data = self.curlEncode(fields, attach)
-			r, s = self._prepareRequest( url, headers )
-			r.setopt(pycurl.POST, 1)
-			r.setopt(pycurl.HTTPPOST, post_data)
-		else:
-			assert mimetype == None, "Mimetype is ignored when no data is given."
-			data, mime_type = self.encode(fields, attach)
-			if not headers: headers = []
-			headers = list(headers)
-			headers.append("Content-Type: " + mime_type)
-			r, s = self._prepareRequest( url, headers )
-			r.setopt(pycurl.POST, 1)
-			r.setopt(pycurl.POSTFIELDS, data)
-		# PyCurl offers three ways to do a POST
-		# If there is data, we attach it
-		# Now we can perform the request
-		self._performRequest()
-		return self.data()
-	
-	def _prepareRequest( self, url, headers = None ):
-		"""Returns a pair (request, stringio) corresponding to an HTTP request
-		to the given url with the given headers (as a list of strings)"""
-		assert self._curl == None, "Only one request is allowed per instance"
-		c = self._curl = pycurl.Curl()
-		s = self._buffer = StringIO.StringIO()
-		c.setopt(c.URL, self._absoluteURL(url))
-		c.setopt(pycurl.FOLLOWLOCATION, 0)
-		c.setopt(pycurl.HEADER, 1)
-		c.setopt(pycurl.WRITEFUNCTION, s.write)
-		if headers:
-			if type(headers) == tuple: headers = list(headers)
-			c.setopt(c.HTTPHEADER, headers)
-		return (c, s)
-
-	def _performRequest( self, counter=0 ):
-		"""Performs the current HTTP request."""
-		r = self._curl
-		if self.verbose >= 2: self._curl.setopt(self._curl.VERBOSE, 1)
-		r.perform()
-		try:
-			#r.perform()
-			pass
-		except Exception, e:
-			if counter == self.retryCount:
-				raise e
+		return self._perform(self.submit("POST", url, headers, data, mimetype, fields, attach, curlEncode=curlEncode))
+
+	def submit( self, method, url, headers=None, data=None, mimetype=None, fields=None, attach=None, callback=None, context=None, curlEncode=False ):
+		"""Queues a request (with the same parameters as 'GET' and 'POST'),
+		and returns its 'CurlTransfer'. The request is sent by the next calls
+		to 'perform' or 'wait'."""
+		form = None
+		body = None
+		if method == "POST":
+			# PyCurl offers three ways to do a POST: we either send the given
+			# data or the fields and attachments encoded by us, or we let Curl
+			# encode the fields and attachments
+			# TODO: Try to see how to succeed with file given by content using Curl
+			if curlEncode and data is None:
+				assert mimetype == None, "Mimetype is ignored when no data is given."
+				form = self.curlEncode(fields, attach)
 			else:
-				time.sleep(self.retryDelay)
-				self._performRequest( counter + 1)
-				return
-		self._status = r.getinfo(pycurl.HTTP_CODE)
-		self._url    = r.getinfo(pycurl.EFFECTIVE_URL)
-		self._protocol, self._host, _, _, _, _ = urlparse.urlparse(self._url)
-		self._parseResponse(self._buffer.getvalue())
-		self._curl.close()
-		self._curl = None
-		if self.verbose >= 1: print self.info(), "\n"
+				body, headers = self._encodeSubmit(data, mimetype, fields, attach, headers)
+				if not isinstance(body, client.MultipartBody): body = ensure_bytes(body, self.encoding)
+		transfer = CurlTransfer(self, method, self._absoluteURL(url), headers, body, form, callback, context)
+		return self._engine.submit(transfer)
+
+	def perform( self, timeout=None ):
+		"""Sends the queued requests and receives the responses, until some
+		transfers are done or the timeout expires. This returns the list of
+		transfers that are done (see 'CurlEngine.perform')."""
+		return [self._finaliseTransfer(_) for _ in self._engine.perform(timeout)]
+
+	def wait( self, transfers=None ):
+		"""Sends the queued requests and receives the responses until the
+		given transfers (or all of them) are done, and returns the given
+		transfers."""
+		done = [self._finaliseTransfer(_) for _ in self._engine.run(transfers)]
+		return done if transfers is None else transfers
+
+	def cancel( self, transfers ):
+		"""Cancels the given transfers, which are not done yet (see
+		'CurlEngine.cancel')."""
+		for transfer in transfers:
+			self._engine.cancel(transfer)
+		return transfers
+
+	def deferred( self ):
+		"""Returns a view of this client whose 'GET', 'HEAD' and 'POST' methods
+		queue the requests and return their 'CurlTransfer' (see 'submit')."""
+		return DeferredClient(self)
+
+	def close( self ):
+		self._engine.close()
+
+	def _perform( self, transfer ):
+		self._engine.run([transfer])
+		self._finaliseTransfer(transfer)
+		return transfer.result()
+
+	def _finaliseTransfer( self, transfer ):
+		"""Updates the state of this client with the given transfer, once it
+		is done."""
+		if transfer.responses:
+			response         = transfer.responses[-1]
+			self._method     = transfer.method
+			self._url        = transfer.url
+			self._status     = str(response.status())
+			self._redirect   = response.location()
+			self._newCookies = response.cookies()
+			self._responses  = transfer.responses
+			self._protocol, self._host, _, _, _, _ = urlparse.urlparse(self._url)
+			if self.verbose >= 1: self._log(self.info(), "\n")
+		return transfer
 
 	def curlEncode(self, fields=(), attach=()):
 		"""This is an alternative implementation of the encoder using the Curl
@@ -188,4 +519,24 @@ class HTTPClient(client.HTTPClient):
 					raise Exception("Unknown attachment type: %s" % (atype))
 		return field_data
 
+class DeferredClient:
+	"""A view of an 'HTTPClient' whose request methods return the queued
+	'CurlTransfer' instead of the responses. This is what sessions use to
+	send many transactions at once."""
+
+	def __init__( self, client ):
+		self.client = client
+
+	def GET( self, url, headers=None, stream=False ):
+		return self.client.submit("GET", url, headers)
+
+	def HEAD( self, url, headers=None, stream=False ):
+		return self.client.submit("HEAD", url, headers)
+
+	def POST( self, url, data=None, mimetype=None, fields=None, attach=None, headers=None, stream=False ):
+		return self.client.submit("POST", url, headers, data, mimetype, fields, attach)
+
+	def __getattr__( self, name ):
+		return getattr(self.client, name)
+
 # EOF - vim: tw=80 ts=4 sw=4 noet
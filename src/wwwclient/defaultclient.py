@@ -12,90 +12,205 @@
 # Last mod  : 08-Mar-2013
 # -----------------------------------------------------------------------------
 
-import sys, logging
+import sys, time, select, socket, logging, threading
 import wwwclient.client as client
 
 if sys.version_info.major < 3:
 	import urlparse as urlparse
 	import httplib as http_client
+	ConnectionError = socket.error
 else:
 	import urllib.parse as urlparse
 	import http.client as http_client
 
-# TODO: Add retry support
+DEFAULT_PORTS = {"http":80, "https":443}
+
+# -----------------------------------------------------------------------------
+#
+# CONNECTION POOL
+#
+# -----------------------------------------------------------------------------
+
+class ConnectionPool:
+	"""Keeps the idle (keep-alive) connections opened by 'HTTPClient' instances,
+	indexed by '(scheme, host, port)', so that subsequent requests to the same
+	server do not need a new TCP (and TLS) handshake.
+
+	The pool is owned by a 'browse.Session' and can be shared by the clients of
+	that session: it is thread-safe. At most 'maxIdle' idle connections are
+	kept (the least recently used are closed first), and connections that
+	were idle for more than 'idleTimeout' seconds, or that were closed by the
+	server, are evicted instead of being reused."""
+
+	MAX_IDLE     = 10
+	IDLE_TIMEOUT = 30
+
+	def __init__( self, maxIdle=None, idleTimeout=None ):
+		self.maxIdle     = self.MAX_IDLE     if maxIdle     is None else maxIdle
+		self.idleTimeout = self.IDLE_TIMEOUT if idleTimeout is None else idleTimeout
+		# A list of (key, connection, released timestamp), from the least
+		# recently to the most recently released.
+		self._idle       = []
+		self._lock       = threading.Lock()
+
+	@staticmethod
+	def Key( scheme, host ):
+		"""Returns the '(scheme, host, port)' key for the given scheme and
+		host, where host can be given as 'host:port'."""
+		scheme = scheme.lower()
+		host   = host.lower()
+		port   = DEFAULT_PORTS.get(scheme)
+		i      = host.rfind(":")
+		if i != -1 and host.find("]", i) == -1:
+			port = int(host[i+1:] or port)
+			host = host[:i]
+		return (scheme, host, port)
+
+	def acquire( self, key ):
+		"""Returns an idle connection for the given key, or 'None' if there is
+		no usable connection available."""
+		now   = time.time()
+		stale = []
+		found = None
+		with self._lock:
+			for i in range(len(self._idle)-1, -1, -1):
+				k, connection, released = self._idle[i]
+				if now - released > self.idleTimeout:
+					stale.append(connection)
+					del self._idle[i]
+				elif k == key and found is None:
+					found = connection
+					del self._idle[i]
+		for connection in stale:
+			connection.close()
+		if found is not None and not self.isAlive(found):
+			found.close()
+			found = None
+		return found
+
+	def release( self, key, connection ):
+		"""Gives back the given connection to the pool, so that it can be
+		reused for the given key."""
+		if self.maxIdle <= 0 or connection.sock is None:
+			connection.close()
+			return
+		evicted = []
+		with self._lock:
+			self._idle.append((key, connection, time.time()))
+			while len(self._idle) > self.maxIdle:
+				evicted.append(self._idle.pop(0)[1])
+		for connection in evicted:
+			connection.close()
+
+	def isAlive( self, connection ):
+		"""Tells if the given idle connection can still be used. An idle HTTP
+		connection should have nothing to read: if its socket is readable, the
+		server either closed it or sent unexpected data."""
+		sock = connection.sock
+		if sock is None: return False
+		try:
+			readable, _, _ = select.select([sock], [], [], 0)
+		except (ValueError, socket.error):
+			return False
+		return not readable
+
+	def close( self ):
+		"""Closes all the idle connections."""
+		with self._lock:
+			idle       = self._idle
+			self._idle = []
+		for _, connection, _ in idle:
+			connection.close()
+
+	def size( self ):
+		"""Returns the number of idle connections in this pool."""
+		return len(self._idle)
+
+# -----------------------------------------------------------------------------
+#
+# HTTP CLIENT
+#
+# -----------------------------------------------------------------------------
+
 class HTTPClient(client.HTTPClient):
 	"""Sends and manages HTTP requests using the 'http.client' and 'urllib.parse'
 	modules. Using the 'curlclient' may be more efficient than using this one."""
 
 	TIMEOUT = 10
 
+	# Files attached to requests over plain HTTP are sent with 'sendfile'
+	SENDFILE   = True
+	CHUNK_SIZE = client.MultipartBody.CHUNK_SIZE
+
+	# These are raised when the server closed a kept-alive connection before
+	# we sent the request (or before it answered).
+	STALE_CONNECTION_ERRORS = (http_client.BadStatusLine, http_client.CannotSendRequest, ConnectionError)
+
 	def __init__( self, encoding="utf-8" ):
 		client.HTTPClient.__init__(self, encoding)
 		self._encoding = encoding
-		self._http = None
+		self._http     = None
+		self._httpKey  = None
+		self._reused   = False
+		self._pending  = None
 
-	def GET  ( self, url, headers=None ):
-		return self._request(url, headers, "GET")
+	def GET  ( self, url, headers=None, stream=False ):
+		return self._request(url, headers, "GET", stream)
 
-	def HEAD ( self, url, headers=None ):
-		return self._request(url, headers, "HEAD")
+	def HEAD ( self, url, headers=None, stream=False ):
+		return self._request(url, headers, "HEAD", stream)
 
-	def INFO ( self, url, headers=None ):
-		return self._request(url, headers, "INFO")
+	def INFO ( self, url, headers=None, stream=False ):
+		return self._request(url, headers, "INFO", stream)
 
-	def POST ( self, url, data=None, mimetype=None, fields=None, attach=None, headers=None):
-		return self._submit(url,data,mimetype,fields,attach,headers,"POST")
+	def POST ( self, url, data=None, mimetype=None, fields=None, attach=None, headers=None, stream=False):
+		return self._submit(url,data,mimetype,fields,attach,headers,"POST",stream)
 
-	def UPDATE ( self, url, data=None, mimetype=None, fields=None, attach=None, headers=None):
-		return self._submit(url,data,mimetype,fields,attach,headers,"UPDATE")
+	def UPDATE ( self, url, data=None, mimetype=None, fields=None, attach=None, headers=None, stream=False):
+		return self._submit(url,data,mimetype,fields,attach,headers,"UPDATE",stream)
 
-	def _request( self, url, headers=None, method="GET" ):
+	def _request( self, url, headers=None, method="GET", stream=False ):
 		"""Gets the given URL, setting the given headers (as a list of
 		strings)."""
 		# We prepare the request
 		response   = None
+		entry      = None
 		if headers == None: headers = ()
+		# Streamed responses bypass the cache
+		if stream:
+			self._prepareRequest(method=method, url=url, headers=headers)
+			return self._finaliseStream(url, method)
 		was_cached = False
-		if self._cache:
-			response  = self._cache.get(url)
-			was_cache = True
+		cache      = self._cache
+		if cache:
+			entry = cache.get(method, self._absoluteURL(url), headers)
+			if entry and cache.isFresh(entry, headers):
+				response   = entry.response(method)
+				was_cached = True
 		if not response:
-			self._prepareRequest(method=method, url=url, headers=headers)
+			request_time = time.time()
+			self._prepareRequest(method=method, url=url, headers=cache.validate(entry, headers) if entry else headers)
 			# And get the response
 			response = self._performRequest()
-			if self._cache:
-				self._cache.set(url, response)
-		return self._finaliseRequest(response, url, method)
+			if cache:
+				response = cache.store(method, self._absoluteURL(url), headers, response, entry, request_time)
 		result   = self._finaliseRequest(response, url, method)
 		if self.verbose >= 1 and not was_cached: self._log(self.info())
 		return result
 
-	def _submit( self, url, data=None, mimetype=None, fields=None, attach=None, headers=None, method="POST" ):
-		# If there is already data given, we check that there is no fields or
-		# attachments
-		if data:
-			assert not fields, "Fields must be empty when data is provided"
-			assert not attach, "No attachment is allowed when data is provided"
-			data = self._valueToPostData(data)
-		# Otherwise we encode the data as multipart
-		if data == None:
-			assert mimetype == None, "Mimetype is ignored when no data is given."
-			attach = self._ensureAttachment(attach)
-			data, mimetype = self.encode(fields, attach)
-		# In case we have a mimetype, we update the list of headers
-		# appropriately
-		if mimetype:
-			if headers == None: headers = []
-			headers = list(filter(lambda x: client.RE_CONTENT_TYPE.match(x) == None, headers))
-			headers.append("Content-Type: " + mimetype)
-		# We add the Content-Length header to the headers list
-		headers.append("Content-Length: " + self._valueToString(len(data)))
+	def _submit( self, url, data=None, mimetype=None, fields=None, attach=None, headers=None, method="POST", stream=False ):
+		data, headers = self._encodeSubmit(data, mimetype, fields, attach, headers)
 		# We prepare the request
 		self._prepareRequest(method=method, url=url, headers=headers, body=data)
-		# And get the response
-		response = self._performRequest()
-		result   = self._finaliseRequest(response, url, method)
-		if self.verbose >= 1: self._log(self.info())
+		if stream:
+			result = self._finaliseStream(url, method)
+		else:
+			# And get the response
+			response = self._performRequest()
+			result   = self._finaliseRequest(response, url, method)
+			if self.verbose >= 1: self._log(self.info())
+		# Unsafe requests invalidate the cached response for the URL
+		if self._cache: self._cache.store(method, self._url, headers, result[-1])
 		return result
 
 	def _prepareRequest( self, url, headers=(), body=None, method="GET" ):
@@ -112,53 +227,193 @@ class HTTPClient(client.HTTPClient):
 		if i == -1:
 			raise Exception("URL does not correspond to current host (%s): %s " % (host, url))
 		url_path = url[i+len(host):]
-		if url_parsed[0] == "http":
-			self._http = http_client.HTTPConnection(host, timeout=self.TIMEOUT)
-		elif url_parsed[0] == "https":
-			self._http = http_client.HTTPSConnection(host, timeout=self.TIMEOUT)
-		else:
+		if url_parsed[0] not in DEFAULT_PORTS:
 			raise Exception("Protocol not supported: {0}".format(url_parsed[0]))
 		http_headers = {}
 		for header in headers:
 			colon = header.find(":")
 			http_headers[header[:colon].strip()] = header[colon+1:]
-		#print "=---------------------------------------"
-		#print host
-		#print method, url_path
-		#print headers
-		#print body
-		#print "=---------------------------------------"
-		request  = self._http.request(method, url_path, body, http_headers)
-		return request
+		self._httpKey = ConnectionPool.Key(url_parsed[0], host)
+		self._pending = (method, url_path, body, http_headers)
+		self._openConnection()
+		try:
+			return self._sendRequest()
+		except self.STALE_CONNECTION_ERRORS as e:
+			# The server may have closed the reused connection in the meantime,
+			# so we retry once with a fresh connection. The request could not
+			# be sent, so this is safe for any method.
+			if not self._reused: raise e
+			self._reopenConnection()
+			return self._sendRequest()
+
+	def _openConnection( self, reuse=True ):
+		"""Opens the connection for the current request, reusing an idle one
+		from the pool when possible."""
+		scheme, host, port = self._httpKey
+		self._http   = self._pool.acquire(self._httpKey) if (reuse and self._pool is not None) else None
+		self._reused = self._http is not None
+		if self._http: return self._http
+		if scheme == "http":
+			self._http = http_client.HTTPConnection(host, port, timeout=self.TIMEOUT)
+		else:
+			self._http = http_client.HTTPSConnection(host, port, timeout=self.TIMEOUT)
+		return self._http
+
+	def _reopenConnection( self ):
+		self._http.close()
+		self._http = None
+		return self._openConnection(reuse=False)
+
+	def _sendRequest( self ):
+		method, url_path, body, http_headers = self._pending
+		if isinstance(body, client.MultipartBody):
+			return self._sendMultipart(method, url_path, body, http_headers)
+		return self._http.request(method, url_path, body, http_headers)
+
+	def _sendMultipart( self, method, url_path, body, http_headers ):
+		"""Sends a request with the given 'client.MultipartBody'. The part
+		headers are sent as they are, while the attached files go straight
+		from the file to the socket (see '_sendFile')."""
+		names = [_.lower() for _ in http_headers]
+		self._http.putrequest(method, url_path,
+			skip_host="host" in names, skip_accept_encoding="accept-encoding" in names)
+		for name, value in http_headers.items():
+			self._http.putheader(name, value)
+		self._http.endheaders()
+		for part in body.parts():
+			if isinstance(part, bytes):
+				self._http.send(part)
+			else:
+				self._sendFile(*part)
+
+	def _sendFile( self, path, size ):
+		"""Sends the first 'size' bytes of the file at the given path. Over
+		plain HTTP, the kernel copies the file to the socket ('sendfile'),
+		otherwise (TLS) the file is sent by chunks."""
+		sock = self._http.sock
+		sent = 0
+		with open(path, "rb") as f:
+			if self.SENDFILE and hasattr(sock, "sendfile") and not isinstance(self._http, http_client.HTTPSConnection):
+				sent = sock.sendfile(f, 0, size) if size else 0
+			else:
+				while sent < size:
+					data = f.read(min(self.CHUNK_SIZE, size - sent))
+					if not data: break
+					self._http.send(data)
+					sent += len(data)
+		if sent < size:
+			raise IOError("File changed while being sent: %s" % (path))
+		return sent
+
+	def _getResponse( self ):
+		"""Returns the response for the pending request, transparently resending
+		the request over a new connection when a reused connection turns out
+		to have been closed by the server. The request was sent at this point,
+		so only idempotent requests are sent again."""
+		try:
+			return self._http.getresponse()
+		except self.STALE_CONNECTION_ERRORS as e:
+			if not self._canResend(): raise e
+			self._reopenConnection()
+			self._sendRequest()
+			return self._http.getresponse()
+
+	def _canResend( self ):
+		"""Tells if the pending request can be sent again over a new
+		connection, after its reused connection failed."""
+		return self._reused and self._pending[0] in self.IDEMPOTENT_METHODS
 
 	def _performRequest( self, counter=0 ):
+		"""Returns the 'client.Response' to the current request. The status and
+		headers are taken as parsed by 'http.client', and the body is kept as
+		raw bytes (only its transfer and content encodings are decoded)."""
 		try:
-			response = self._http.getresponse()
-				# TODO: Should use the response encoding
-			body_raw = response.read()
-			body     = body_raw.decode()
-			res  = "HTTP/{version} {status} {reason}\r\n{msg}\r\n{body}".format(
-				version = "1.0" if response.version == 10 else "1.1",
-				status = response.status,
-				reason = response.reason,
-				msg    = response.msg,
-				body   = body
-			)
+			response = self._getResponse()
+			headers  = client.Headers(response.msg.items())
+			# Responses without a body (like 'HEAD' ones) have a zero length,
+			# even when they are chunked
+			chunked  = response.chunked and response.length != 0
+			if chunked:
+				# We decode chunked bodies straight from the socket (this also
+				# gives us the trailers that 'http.client' discards).
+				decoder  = client.ChunkedDecoder()
+				body     = bytes(decoder.readFrom(response.fp))
+				response.close()
+				for name, value in decoder.trailers:
+					headers.add(name, value)
+			else:
+				body     = response.read()
+			self._releaseConnection(response)
+		except Exception as e:
 			self._closeConnection()
-			return res
+			raise e
+		result = client.Response(self._firstLine(response), body=None, headers=headers)
+		return self._decodeResponse(result, body, chunked)
+
+	def _finaliseStream( self, url, method ):
+		"""Returns the list with the single 'client.Response' to the current
+		request, whose body is left unread: the response 'stream' reads it
+		from the connection, which is detached from this client and given
+		back to the pool once the body was read completely."""
+		try:
+			response = self._getResponse()
 		except Exception as e:
 			self._closeConnection()
 			raise e
+		connection, key = self._http, self._httpKey
+		pool            = self._pool
+		self._http      = None
+		def on_close( complete ):
+			if complete and pool is not None and not response.will_close:
+				pool.release(key, connection)
+			else:
+				connection.close()
+		headers = client.Headers(response.msg.items())
+		decoder = client.ContentDecoder.Create(headers.get("Content-Encoding"))
+		result  = client.Response(
+			self._firstLine(response),
+			body    = None,
+			headers = headers,
+			stream  = client.BodyStream(response, on_close, decoder)
+		)
+		if response.length != 0 and (response.chunked or decoder):
+			# The length of the decoded body is only known once it is read
+			result.markDecoded()
+		res = self._finaliseRequest(result, url, method)
+		if self.verbose >= 1: self._log(self.info())
+		return res
 
 	def _finaliseRequest( self, response, url, method ):
+		"""Updates the state of this client with the given response, which is
+		either a 'client.Response' or, for compatibility (cached responses),
+		a complete HTTP response message as a string."""
 		self._url    = self._absoluteURL(url)
 		self._method = method
-		self._status = response.split()[1]
-		res          = self._parseResponse(response)
+		if isinstance(response, client.Response):
+			self._status     = str(response.status())
+			self._redirect   = response.location()
+			self._newCookies = response.cookies()
+			self._responses  = res = [response]
+		else:
+			self._status = response.split()[1]
+			res          = self._parseResponse(response)
 		self._protocol, self._host, _, _, _, _ = urlparse.urlparse(self._url)
 		self._closeConnection()
 		return res
 
+	def _firstLine( self, response ):
+		"""Returns the status line of the given 'http.client' response."""
+		return "HTTP/{0} {1} {2}".format("1.0" if response.version == 10 else "1.1", response.status, response.reason)
+
+	def _releaseConnection( self, response ):
+		"""Gives the current connection back to the pool if the (fully read)
+		response allows it to be kept alive, otherwise closes it."""
+		if self._http and self._pool is not None and not response.will_close:
+			self._pool.release(self._httpKey, self._http)
+			self._http = None
+		else:
+			self._closeConnection()
+
 	def _closeConnection( self ):
 		if self._http:
 			self._http.close()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Encoding: utf8
+# -----------------------------------------------------------------------------
+# Project   : WWWClient
+# -----------------------------------------------------------------------------
+# Author    : Sebastien Pierre                               <sebastien@ivy.fr>
+# -----------------------------------------------------------------------------
+# License   : GNU Lesser General Public License
+# Credits   : Xprima.com
+# -----------------------------------------------------------------------------
+# Creation  : 17-Oct-2026
+# Last mod  : 17-Oct-2026
+# -----------------------------------------------------------------------------
+
+import sys, time, random, threading, email.utils
+
+if sys.version_info.major < 3:
+	import urlparse
+else:
+	import urllib.parse as urlparse
+
+__doc__ = """\
+The 'scheduler' module decides *when* requests can be sent to a host, so that
+a session stays polite to each origin without slowing down requests to the
+other origins.
+
+A 'Scheduler' keeps, for each host, the time at which the next request can be
+sent. Requests are spaced by the scheduler 'delay' (a number of seconds, or a
+'(min, max)' range from which each interval is randomly picked), with up to
+'burst' requests allowed at once. When a server answers '429' or '503' with a
+'Retry-After' header, the host is put on hold for the given time.
+
+--
+	scheduler = Scheduler(delay=(1.0, 2.0))
+	session   = browse.Session(scheduler=scheduler)
+--
+
+Schedulers are thread-safe, and can be shared by several sessions (and by
+the workers of 'Session.fetchAll'). The 'reserve' method returns the time to
+wait before sending a request, and does not block, so that it can be used
+with 'asyncio' as well.
+"""
+
+# -----------------------------------------------------------------------------
+#
+# SCHEDULER
+#
+# -----------------------------------------------------------------------------
+
+class Scheduler:
+	"""Spaces the requests sent to each host, using one token bucket per host
+	(implemented as the theoretical arrival time of the next request)."""
+
+	RETRY_STATUS    = (429, 503)
+	MAX_RETRY_AFTER = 120
+
+	def __init__( self, delay=None, burst=1 ):
+		if delay is None:
+			delay = (0, 0)
+		elif type(delay) in (int, float):
+			delay = (delay, delay)
+		self.delay   = tuple(delay)
+		self.burst   = max(1, burst)
+		# Maps each host to the time at which its bucket is full again
+		self._next   = {}
+		self._lock   = threading.Lock()
+
+	@staticmethod
+	def Host( url ):
+		"""Returns the host (as 'host:port', lowercase) for the given URL."""
+		return urlparse.urlparse(url)[1].lower()
+
+	@staticmethod
+	def RetryAfter( value ):
+		"""Returns the number of seconds to wait for the given 'Retry-After'
+		header value (a number of seconds or an HTTP date), or 'None' if it
+		cannot be parsed."""
+		if value is None: return None
+		value = value.strip()
+		if value.isdigit(): return int(value)
+		date = email.utils.parsedate_tz(value)
+		if date is None: return None
+		return max(0, email.utils.mktime_tz(date) - time.time())
+
+	def interval( self ):
+		"""Returns the interval to leave before the next request."""
+		return random.uniform(*self.delay) if self.delay[1] else 0
+
+	def reserve( self, host ):
+		"""Reserves a slot for a request to the given host, and returns the
+		number of seconds to wait before sending it. Requests to other hosts
+		are not affected."""
+		now = time.time()
+		with self._lock:
+			interval = self.interval()
+			tat      = max(self._next.get(host, now), now)
+			# The bucket allows 'burst' requests within 'burst' intervals
+			wait     = max(0, tat - (self.burst - 1) * interval - now)
+			self._next[host] = tat + interval
+			self._cleanup(now)
+		return wait
+
+	def wait( self, host ):
+		"""Blocks the current thread until a request can be sent to the given
+		host."""
+		delay = self.reserve(host)
+		if delay > 0: time.sleep(delay)
+		return delay
+
+	def backoff( self, host, seconds ):
+		"""Puts the given host on hold for the given number of seconds."""
+		with self._lock:
+			self._next[host] = max(self._next.get(host, 0), time.time() + seconds)
+		return self
+
+	def update( self, host, response ):
+		"""Updates the schedule of the given host with the given
+		'client.Response'. This returns the number of seconds the host was put
+		on hold for when the response has a 'Retry-After' header and a '429'
+		or '503' status, 'None' otherwise."""
+		if response is None or response.status() not in self.RETRY_STATUS: return None
+		seconds = self.RetryAfter(response.headers.get("Retry-After"))
+		if seconds is None: return None
+		self.backoff(host, seconds)
+		return seconds
+
+	def _cleanup( self, now ):
+		# Hosts whose bucket is full again do not need to be kept
+		if len(self._next) > 1000:
+			for host in [h for h, t in self._next.items() if t < now]:
+				del self._next[host]
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
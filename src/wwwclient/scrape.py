@@ -16,9 +16,8 @@
 # would allow to have still one structure. Ideally, the original HTML could be
 # kept to allow easy subset extraction (currently, the data is recreated)
 
-# FIXME: This does not support CDATA and PI nodes
-
-import re, string, sys
+import re, string, sys, codecs, weakref
+from   array import array
 import wwwclient.form
 import wwwclient.browse
 
@@ -28,6 +27,7 @@ else:
 	import html
 	html_entities = html.entities
 	unicode       = str
+	intern        = sys.intern
 
 __doc__ = """\
 The scraping module gives a set of functionalities to manipulate HTML data. All
@@ -36,8 +36,24 @@ document. This is very useful, as it does not require the HTML to be
 well-formed, and allows easy selection of HTML fragments."""
 
 RE_SPACES    = re.compile("\s+")
-RE_HTMLSTART = re.compile("</?((\w+[\d\w_\-]*:)?[\d\w_\-]+)",      re.I)
-RE_HTMLEND   = re.compile("/?>")
+# Matches the next markup token: a comment, a CDATA section, a declaration
+# (like doctype), a processing instruction, or an element tag. Tags whose
+# attributes have unbalanced quotes are matched by the 'loose' alternative.
+RE_TOKEN     = re.compile(
+	"<(?:"
+	"(?P<comment>!--.*?(?:-->|\\Z))"
+	"|(?P<cdata>!\[CDATA\[.*?(?:\]\]>|\\Z))"
+	"|(?P<declaration>![^>]*>?|\?.*?(?:\?>|\\Z))"
+	"|(?P<close>/)?(?P<name>(?:\w+[\d\w_\-]*:)?[\d\w_\-]+)"
+	"(?:(?P<attributes>[^>\"']*(?:(?:\"[^\"]*\"|'[^']*')[^>\"']*)*)"
+	"|(?P<loose>[^>]*))>"
+	")",
+	re.S
+)
+# Matches attributes whose quotes are balanced, and the start of the
+# attributes of a tag (whose last quote may not be closed yet)
+RE_QUOTES    = re.compile("[^\"']*(?:(?:\"[^\"]*\"|'[^']*')[^\"']*)*")
+RE_TAG_START = re.compile("[^>\"']*(?:(?:\"[^\"]*\"|'[^']*')[^>\"']*)*(?:\"[^\"]*|'[^']*)?")
 RE_HTMLLINK  = re.compile("<[^<]+(href|src|url)\s*=\s*('[^']*'|\"[^\"]*\"|[^ >]*)", re.I)
 
 RE_HTMLCLASS = re.compile("class\s*=\s*['\"]?([\w\-_\d]+)", re.I)
@@ -45,7 +61,25 @@ RE_HTMLID    = re.compile("id\s*=\s*['\"]?([\w\-_\d]+)", re.I)
 RE_HTMLHREF  = re.compile("href\s*=\s*('[^']*'|\"[^\"]*\"|[^ ]*)", re.I)
 
 RE_SPACES    = re.compile("\s+", re.MULTILINE)
-RE_QUERY     = re.compile("^(?P<name>(\w+:)?[\w\d_\-]+)?(?P<id>#[\w\d_\-]+)?(?P<class>\.[\w\d_\-]+)?(?P<property>\:[\w\d\-]+)?(?P<count>\[\-?\d+\])?$")
+# Matches an attribute name and its (double, single or non-quoted) value
+RE_ATTRIBUTE = re.compile(
+	"([^\\s=\"'/]+)"
+	"(?:\\s*=\\s*(?:\"([^\"]*)\"?|'([^']*)'?|([^\\s\"']*)))?"
+)
+RE_RAW_TEXT_END = {}
+# The tokens of a selector (see 'Selector')
+RE_SELECTOR  = re.compile(
+	"(?P<child>\\s*>\\s*)"
+	"|(?P<descendant>\\s+)"
+	"|(?P<name>\\*|[\\w\\-]+)"
+	"|\\#(?P<id>[\\w\\-]+)"
+	"|\\.(?P<class>[\\w\\-]+)"
+	"|\\[\\s*(?P<count>-?\\d+)\\s*\\]"
+	"|\\[\\s*(?P<attribute>[\\w\\-:]+)\\s*(?:(?P<operator>[~|^$*!]?=)\\s*"
+	"(?:\"(?P<double>[^\"]*)\"|'(?P<single>[^']*)'|(?P<value>[^\\]\\s]*)))?\\s*\\]"
+	"|:(?P<pseudo>[\\w\\-]+)(?:\\((?P<argument>[^)]*)\\))?"
+)
+RE_NTH       = re.compile("^([+-]?\\d*)n\\s*(?:([+-])\\s*(\\d+))?$")
 
 KEEP_ABOVE    = "+"
 KEEP_SAME     = "="
@@ -59,6 +93,27 @@ def ensureUnicode( text, encoding=None ):
 	else:
 		return text
 
+if sys.version_info.major < 3:
+	RE_ENTITY = re.compile("&(?:#[xX]([0-9a-fA-F]+)|#(\\d+)|(\\w+));?")
+
+	def _expandEntity( match ):
+		hexa, decimal, name = match.groups()
+		try:
+			if hexa:    return unichr(int(hexa, 16))
+			if decimal: return unichr(int(decimal))
+		except (ValueError, OverflowError):
+			return u"\ufffd"
+		code = html_entities.name2codepoint.get(name)
+		return unichr(code) if code is not None else match.group()
+
+	def expandEntities( text ):
+		"""Expands the character references and named entities found in the
+		given (unicode) text."""
+		return RE_ENTITY.sub(_expandEntity, text)
+else:
+	# The standard library knows all the HTML5 named entities
+	expandEntities = html.unescape
+
 # -----------------------------------------------------------------------------
 #
 # URL
@@ -93,9 +148,16 @@ class Tag(object):
 	"""A Tag is an abstract decorator for a portion within a string. Tags are
 	used in this module to identify HTML/XML data within strings."""
 
-	OPEN  = "open"
-	CLOSE = "close"
-	EMPTY = "empty"
+	OPEN    = "open"
+	CLOSE   = "close"
+	EMPTY   = "empty"
+	TEXT    = "text"
+	COMMENT = "comment"
+	CDATA   = "cdata"
+
+	# The HTML elements whose content is raw text, where '<' does not start
+	# a tag.
+	RAW_TEXT = ("script", "style")
 
 	def __init__( self, html, start, end, depth=0 ):
 		"""Creates a new new tag."""
@@ -155,11 +217,19 @@ class ElementTag(Tag):
 	a string."""
 
 	def __init__( self, html, start, end, astart=None, aend=None, attributes=None,
-	depth=None, type=None ):
-		"""Creates a new tag element extracted from the given 'html' string."""
+	depth=None, type=None, name=None ):
+		"""Creates a new tag element extracted from the given 'html' string.
+		The 'name' is given when it is already known (by the tokenizer)."""
 		Tag.__init__(self, html, start, end, depth=depth)
 		if type == None: type = Tag.OPEN
 		self._attributes = attributes
+		self._name       = name
+		self._lname      = None
+		# The id and set of classes are parsed once (see 'classes')
+		self._id         = None
+		self._classes    = None
+		# The HTML of the tag, once rendered after a change
+		self._rendered   = None
 		# astart-aend denote the range of attributes
 		self.astart      = astart
 		self.aend        = aend
@@ -193,22 +263,48 @@ class ElementTag(Tag):
 	def set( self, name, value=None ):
 		"""Sets the given attribute set for this tag."""
 		self.attributes()[name] = value
-		self.hasChanged = True
+		self._changed()
 		return self
 
 	def remove( self, name ):
 		a = self.attributes()
 		if name in a:
 			del a[name]
-		self.hasChanged = True
+		self._changed()
 		return self
 
+	def _changed( self ):
+		self.hasChanged = True
+		self._classes   = None
+		self._rendered  = None
+		# The list the tag belongs to may need to know (see 'CompactTagList')
+		context = getattr(self, "context", None)
+		if context is not None: context._onChange(self)
+
+	def classes( self ):
+		"""Returns the set of classes of this element."""
+		if self._classes is None:
+			attributes    = self.attributes()
+			value         = attributes.get("class")
+			self._id      = attributes.get("id")
+			self._classes = frozenset(value.split()) if value else frozenset()
+		return self._classes
+
 	def name( self ):
 		"""Returns this tag name"""
-		if self.type == Tag.OPEN or self.type == Tag.EMPTY:
-			return self._html[self.start+1:self.astart].strip()
-		else:
-			return self._html[self.start+2:self.astart].strip()
+		if self._name is None:
+			if self.type == Tag.OPEN or self.type == Tag.EMPTY:
+				self._name = self._html[self.start+1:self.astart].strip()
+			else:
+				self._name = self._html[self.start+2:self.astart].strip()
+		return self._name
+
+	def lname( self ):
+		"""Returns this tag name in lowercase. Names are interned, so that they
+		can be compared quickly."""
+		if self._lname is None:
+			self._lname = intern(str(self.name().lower()))
+		return self._lname
 
 	def nameLike( self, what ):
 		"""Tells if the name is like the given string/list of string/regexp/list
@@ -223,29 +319,28 @@ class ElementTag(Tag):
 			return what.match(self.name(), re.I)
 
 	def hasName( self, name ):
-		return self.name().lower() == name.lower()
+		return self.lname() == name.lower()
 
 	def hasClass( self, name ):
 		"""Tells if the element has the given class (case sensitive)"""
-		element_class = self.attributes().get("class")
-		if element_class and name in element_class.split() != -1:
-			return True
-		else:
-			return False
+		return name in (self._classes if self._classes is not None else self.classes())
 
 	def hasId( self, name ):
 		"""Tells if the element has the given id (case sensitive)"""
-		return self.attributes().get("id") == name
+		if self._classes is None: self.classes()
+		return self._id == name
 
 	def html(self, encoding=None):
 		if self.hasChanged:
-			name = self.name()
-			attr = "".join([" {0}=\"{1}\"".format(k, v) for k,v in self.attributes().items()])
-			return "<{2}{0}{1}{3}>".format(name, attr,
-				"/" if self.isClosing() else "",
-				"/" if self.isEmpty()   else "",
-			)
-
+			# Changed tags are rendered once, until they change again
+			if self._rendered is None:
+				name = self.name()
+				attr = "".join([" {0}=\"{1}\"".format(k, v) if v is not None else " " + k for k,v in self.attributes().items()])
+				self._rendered = "<{2}{0}{1}{3}>".format(name, attr,
+					"/" if self.isClosing() else "",
+					"/" if self.isEmpty()   else "",
+				)
+			return self._rendered
 		else:
 			return super(ElementTag, self).html()
 
@@ -286,6 +381,45 @@ class TextTag(Tag):
 	def name(self):
 		return "#text"
 
+class CommentTag(TextTag):
+	"""Represents a comment, a declaration (like doctype) or a processing
+	instruction. They are kept in the HTML, but have no text."""
+
+	def text(self, encoding=None):
+		return u''
+
+	def name(self):
+		return "#comment"
+
+class CDATATag(TextTag):
+	"""Represents a CDATA section, whose text is its content."""
+
+	def text(self, encoding=None):
+		text = self._html[self.start+9:self.end-3 if self._html.endswith("]]>", 0, self.end) else self.end]
+		if encoding: text = text.decode(encoding)
+		return text
+
+def joinTags( tags ):
+	"""Returns the HTML of the given tags. The tags that were not changed and
+	follow each other in their source document are copied as a single span
+	of the source, and only the changed tags are rendered."""
+	res    = []
+	source = None
+	start  = end = 0
+	for tag in tags:
+		html = tag._html
+		if tag.hasChanged or not html:
+			if source is not None: res.append(source[start:end])
+			source = None
+			res.append(tag.html())
+		elif html is source and tag.start == end:
+			end = tag.end
+		else:
+			if source is not None: res.append(source[start:end])
+			source, start, end = html, tag.start, tag.end
+	if source is not None: res.append(source[start:end])
+	return "".join(res)
+
 # -----------------------------------------------------------------------------
 #
 # TAG LIST
@@ -309,93 +443,95 @@ class TagList:
 		self.content.append(content)
 		return content
 
+	def _onChange( self, tag ):
+		"""Invoked when the given tag of this list was changed."""
+		pass
+
 	def fromHTML( self, html, scraper=None ):
 		"""Creates the tag list content from the given HTML data. This will
 		erase the content of this tag list, replacing it by this one."""
 		self.content = []
-		offset    = 0
 		depth     = 0
-		end       = False
 		if scraper == None: scraper = HTML
-		while not end:
-			tag = scraper.findNextTag(html, offset)
-			# If there is no tag, it is the document
-			if tag == None:
-				self.append(TextTag( html, start=offset, end=len(html)))
-				end = True
+		for kind, start, end, attr_start, attr_end, name in scraper.tokenize(html):
+			if kind == Tag.TEXT:
+				tag = TextTag(html, start, end, depth)
+			elif kind == Tag.COMMENT:
+				tag = CommentTag(html, start, end, depth)
+			elif kind == Tag.CDATA:
+				tag = CDATATag(html, start, end, depth)
 			else:
-				tag, tag_end_offset = tag
-				tag_type, tag_name, tag_start, attr_start, attr_end = tag
-				# There may be text inbetween
-				if tag_start > offset:
-					self.append(TextTag(html, start=offset,end=tag_start, depth=depth))
-				# We process the encountered tag
-				#new  = depth, tag_type, tag_name, tag_start, attr_end + 1, attr_start, attr_end
-				new = ElementTag( html, tag_start, tag_end_offset, attr_start, attr_end, type=tag_type, depth=depth)
-				self.append(new)
-				last = new
-				offset = tag_end_offset
+				tag = ElementTag(html, start, end, attr_start, attr_end, type=kind, depth=depth, name=name)
+			self.append(tag)
 		return self.content
 
 	def tagtree( self, asXML=False ):
-		"""Folds this list into a tree, which is returned as result."""
+		"""Folds this list into a tree, which is returned as result. Unless
+		'asXML' is true, the HTML rules apply: names are case-insensitive,
+		some elements are empty (like 'br') and some are implicitly closed
+		(like 'p')."""
 		root       = TagTree(id=-1)
 		parents    = [root]
 		counter    = 0
+		# The stack of open tags, and the positions of each name in the
+		# stack, so that closing tags are matched in constant time.
 		tags_stack = []
-		def find_opening_tag(tag, stack):
-			for i in range(len(stack)-1,-1,-1):
-				this_tag = stack[i]
-				if this_tag.name() == tag.name() and this_tag.type == Tag.OPEN:
-					return this_tag, i
-			return None, -1
+		names      = []
+		positions  = {}
+		def pop():
+			positions[names.pop()].pop()
+			parents.pop()
+			return tags_stack.pop()
 		# We iterate on the tags of this taglist
-		for tag in self.content:
+		for tag, name in self._iterNamed(asXML):
 			#  We create the node
-			if isinstance(tag, TextTag):
-				parents[-1].append(TagTree(tag))
+			if name is None:
+				parents[-1]._adopt(TagTree(tag))
+				continue
+			if tag.type == Tag.OPEN or tag.type == Tag.EMPTY:
+				if tags_stack and not asXML and HTML_closeWhen( tag, tags_stack[-1] ):
+					# This is the special treatment when we have to close
+					# tags in HTML: the parent is closed by an empty tag
+					parent_tag  = tags_stack[-1]
+					node        = parents[-1]
+					pop()
+					node.close(ElementTag(tag._html, tag.start, tag.start, tag.start, tag.start, type=Tag.CLOSE, name=parent_tag.name()))
+				node = TagTree(tag, id=counter)
+				parents[-1]._adopt(node)
+				counter += 1
+				if not (tag.type == Tag.EMPTY or (not asXML and HTML_isEmpty(tag))):
+					parents.append(node)
+					tags_stack.append(tag)
+					names.append(name)
+					positions.setdefault(name, []).append(len(tags_stack) - 1)
+			elif tag.type == Tag.CLOSE:
+				where = positions.get(name)
+				if not where:
+					# There is no opening tag for this tag
+					continue
+				depth = where[-1]
+				while len(tags_stack) > depth + 1:
+					pop()
+				node = parents[-1]
+				pop()
+				node.close(tag)
 			else:
-				if tag.type in (Tag.OPEN, Tag.EMPTY):
-					if tags_stack and HTML_closeWhen( tag, tags_stack[-1] ) and not asXML:
-						# This is the special treatment when we have to close
-						# tags in HTML
-						# FIXME: The two variables are not used
-						parent_tag = tags_stack.pop()
-						closing_tag = ElementTag(tag._html, tag.start, tag.start, type=Tag.CLOSE)
-						parents.pop().close(tag)
-					if tag.type == Tag.EMPTY or (not asXML and HTML_isEmpty(tag)):
-						node = TagTree(tag, id=counter)
-						parents[-1].append(node)
-						counter   += 1
-					else:
-						node = TagTree(tag, id=counter)
-						parents[-1].append(node)
-						parents.append(node)
-						tags_stack.append(tag)
-						counter   += 1
-				elif tag.type == Tag.CLOSE:
-					opening_tag, depth = find_opening_tag(tag, tags_stack)
-					if not opening_tag:
-						#print "WARNING: no opening tag for ", tag
-						continue
-					else:
-						while len(tags_stack) > depth:
-							stack_tag = tags_stack.pop()
-							node      = parents.pop()
-						assert stack_tag == opening_tag
-						node.close(tag)
-				else:
-					raise Exception("Unknow Tag.type: %s" % (tag.type))
+				raise Exception("Unknow Tag.type: %s" % (tag.type))
 		root._taglist = self
 		return root
 
+	def _iterNamed( self, asXML=False ):
+		"""Iterates on the '(tag, name)' couples of this list, where the name
+		is 'None' for text tags, and is lowercase unless 'asXML' is true."""
+		for tag in self:
+			if isinstance(tag, TextTag):
+				yield tag, None
+			else:
+				yield tag, (tag.name() if asXML else tag.lname())
+
 	def html( self ):
-		"""Converts this tags list to HTML"""
-		res = []
-		for tag in self.content:
-			assert isinstance(tag, Tag) or isinstance(tag, TextTag)
-			res.append(tag.html())
-		return "".join(res)
+		"""Converts this tags list to HTML (see 'joinTags')."""
+		return joinTags(self.content)
 
 	def innerhtml(self):
 		res = []
@@ -404,16 +540,37 @@ class TagList:
 			res.append(tag.html())
 		return "".join(res)
 
-	def text(self, encoding=None):
+	def text( self, encoding=None, expand=False ):
+		"""Returns the text of the tags in this list, where the entities are
+		expanded when 'expand' is true."""
 		res = []
 		for tag in self.content:
-			res.append(ensureUnicode(tag.text(encoding), encoding))
-		# FIXME: Unicode
-		return u"".join(res)
+			# Elements have no text
+			if isinstance(tag, ElementTag): continue
+			text = tag.text(encoding)
+			if not isinstance(text, unicode): text = ensureUnicode(text, encoding)
+			# The entities are expanded once the text is joined, so CDATA (which
+			# has no entities) is escaped
+			if expand and tag.__class__ is CDATATag: text = text.replace("&", "&amp;")
+			res.append(text)
+		text = u"".join(res)
+		return expandEntities(text) if expand and "&" in text else text
 
 	def find( self, expression ):
-		# FIXME: Implement CSS matching
-		return self.withName(expression)
+		"""Returns the tags of this list that match the given CSS-like
+		expression (see 'Selector'). Expressions that need the structure of
+		the document are evaluated on the tree of this list. The expression
+		can also be a predicate, which is given each tag of this list.
+
+		Note that element names are matched case-insensitively, as in
+		'Selector', while they used to be compared as they were written."""
+		if callable(expression):
+			return [_ for _ in self if expression(_)]
+		selector = Selector.Compile(expression)
+		if selector.isSimple():
+			return [_ for _ in self if selector.matchTag(_)]
+		else:
+			return [_.startTag if isinstance(_, TagTree) else _ for _ in self.tagtree().query(selector)]
 
 	def withName( self, name ):
 		return [_ for _ in self if _.name() == name]
@@ -431,6 +588,218 @@ class TagList:
 	def __str__( self ):
 		return str(self.content)
 
+class CompactTagList(TagList):
+	"""A 'TagList' where the tokens are kept in parallel 'array' columns
+	(kind, start, end, attributes start and end, depth, parent index and
+	name) instead of one object per token. The 'ElementTag' and 'TextTag'
+	objects are views on the columns, created when a token is accessed.
+	A token has a single view for as long as the view is used (so that the
+	tags of a tree made by 'tagtree' are the tags of the list), but only the
+	views that were changed (and the appended tags) are kept by the list, so
+	that scanning a whole document does not keep one object per token.
+
+	The parent of a token is the innermost element that is open (not closed
+	yet) at the token, void elements (like 'br' or 'img') being never open.
+	It is '-1' for the tokens at the top level."""
+
+	KINDS   = (Tag.OPEN, Tag.CLOSE, Tag.EMPTY, Tag.TEXT, Tag.COMMENT, Tag.CDATA)
+	CLASSES = (ElementTag, ElementTag, ElementTag, TextTag, CommentTag, CDATATag)
+	VOID    = frozenset(_.lower() for _ in "AREA BASE BASEFONT BR COL EMBED FRAME HR IMG INPUT ISINDEX LINK META PARAM SOURCE TRACK WBR".split())
+
+	def __init__( self, html=None, scraper=None ):
+		self._html       = ""
+		self._kind       = array("b")
+		self._start      = array("i")
+		self._end        = array("i")
+		self._attrStart  = array("i")
+		self._attrEnd    = array("i")
+		self._depth      = array("i")
+		self._parent     = array("i")
+		self._name       = array("i")
+		# The table of the tag names, indexed by the 'name' column
+		self._names      = []
+		self._nameIds    = {}
+		# The views that were changed, and the appended tags, by index, and
+		# the views that are in use
+		self._views      = {}
+		self._live       = weakref.WeakValueDictionary()
+		if html is not None: self.fromHTML(html, scraper)
+
+	@property
+	def content( self ):
+		"""The list of the tags of this list (this creates all the views)."""
+		return [self._view(i) for i in range(len(self._kind))]
+
+	def fromHTML( self, html, scraper=None ):
+		"""Creates the tag list content from the given HTML data. This will
+		erase the content of this tag list, replacing it by this one."""
+		self.__init__()
+		self._html = html
+		if scraper == None: scraper = HTML
+		kinds      = dict((k, i) for i, k in enumerate(self.KINDS))
+		void       = self.VOID
+		stack      = []
+		open_names = []
+		# The positions of each name in the stack, so that closing tags are
+		# matched in constant time (as in 'tagtree')
+		positions  = {}
+		for kind, start, end, attr_start, attr_end, name in scraper.tokenize(html):
+			if kind == Tag.CLOSE and stack:
+				where = positions.get(name.lower())
+				if where:
+					# We close up to the matching element, so that the closing
+					# tag is at the same level as the opening one
+					depth = where[-1]
+					while len(stack) > depth:
+						positions[open_names.pop()].pop()
+						stack.pop()
+			i = len(self._kind)
+			self._add(kinds[kind], start, end, attr_start, attr_end, len(stack), stack[-1] if stack else -1, name)
+			if kind == Tag.OPEN:
+				lname = name.lower()
+				if lname not in void:
+					positions.setdefault(lname, []).append(len(stack))
+					stack.append(i)
+					open_names.append(lname)
+		return self
+
+	def append( self, content ):
+		"""Appends the given tag, which must be a tag of the same HTML
+		string as the other tags of this list."""
+		assert isinstance(content, Tag)
+		if not self._kind: self._html = content._html
+		assert content._html is self._html, "Tags must come from the same document"
+		if isinstance(content, ElementTag):
+			kind, name = self.KINDS.index(content.type), content.name()
+		else:
+			kind, name = self.CLASSES.index(content.__class__), None
+		self._add(kind, content.start, content.end, content.astart if name else None,
+			content.aend if name else None, content.depth or 0, -1, name)
+		content.context   = self
+		content._position = len(self._kind) - 1
+		self._views[content._position] = content
+		return content
+
+	def _onChange( self, tag ):
+		# Changed views are kept, for 'html' and for the next accesses
+		self._views[tag._position] = tag
+
+	def kind( self, index ):
+		return self.KINDS[self._kind[index]]
+
+	def name( self, index ):
+		"""Returns the name of the tag at the given index ('None' for text)."""
+		i = self._name[index]
+		return self._names[i] if i >= 0 else None
+
+	def parent( self, index ):
+		return self._parent[index]
+
+	def depth( self, index ):
+		return self._depth[index]
+
+	def html( self ):
+		"""Converts this tags list to HTML, copying the source of the tags that
+		were not changed."""
+		res   = []
+		run   = None
+		html  = self._html
+		for i in range(len(self._kind)):
+			view = self._views.get(i)
+			if view is not None and view.hasChanged:
+				if run: res.append(html[run[0]:run[1]])
+				res.append(view.html())
+				run = None
+			elif run and run[1] == self._start[i]:
+				run[1] = self._end[i]
+			else:
+				if run: res.append(html[run[0]:run[1]])
+				run = [self._start[i], self._end[i]]
+		if run: res.append(html[run[0]:run[1]])
+		return "".join(res)
+
+	def text( self, encoding=None, expand=False ):
+		res   = []
+		html  = self._html
+		text  = self.KINDS.index(Tag.TEXT)
+		cdata = self.KINDS.index(Tag.CDATA)
+		for i in range(len(self._kind)):
+			kind = self._kind[i]
+			if kind == text:
+				value = html[self._start[i]:self._end[i]]
+			elif kind == cdata:
+				value = self._view(i).text()
+				if expand: value = value.replace("&", "&amp;")
+			else:
+				continue
+			res.append(value if isinstance(value, unicode) else ensureUnicode(value, encoding))
+		text = u"".join(res)
+		return expandEntities(text) if expand and "&" in text else text
+
+	def withName( self, name ):
+		i = self._nameIds.get(name)
+		if i is None: return []
+		return [self._view(j) for j in range(len(self._name)) if self._name[j] == i]
+
+	def _iterNamed( self, asXML=False ):
+		# The names come from the table of names, lowercased once per name
+		names = self._names if asXML else [intern(_.lower()) for _ in self._names]
+		for i in range(len(self._kind)):
+			j = self._name[i]
+			yield self._view(i), (names[j] if j >= 0 else None)
+
+	def _add( self, kind, start, end, attrStart, attrEnd, depth, parent, name ):
+		if name is None:
+			name_id = -1
+		else:
+			name_id = self._nameIds.get(name)
+			if name_id is None:
+				name_id = self._nameIds[name] = len(self._names)
+				self._names.append(name)
+		self._kind.append(kind)
+		self._start.append(start)
+		self._end.append(end)
+		self._attrStart.append(-1 if attrStart is None else attrStart)
+		self._attrEnd.append(-1 if attrEnd is None else attrEnd)
+		self._depth.append(depth)
+		self._parent.append(parent)
+		self._name.append(name_id)
+
+	def _view( self, index ):
+		"""Returns the tag object for the token at the given index."""
+		tag = self._views.get(index)
+		if tag is None: tag = self._live.get(index)
+		if tag is None:
+			kind = self._kind[index]
+			if kind <= 2:
+				tag = ElementTag(self._html, self._start[index], self._end[index],
+					self._attrStart[index], self._attrEnd[index],
+					type=self.KINDS[kind], depth=self._depth[index],
+					name=self._names[self._name[index]])
+			else:
+				tag = self.CLASSES[kind](self._html, self._start[index], self._end[index], self._depth[index])
+			tag.context   = self
+			tag._position = index
+			self._live[index] = tag
+		return tag
+
+	def __iter__( self ):
+		for i in range(len(self._kind)):
+			yield self._view(i)
+
+	def __len__( self ):
+		return len(self._kind)
+
+	def __getitem__( self, i ):
+		if isinstance(i, slice):
+			return [self._view(j) for j in range(*i.indices(len(self._kind)))]
+		if i < 0: i += len(self._kind)
+		if i < 0 or i >= len(self._kind): raise IndexError(i)
+		return self._view(i)
+
+	def __str__( self ):
+		return str(self.content)
+
 # -----------------------------------------------------------------------------
 #
 # TAG TREE
@@ -444,6 +813,8 @@ class TagTree:
 	document as a tree."""
 
 	TEXT  = "#text"
+	# Returned by 'iterFind' predicates to skip the descendants of a node
+	PRUNE = object()
 
 	def __init__( self, startTag=None, endTag=None, id=None ):
 		"""TagTrees should be created by an HTMLTools, and not really directly.
@@ -452,6 +823,7 @@ class TagTree:
 		self._parent   = None
 		self._depth    = 0
 		self._taglist  = None
+		self._index    = None
 		self.startTag  = None
 		self.endTag    = None
 		self.id        = id
@@ -496,10 +868,12 @@ class TagTree:
 
 	def set( self, name, value):
 		self.startTag.set(name, value)
+		self._invalidate()
 		return self
 
 	def remove( self, name):
 		self.startTag.remove(name)
+		self._invalidate()
 		return self
 
 	def attribute(self, name):
@@ -528,6 +902,32 @@ class TagTree:
 		"""Tells if this tag tree is a root (has no parent) or not."""
 		return self._parent == None
 
+	def root( self ):
+		"""Returns the root of the tree this tag tree belongs to."""
+		node = self
+		while node._parent is not None:
+			node = node._parent
+		return node
+
+	def index( self ):
+		"""Returns the 'TagTreeIndex' of the tree this tag tree belongs to,
+		which is created on the root when first needed."""
+		root = self.root()
+		if root._index is None:
+			root._index = TagTreeIndex(root)
+		return root._index
+
+	def _invalidate( self ):
+		"""Drops the tag lists cached by this tag tree and its ancestors, and
+		the index of the tree, which must be done whenever the tree or the
+		attributes of its tags change."""
+		node = self
+		while True:
+			node._taglist = None
+			if node._parent is None: break
+			node = node._parent
+		node._index = None
+
 	def _cutBelow( self, data, value ):
 		"""Helper function for the `cut()` method."""
 		depth = self.depth()
@@ -577,18 +977,31 @@ class TagTree:
 
 	def find( self, predicate, recursive=True ):
 		"""Returns a list of child nodes (TagTree objects) that match the given predicate. This
-		operation is recursive by default."""
+		operation is recursive by default (see 'iterFind')."""
 		# NOTE: This has been removed, as find means "find inside"
 		# if self.startTag and predicate(self.startTag):
 		# 	return [self]
-		res  = []
-		for c in self.children:
-			assert isinstance(c, TagTree)
-			if predicate(c):
-				res.append(c)
-			if recursive:
-				res = res + c.find(predicate)
-		return res
+		return list(self.iterFind(predicate, recursive))
+
+	def iterFind( self, predicate, recursive=True ):
+		"""Iterates on the descendant nodes (or only the children when not
+		'recursive') that match the given predicate, in document order. The
+		predicate can return 'TagTree.PRUNE' to skip a node along with its
+		descendants (for instance to avoid 'script' or 'svg' elements)."""
+		prune = self.PRUNE
+		stack = [iter(self.children)]
+		while stack:
+			for child in stack[-1]:
+				match = predicate(child)
+				if match is prune:
+					continue
+				if match:
+					yield child
+				if recursive and child.children:
+					stack.append(iter(child.children))
+					break
+			else:
+				stack.pop()
 
 	def open( self, startTag):
 		if startTag==None: return
@@ -596,10 +1009,8 @@ class TagTree:
 		assert self.endTag == None
 		assert isinstance(startTag, Tag)
 		self.startTag = startTag
-		if isinstance(startTag, TextTag):
-			self.name     = TagTree.TEXT
-		else:
-			self.name     = startTag.name()
+		# Text tags are named '#text' (or '#comment')
+		self.name     = startTag.name()
 		assert self.name, repr(startTag.html()) + ":" + startTag.name()
 		return self
 
@@ -615,7 +1026,15 @@ class TagTree:
 		node.setParent(self)
 		assert node != self
 		self.children.append(node)
-		self._taglist = None
+		self._invalidate()
+		return self
+
+	def _adopt( self, node ):
+		"""Appends the given node without invalidating the cached state, which
+		is what 'TagList.tagtree' does while the tree is being built."""
+		node._parent = self
+		node._depth  = self._depth + 1
+		self.children.append(node)
 		return self
 
 	def merge( self, node ):
@@ -627,22 +1046,27 @@ class TagTree:
 	def list( self, contentOnly=False ):
 		"""Returns a tag list from this Tree Node."""
 		if self._taglist == None:
-			content = []
-			if self.startTag:
-				content.append(self.startTag)
-			for c in self.children:
-				if not isinstance(c, TagTree):
-					content.append(c)
-				else:
-					content.extend(c.list(contentOnly=True))
-			if self.endTag:
-				content.append(self.endTag)
-			self._taglist = TagList(content=content)
+			self._taglist = TagList(content=list(self.iterTags()))
 		if contentOnly:
 			return self._taglist.content
 		else:
 			return self._taglist
 
+	def iterTags( self, inner=False ):
+		"""Iterates on the tags of this tree in document order, without the
+		start and end tags of this node when 'inner' is true."""
+		if self.startTag and not inner: yield self.startTag
+		stack = [(self, iter(self.children))]
+		while stack:
+			node, children = stack[-1]
+			for child in children:
+				if child.startTag: yield child.startTag
+				stack.append((child, iter(child.children)))
+				break
+			else:
+				stack.pop()
+				if node.endTag and (stack or not inner): yield node.endTag
+
 	def hasName( self, name ):
 		"""Tells if the element has the given class (case sensitive)"""
 		if self.startTag: return self.startTag.hasName(name)
@@ -659,8 +1083,8 @@ class TagTree:
 		else: return None
 
 	def prettyString( self, ):
-		if self.name == self.TEXT:
-			return "#text:" + repr(self.startTag.html())
+		if isinstance(self.startTag, TextTag):
+			return self.name + ":" + repr(self.startTag.html())
 		else:
 			if self._parent == None:
 				res =  "#root\n"
@@ -685,49 +1109,21 @@ class TagTree:
 			return res
 
 	def query( self, query ):
-		"""Does a basic CSS-like query on the TagTree. Returns a TagTree"""
-		if type(query) not in (tuple, list):
-			selectors = list(filter(lambda _:_.strip(), query.split(" ")))
-		else:
-			selectors = list(filter(lambda _:_.strip(), query))
-		if selectors:
-			head      = selectors[0]
-			tail      = []
-			if len(selectors) >= 1: tail = selectors[1:]
-			predicate = lambda: True
-			match     = RE_QUERY.match(head)
-			assert match, "Invalid selector expression: " + repr(head)
-			p_name, p_id, p_class, p_property, p_count = match.group("name"), match.group("id"), match.group("class"), match.group("property"), match.group("count")
-			if p_name:
-				predicate = lambda _:predicate and _.hasName(p_name)
-			if p_id:
-				predicate = lambda _:predicate and _.hasId(p_id[1:])
-			if p_class:
-				predicate = lambda _:predicate and _.hasClass(p_class[1:])
-			res = []
-			for sub_tree in self.find(predicate):
-				res = res + sub_tree.query(tail)
-			if p_property:
-				if p_property == ":text":
-					res = map(lambda _:_.text(), res)
-				else:
-					raise Exception("Property selector not supproted yet: " + p_property)
-			if p_count:
-				count = int(p_count[1:-1])
-				if count < 0:
-					count = len(res) + count
-				if count < len(res):
-					return [res[count]]
-				else:
-					return [None]
-			else:
-				return res
-		else:
-			return [self]
+		"""Does a CSS-like query on the TagTree (see 'Selector'), and returns
+		the list of matching TagTree nodes."""
+		return list(self.iterQuery(query))
+
+	def iterQuery( self, query ):
+		"""Iterates on the results of the given CSS-like query, which are
+		only looked up as they are consumed."""
+		return Selector.Compile(query).select(self)
 
 	def first( self, query ):
-		r = self.query(query)
-		return r[0] if len(r) > 0 else HTML.EMPTY
+		"""Returns the first result of the given query, or 'HTML.EMPTY'. The
+		search stops at the first match."""
+		for result in self.iterQuery(query):
+			return result
+		return HTML.EMPTY
 
 	def __str__( self ):
 		return self.prettyString()
@@ -739,15 +1135,17 @@ class TagTree:
 		return len(self.children)
 
 	def html( self ):
-		"""Converts this tags tree to HTML"""
-		return self.list().html()
+		"""Converts this tags tree to HTML (see 'joinTags')."""
+		return joinTags(self.iterTags())
 
-	def text( self ):
-		"""Returns only the text tags in this HTML tree"""
-		return self.list().text()
+	def text( self, expand=False ):
+		"""Returns only the text tags in this HTML tree, where the entities
+		are expanded when 'expand' is true."""
+		return self.list().text(expand=expand)
 
 	def innerhtml( self ):
-		return self.list().innerhtml()
+		"""Converts the children of this tree to HTML."""
+		return joinTags(self.iterTags(inner=True))
 
 	def __getitem__( self, index ):
 		if isinstance(index, str):
@@ -759,6 +1157,388 @@ class TagTree:
 		for tag in self.list():
 			yield tag
 
+# -----------------------------------------------------------------------------
+#
+# TAG TREE INDEX
+#
+# -----------------------------------------------------------------------------
+
+class TagTreeIndex:
+	"""Maps the element names, ids and classes of a tree to its nodes, in
+	document order. Indexes are created by 'TagTree.index' and dropped when
+	the tree changes through 'append', 'merge', 'set' or 'remove' (tags
+	changed directly are not tracked). The name index and the id/class index
+	are built separately, as the latter needs the attributes to be parsed."""
+
+	def __init__( self, root ):
+		self.root     = root
+		self._names   = None
+		self._ids     = None
+		self._classes = None
+
+	def withName( self, name ):
+		"""Returns the nodes with the given (lowercase) element name."""
+		if self._names is None:
+			self._build(False)
+		return self._names.get(name, ())
+
+	def withId( self, id ):
+		"""Returns the nodes with the given id (there should be only one)."""
+		if self._ids is None:
+			self._build(True)
+		return self._ids.get(id, ())
+
+	def withClass( self, name ):
+		"""Returns the nodes that have the given class."""
+		if self._classes is None:
+			self._build(True)
+		return self._classes.get(name, ())
+
+	def _build( self, attributes ):
+		names   = {}
+		ids     = {} if attributes else None
+		classes = {} if attributes else None
+		for node in _walk(self.root):
+			tag = node.startTag
+			if not isinstance(tag, ElementTag): continue
+			name = tag.lname()
+			if name in names: names[name].append(node)
+			else:             names[name] = [node]
+			if not attributes: continue
+			for c in tag.classes():
+				if c in classes: classes[c].append(node)
+				else:            classes[c] = [node]
+			if tag._id is not None:
+				if tag._id in ids: ids[tag._id].append(node)
+				else:              ids[tag._id] = [node]
+		self._names = names
+		if attributes:
+			self._ids     = ids
+			self._classes = classes
+		return self
+
+# -----------------------------------------------------------------------------
+#
+# SELECTORS
+#
+# -----------------------------------------------------------------------------
+
+class SelectorStep:
+	"""A compound selector (like 'td.price[2]') within a 'Selector', along with
+	the combinator that relates it to the previous step ('' for descendant,
+	'>' for child)."""
+
+	def __init__( self, combinator="" ):
+		self.combinator = combinator
+		self.name       = None
+		self.id         = None
+		self.classes    = frozenset()
+		self.attributes = []
+		self.nth        = []
+		self.count      = None
+		self.text       = False
+
+	def matchTag( self, tag ):
+		"""Tells if the given tag matches this step (except for the
+		structural pseudo-classes, which need the tree)."""
+		if not isinstance(tag, ElementTag) or tag.type == Tag.CLOSE: return False
+		if self.name is not None and tag.lname() != self.name: return False
+		if self.id is not None and not tag.hasId(self.id): return False
+		if self.classes and not self.classes.issubset(tag.classes()): return False
+		for name, operator, expected in self.attributes:
+			value = tag.attributes().get(name)
+			if operator is None:
+				if name not in tag.attributes(): return False
+			elif operator == "!=":
+				if value == expected: return False
+			elif value is None:
+				return False
+			elif operator == "=":
+				if value != expected: return False
+			elif operator == "~=":
+				if expected not in value.split(): return False
+			elif operator == "|=":
+				if value != expected and not value.startswith(expected + "-"): return False
+			elif operator == "^=":
+				if not value.startswith(expected): return False
+			elif operator == "$=":
+				if not value.endswith(expected): return False
+			elif operator == "*=":
+				if expected not in value: return False
+		return True
+
+	def match( self, node ):
+		"""Tells if the given 'TagTree' node matches this step."""
+		if not self.matchTag(node.startTag): return False
+		if self.nth:
+			index = self._index(node)
+			for a, b in self.nth:
+				if a == 0:
+					if index != b: return False
+				elif (index - b) % a != 0 or (index - b) // a < 0:
+					return False
+		return True
+
+	def isSimple( self ):
+		"""Tells if this step can be matched on a tag, without the tree."""
+		return not self.nth
+
+	def _index( self, node ):
+		"""Returns the (1-based) index of the given node among the elements of
+		its parent."""
+		parent = node.parent()
+		if parent is None: return 1
+		index  = 0
+		for sibling in parent.children:
+			if isinstance(sibling.startTag, ElementTag):
+				index += 1
+				if sibling is node: return index
+		return index
+
+class Selector:
+	"""A compiled CSS-like selector, as used by 'TagTree.query'. Selectors are
+	compiled once (see 'Compile') and can then be applied to any tree.
+
+	The supported syntax is a subset of CSS: element names ('*' for any),
+	'#id', '.class' (several classes can be given), attributes ('[name]',
+	'[name=value]' and the '~=', '|=', '^=', '$=', '*=' and '!=' operators),
+	':nth-child(an+b)', ':first-child', the descendant (space) and child
+	('>') combinators, as well as these two extensions:
+
+	- ':text' returns the text of the matching nodes instead of the nodes
+	- '[n]' only keeps the n-th result (negative to count from the end) of
+	  the rest of the selector, within each match of the previous step, or
+	  'None' if there is no such result."""
+
+	MAX_CACHED = 1000
+	CACHE      = {}
+
+	@classmethod
+	def Compile( cls, selector ):
+		"""Returns the compiled selector for the given selector string (or list
+		of selector strings, that are joined as descendants)."""
+		if isinstance(selector, Selector): return selector
+		if type(selector) in (tuple, list): selector = " ".join(selector)
+		compiled = cls.CACHE.get(selector)
+		if compiled is None:
+			if len(cls.CACHE) >= cls.MAX_CACHED: cls.CACHE.clear()
+			compiled = cls.CACHE[selector] = cls(selector)
+		return compiled
+
+	def __init__( self, selector ):
+		self.selector = selector
+		self.steps    = self._parse(selector.strip())
+		# Selectors where '[n]' or ':text' apply to the results of more than
+		# one step are evaluated step by step, the others in a single walk of
+		# the tree.
+		self._nested  = len(self.steps) > 1 and (
+			self.steps[-1].count is not None
+			or any(step.count is not None or step.text for step in self.steps[:-1])
+		)
+
+	def select( self, root ):
+		"""Iterates on the nodes (or texts for ':text') within the given root
+		'TagTree' that match this selector, in document order."""
+		if not self.steps:
+			return iter([root])
+		elif self._nested:
+			return self._selectNested(root, 0)
+		count = self.steps[-1].count
+		if count is None:
+			return self._selectWalk(root)
+		else:
+			return self._nth(self._selectWalk(root), count)
+
+	def matchTag( self, tag ):
+		"""Tells if the given tag matches this selector, which must be a single
+		step without structural pseudo-classes (see 'isSimple')."""
+		return self.steps[0].matchTag(tag)
+
+	def isSimple( self ):
+		"""Tells if this selector can be matched on a single tag, without the
+		tree."""
+		return len(self.steps) == 1 and self.steps[0].isSimple() and not self.steps[0].text and self.steps[0].count is None
+
+	def isStreamable( self ):
+		"""Tells if this selector can be matched on a node knowing only its
+		ancestors, and not its siblings (see 'HTMLStream')."""
+		return bool(self.steps) and not self._nested and self.steps[-1].count is None and all(step.isSimple() for step in self.steps)
+
+	def match( self, node, root=None ):
+		"""Tells if the given 'TagTree' node matches this selector, within the
+		given root (the root of the node tree by default)."""
+		if root is None: root = node.root()
+		return self.steps[-1].match(node) and self._matchAncestors(node, len(self.steps) - 1, root)
+
+	def _selectWalk( self, root ):
+		"""Walks the tree once, matching the last step and then the previous
+		steps on the ancestors (as browsers do)."""
+		steps = self.steps
+		last  = steps[-1]
+		nodes, contained = self._candidates(root)
+		for node in nodes:
+			if not contained and not self._isBelow(node, root): continue
+			if last.match(node) and self._matchAncestors(node, len(steps) - 1, root):
+				yield node.text() if last.text else node
+
+	def _candidates( self, root ):
+		"""Returns the nodes that may match the last step, in document order,
+		and tells if they are all within the given root. The tree index is
+		used when the last step has an id (for any root), or a class or name
+		(for the root of the tree only, as it would otherwise list nodes
+		outside of the root)."""
+		steps = self.steps
+		last  = steps[-1]
+		if last.combinator == ">" and len(steps) == 1:
+			return _walk(root, True), True
+		if last.id is not None:
+			nodes = root.index().withId(last.id)
+			return nodes, root.isRoot()
+		if not root.isRoot():
+			return _walk(root), True
+		if last.classes:
+			index = root.index()
+			return min((index.withClass(c) for c in last.classes), key=len), True
+		if last.name is not None:
+			return root.index().withName(last.name), True
+		return _walk(root), True
+
+	def _isBelow( self, node, root ):
+		"""Tells if the given node is a descendant of the given root."""
+		node = node._parent
+		while node is not None:
+			if node is root: return True
+			node = node._parent
+		return False
+
+	def _matchAncestors( self, node, index, root ):
+		"""Tells if the steps before the given step index match the ancestors
+		of the given node, below the given root."""
+		if index == 0:
+			return self.steps[0].combinator != ">" or node.parent() is root
+		step   = self.steps[index - 1]
+		parent = node.parent()
+		if self.steps[index].combinator == ">":
+			return parent is not None and parent is not root and step.match(parent) and self._matchAncestors(parent, index - 1, root)
+		while parent is not None and parent is not root:
+			if step.match(parent) and self._matchAncestors(parent, index - 1, root):
+				return True
+			parent = parent.parent()
+		return False
+
+	def _selectNested( self, node, index ):
+		"""Evaluates the steps from the given index in the context of the
+		given node, which gives the same results as nesting the queries."""
+		step    = self.steps[index]
+		matches = (_ for _ in _walk(node, step.combinator == ">") if step.match(_))
+		if index + 1 < len(self.steps):
+			results = (r for m in matches for r in self._selectNested(m, index + 1))
+		else:
+			results = matches
+		if step.text:
+			results = (_.text() if _ is not None else None for _ in results)
+		if step.count is None:
+			return results
+		return self._nth(results, step.count)
+
+	def _nth( self, results, count ):
+		if count >= 0:
+			for i, result in enumerate(results):
+				if i == count:
+					yield result
+					return
+		else:
+			results = list(results)
+			if -count <= len(results):
+				yield results[count]
+				return
+		yield None
+
+	def _parse( self, selector ):
+		steps    = []
+		step     = None
+		offset   = 0
+		while offset < len(selector):
+			m = RE_SELECTOR.match(selector, offset)
+			if not m:
+				raise ValueError("Invalid selector expression: {0} at {1}".format(repr(selector), offset))
+			offset = m.end()
+			group  = m.lastgroup
+			if group in ("child", "descendant"):
+				if step is None:
+					# A selector starting with '>' only matches the children
+					# of the root
+					if steps or group != "child":
+						raise ValueError("Invalid selector expression: " + repr(selector))
+					step = SelectorStep(">")
+					continue
+				steps.append(step)
+				step = SelectorStep(">" if group == "child" else "")
+				continue
+			if step is None: step = SelectorStep()
+			if group == "name":
+				name = m.group("name")
+				step.name = None if name == "*" else name.lower()
+			elif group == "id":
+				step.id = m.group("id")
+			elif group == "class":
+				step.classes = step.classes.union((m.group("class"),))
+			elif group == "count":
+				step.count = int(m.group("count"))
+			elif group in ("attribute", "double", "single", "value"):
+				value = m.group("double")
+				if value is None: value = m.group("single")
+				if value is None: value = m.group("value")
+				step.attributes.append((m.group("attribute"), m.group("operator"), value))
+			elif group in ("pseudo", "argument"):
+				self._parsePseudo(step, m.group("pseudo").lower(), m.group("argument"))
+		if step is not None:
+			steps.append(step)
+		return steps
+
+	def _parsePseudo( self, step, pseudo, argument ):
+		if pseudo == "text":
+			step.text = True
+		elif pseudo == "first-child":
+			step.nth.append((0, 1))
+		elif pseudo == "nth-child":
+			argument = (argument or "").strip().lower()
+			if argument == "odd":
+				step.nth.append((2, 1))
+			elif argument == "even":
+				step.nth.append((2, 0))
+			elif argument.lstrip("+-").isdigit():
+				step.nth.append((0, int(argument)))
+			else:
+				m = RE_NTH.match(argument)
+				if not m: raise ValueError("Invalid :nth-child argument: " + repr(argument))
+				a = m.group(1)
+				a = -1 if a == "-" else (1 if a in ("", "+") else int(a))
+				b = int(m.group(3) or 0) * (-1 if m.group(2) == "-" else 1)
+				step.nth.append((a, b))
+		else:
+			raise ValueError("Property selector not supported yet: :" + pseudo)
+
+	def __repr__( self ):
+		return "<Selector {0}>".format(repr(self.selector))
+
+def _walk( root, childrenOnly=False ):
+	"""Iterates on the descendants (or only the children) of the given
+	'TagTree' in document order, without recursion."""
+	if childrenOnly:
+		for child in root.children:
+			yield child
+		return
+	stack = [iter(root.children)]
+	while stack:
+		for child in stack[-1]:
+			yield child
+			if child.children:
+				stack.append(iter(child.children))
+				break
+		else:
+			stack.pop()
+
 # -----------------------------------------------------------------------------
 #
 # HTML PRESETS
@@ -766,32 +1546,36 @@ class TagTree:
 # -----------------------------------------------------------------------------
 
 HTML_EMPTY = """\
-AREA BASE BASEFONT BR COL FRAME HR IMG INPUT ISINDEX LINK META PARAM
+AREA BASE BASEFONT BR COL EMBED FRAME HR IMG INPUT ISINDEX LINK META PARAM
+SOURCE TRACK WBR
 """[:-1].split()
 
 HTML_MAYBE_EMPTY = """\
 A P
 """[:-1].split()
 
+# The rules below compare the interned lowercase names ('ElementTag.lname')
+HTML_EMPTY_NAMES       = frozenset(intern(_.lower()) for _ in HTML_EMPTY)
+HTML_MAYBE_EMPTY_NAMES = frozenset(intern(_.lower()) for _ in HTML_MAYBE_EMPTY)
+# Elements that close a parent of the same name (like 'td'), and elements
+# that close a parent 'p'.
+HTML_CLOSE_SAME        = frozenset(("td", "tr", "p"))
+HTML_CLOSE_P           = frozenset(("div", "table", "ul", "blockquote", "form"))
+
 def HTML_isEmpty( tag ):
-	tag_name = tag.name().upper()
-	if tag_name in HTML_EMPTY: return True
-	if tag_name == "A" and not tag.has("href"): return True
+	tag_name = tag.lname()
+	if tag_name in HTML_EMPTY_NAMES: return True
+	if tag_name == "a" and not tag.has("href"): return True
 	return False
 
 def HTML_mayBeEmpty( tag ):
-	tag_name = tag.name().upper()
-	if tag_name in HTML_MAYBE_EMPTY: return True
-	return False
+	return tag.lname() in HTML_MAYBE_EMPTY_NAMES
 
 def HTML_closeWhen( current, parent ):
-	cur_name = (current.name() or "").upper()
-	par_name = (parent.name() or "").upper()
-	if cur_name == par_name == "TD": return True
-	if cur_name == par_name == "TR": return True
-	if cur_name == par_name == "P": return True
-	if par_name == "P" and cur_name in ("DIV", "TABLE", "UL", "BLOCKQUOTE",
-	"FORM"): return True
+	cur_name = current.lname()
+	par_name = parent.lname()
+	if cur_name == par_name and cur_name in HTML_CLOSE_SAME: return True
+	if par_name == "p" and cur_name in HTML_CLOSE_P: return True
 	return False
 
 # -----------------------------------------------------------------------------
@@ -843,12 +1627,16 @@ class HTMLTools:
 		else:
 			raise Exception("Unsupported data:" + data)
 
+	def stream( self, asXML=False, encoding="utf-8" ):
+		"""Returns an 'HTMLStream' that parses a document chunk by chunk with
+		this scraper."""
+		return HTMLStream(scraper=self, asXML=asXML, encoding=encoding)
+
 	def list( self, data ):
-		"""Converts the given text or tagtree into a taglist."""
+		"""Converts the given text or tagtree into a taglist. Text is converted
+		into a 'CompactTagList'."""
 		if type(data) in (str, unicode):
-			tag_list = TagList()
-			tag_list.fromHTML(data, scraper=self)
-			return tag_list
+			return CompactTagList(data, scraper=self)
 		elif isinstance(data, wwwclient.browse.Session):
 			return self.list(data.last().data())
 		elif isinstance(data, wwwclient.browse.Transaction):
@@ -906,7 +1694,7 @@ class HTMLTools:
 		res = None
 		if type(data) in (str, unicode):
 			res = data
-		if type(data) in (list, tuple, iter):
+		elif type(data) in (list, tuple, iter):
 			return [self.text(_) for _ in data]
 		elif isinstance(data, wwwclient.browse.Session):
 			return self.text(data.last().data(), expand, normalize)
@@ -914,8 +1702,9 @@ class HTMLTools:
 			return self.text(data.data(), expand, normalize)
 		elif isinstance(data, Tag):
 			res = data.text()
-		elif isinstance(data, TagTree):
-			res = data.text()
+		elif isinstance(data, (TagTree, TagList)):
+			# Trees and lists expand the entities as they extract the text
+			res, expand = data.text(expand=expand), False
 		else:
 			raise Exception("Unsupported data:" + str(data) + ":" + data.__class__.__name__)
 		if expand: res = self.expand(res)
@@ -923,52 +1712,13 @@ class HTMLTools:
 		return res
 
 	def expand( self, text, encoding=None ):
-		"""Expands the entities found in the given text."""
+		"""Expands the entities (including the HTML5 named entities) found in
+		the given text."""
 		if not (type(text) in (str, unicode)):
 			text = text.text()
-		# NOTE: This is based on
-		# <http://www.shearersoftware.com/software/developers/htmlfilter/>
-		entityStart = text.find('&')
-		if entityStart != -1:          # only run bulk of code if there are entities present
-			preferUnicodeToISO8859 = True
-			prevOffset = 0
-			textParts = []
-			while entityStart != -1:
-				textParts.append(text[prevOffset:entityStart])
-				entityEnd = text.find(';', entityStart+1)
-				if entityEnd == -1:
-					entityEnd = entityStart
-					entity = '&'
-				else:
-					entity = text[entityStart:entityEnd+1]
-					if len(entity) < 4 or entity[1] != '#':
-						entity = html_entities.entitydefs.get(entity[1:-1],entity)
-					if len(entity) == 1:
-						if preferUnicodeToISO8859 and ord(entity) > 127 and hasattr(entity, 'decode'):
-							entity = entity.decode('iso-8859-1')
-							if type(text) != unicode and encoding:
-								entity = entity.encode(encoding)
-					else:
-						if len(entity) >= 4 and entity[1] == '#':
-							if entity[2] in ('X','x'):
-								entityCode = int(entity[3:-1], 16)
-							else:
-								entityCode = int(entity[2:-1])
-							if entityCode > 255:
-								entity = unichr(entityCode)
-							else:
-								entity = chr(entityCode)
-								if preferUnicodeToISO8859 and hasattr(entity, 'decode'):
-									entity = entity.decode('iso-8859-1')
-									if type(text) != unicode and encoding:
-										entity = entity.encode(encoding)
-					textParts.append(entity)
-				prevOffset = entityEnd+1
-				entityStart = text.find('&', prevOffset)
-			textParts.append(text[prevOffset:])
-			text = u''.join(textParts)
-		return text
-
+		# Most texts have no entities at all
+		if "&" not in text: return text
+		return expandEntities(ensureUnicode(text, encoding))
 
 	# FORMS-RELATED OPERATIONS
 	# ========================================================================
@@ -1004,21 +1754,76 @@ class HTMLTools:
 	# UTILITIES
 	# ========================================================================
 
+	def tokenize( self, html, offset=0 ):
+		"""Iterates on the tokens of the given HTML text, in a single pass
+		from the given offset. Each token is a tuple '(kind, start, end,
+		attributes start, attributes end, name)' where kind is one of the
+		'Tag' types ('OPEN', 'CLOSE', 'EMPTY', 'TEXT', 'COMMENT' or
+		'CDATA'). Only element tokens have attributes offsets and a name.
+
+		Comments, CDATA sections, declarations and processing instructions
+		are single tokens (the last two being 'COMMENT'), quoted '>' in
+		attribute values do not end a tag, and the content of 'RAW_TEXT'
+		elements (like 'script') is a single text token."""
+		search  = RE_TOKEN.search
+		end     = len(html)
+		raw     = None
+		# No tag can end after the last '>', so we do not search beyond it
+		# (this keeps the search linear on truncated documents).
+		limit   = html.rfind(">") + 1
+		while offset < end:
+			if raw:
+				# We are in raw text, which ends with the element closing tag
+				m = raw.search(html, offset)
+				if m is None:
+					yield (Tag.TEXT, offset, end, None, None, None)
+					break
+				if m.start() > offset:
+					yield (Tag.TEXT, offset, m.start(), None, None, None)
+				offset, raw = m.start(), None
+			m = search(html, offset, limit)
+			if m is None:
+				yield (Tag.TEXT, offset, end, None, None, None)
+				break
+			start = m.start()
+			if start > offset:
+				yield (Tag.TEXT, offset, start, None, None, None)
+			offset = m.end()
+			group  = m.lastgroup
+			if group == "comment" or group == "declaration":
+				yield (Tag.COMMENT, start, offset, None, None, None)
+			elif group == "cdata":
+				yield (Tag.CDATA, start, offset, None, None, None)
+			else:
+				name       = m.group("name")
+				attr_start = m.end("name")
+				attr_end   = offset - 1
+				if m.group("close"):
+					kind = Tag.CLOSE
+				elif html[attr_end - 1] == "/" and attr_end > attr_start:
+					kind      = Tag.EMPTY
+					attr_end -= 1
+				else:
+					kind = Tag.OPEN
+					if name.lower() in Tag.RAW_TEXT: raw = self._rawTextEnd(name)
+				yield (kind, start, offset, attr_start, attr_end, name)
+
+	def _rawTextEnd( self, name ):
+		"""Returns the regexp matching the closing tag of the raw text element
+		with the given name."""
+		name = name.lower()
+		if name not in RE_RAW_TEXT_END:
+			RE_RAW_TEXT_END[name] = re.compile("</" + name + "[\\s/>]", re.I)
+		return RE_RAW_TEXT_END[name]
+
 	def findNextTag( self, html, offset=0 ):
 		"""Finds the next tag in the given HTML text from the given offset. This
 		returns (tag type, tag name, tag start, attributes start, attributes
 		end) and tag end or None."""
-		if offset >= len(html) - 1: return None
-		m = RE_HTMLSTART.search(html, offset)
-		if m == None:
-			return None
-		n = RE_HTMLEND.search(html, m.end())
-		if n == None:
-			return HTMLTools.findNextTag(self, html, m.end())
-		if m.group()[1] == "/": tag_type = Tag.CLOSE
-		elif n.group()[0] == "/": tag_type = Tag.EMPTY
-		else: tag_type = Tag.OPEN
-		return (tag_type, m.group(1), m.start(), m.end(), n.start()), n.end()
+		for kind, start, end, attr_start, attr_end, name in self.tokenize(html, offset):
+			if name is not None:
+				return (kind, name, start, attr_start, attr_end), end
+		return None
 
 	@staticmethod
 	def onRE( text, regexp, off=0 ):
@@ -1057,42 +1862,272 @@ class HTMLTools:
 
 	@staticmethod
 	def parseAttributes(text, attribs = None):
-		"""Parses the HTML/XML attributes described in the given text."""
+		"""Parses the HTML/XML attributes described in the given text. Values
+		can be quoted or not, and attributes may have no value (like
+		'checked'), in which case their value is 'None'."""
 		if attribs == None: attribs = {}
-		eq = text.find("=")
-		# There may be attributes without a trailing =
-		# Like  ''id=all type=radio name=meta value="" checked''
-		if eq == -1:
-			space = text.find(" ")
-			if space == -1:
-				name = text.strip()
-				if name: attribs[name] = None
-				return attribs
-			else:
-				name = text[:space].strip()
-				if name: attribs[name] = None
-				return HTML.parseAttributes(text[space+1:], attribs)
+		for match in RE_ATTRIBUTE.finditer(text):
+			name, double, single, value = match.groups()
+			if double is not None:
+				value = double
+			elif single is not None:
+				value = single
+			attribs[name] = value
+		return attribs
+
+# -----------------------------------------------------------------------------
+#
+# HTML STREAM
+#
+# -----------------------------------------------------------------------------
+
+class HTMLStream:
+	"""Parses an HTML document given as a sequence of chunks, without
+	keeping the document in memory. The stream emits 'onStart', 'onEnd' and
+	'onText' events (to be overridden) with the path of the open element
+	tags, and calls the callbacks bound to selectors (see 'bind') with the
+	subtree of each matching element, as soon as it is closed.
+
+	--
+		rows   = []
+		stream = HTML.stream()
+		stream.bind("table.export tr", lambda row:rows.append(row.query("td:text")))
+		stream.parse(session.get(url, stream=True))
+	--
+
+	Only the matching subtrees are built, and they are discarded once their
+	callback returns, so that the memory used does not depend on the size of
+	the document. The ancestors of a subtree only hold their start tag."""
+
+	# The size up to which a tag with unbalanced quotes may continue in the
+	# next chunks (see '_isIncomplete')
+	MAX_TAG = 64 * 1024
+
+	def __init__( self, scraper=None, asXML=False, encoding="utf-8" ):
+		self.scraper    = scraper or HTML
+		self.asXML      = asXML
+		self.encoding   = encoding
+		self.bindings   = []
+		# The start tags of the open elements, and their nodes, the first
+		# node being the root.
+		self.path       = []
+		self._nodes     = [TagTree(id=-1)]
+		self._names     = []
+		self._positions = {}
+		# The bindings matched by each open element
+		self._matches   = []
+		self._capturing = 0
+		self._counter   = 0
+		self._data      = ""
+		self._decoder   = None
+		# The regexp matching the closing tag of the pending raw text element,
+		# the length of the closing tag and the end of the data received so
+		# far, and the chunks received while the closing tag is missing.
+		self._raw       = None
+		self._chunks    = []
+
+	def bind( self, selector, callback ):
+		"""Calls the given callback with each node (or its text for ':text')
+		that matches the given selector, when the node is closed. Selectors
+		that need the siblings of a node (like ':nth-child' or '[n]') are not
+		supported."""
+		selector = Selector.Compile(selector)
+		if not selector.isStreamable():
+			raise ValueError("Selector cannot be used on a stream: " + repr(selector.selector))
+		self.bindings.append((selector, callback))
+		return self
+
+	def parse( self, data ):
+		"""Parses the given data, which can be a string, an iterable of
+		strings (or bytes) or a (streamed) 'browse.Transaction', and closes
+		this stream."""
+		if isinstance(data, wwwclient.browse.Transaction):
+			data = data.iterContent()
+		elif type(data) in (str, unicode, bytes):
+			data = (data,)
+		for chunk in data:
+			self.feed(chunk)
+		return self.close()
+
+	def feed( self, chunk ):
+		"""Parses the given chunk of the document. Bytes are decoded using
+		the stream encoding."""
+		if type(chunk) is not str and not isinstance(chunk, unicode):
+			if self._decoder is None:
+				self._decoder = codecs.getincrementaldecoder(self.encoding)("replace")
+			chunk = self._decoder.decode(chunk)
+		if self._raw is not None:
+			# The raw text is only parsed once its closing tag has arrived
+			self._chunks.append(chunk)
+			if not self._hasRawTextEnd(chunk): return self
+			data = self._data + "".join(self._chunks)
+			del self._chunks[:]
 		else:
-			if eq + 1 == len(text):
-				return attribs
-			sep = text[eq+1]
-			if   sep == "'": end = text.find( "'", eq + 2 )
-			elif sep == '"': end = text.find( '"', eq + 2 )
-			else: end = text.find(" ", eq)
-			# Did we reach the end ?
-			name = text[:eq].strip()
-			if end == -1:
-				value = text[eq+1:]
-				if value and value[0] in ("'", '"'): value = value[1:-1]
-				else: value = value.strip()
-				attribs[name] = value
-				return attribs
+			data = self._data + chunk
+		self._data = data[self._process(data, False):]
+		return self
+
+	def close( self ):
+		"""Parses the rest of the document and closes the elements that are
+		still open."""
+		self._data += "".join(self._chunks)
+		if self._decoder is not None:
+			self._data += self._decoder.decode(b"", True)
+		self._process(self._data, True)
+		self._data = ""
+		self._raw  = None
+		del self._chunks[:]
+		while self.path:
+			self._end(self._implicitClose(self.path[-1]))
+		return self
+
+	# EVENTS
+	# ========================================================================
+
+	def onStart( self, tag, path ):
+		"""Called with the start tag of each element, and the list of the
+		start tags of its ancestors (which must be copied to be kept)."""
+
+	def onEnd( self, tag, path ):
+		"""Called with the end tag of each element (which is empty when the
+		element is closed implicitly, or the start tag itself for empty
+		elements), and the start tags of its ancestors."""
+
+	def onText( self, tag, path ):
+		"""Called with each text tag (including comments and CDATA), and the
+		start tags of the open elements."""
+
+	# PARSING
+	# ========================================================================
+
+	def _process( self, data, final ):
+		"""Processes the tokens of the given data, and returns the offset of
+		the first token that is not processed, because it may continue in the
+		next chunk (unless 'final' is true)."""
+		tokens = list(self.scraper.tokenize(data))
+		if not final:
+			count = len(tokens)
+			while count and self._isIncomplete(data, tokens[count - 1]):
+				count -= 1
+			self._raw = None
+			if count < len(tokens):
+				kind, start, end, attr_start, attr_end, name = tokens[count]
+				if kind == Tag.OPEN and name.lower() in Tag.RAW_TEXT:
+					# The pending data starts with a raw text element, whose
+					# closing tag is searched in the next chunks.
+					size      = len(name) + 2
+					self._raw = (self.scraper._rawTextEnd(name), size, data[max(end, len(data) - size):])
+			del tokens[count:]
+		offset = 0
+		for kind, start, end, attr_start, attr_end, name in tokens:
+			html  = data[start:end]
+			depth = len(self.path)
+			if kind == Tag.TEXT:
+				self._text(TextTag(html, 0, end - start, depth))
+			elif kind == Tag.COMMENT:
+				self._text(CommentTag(html, 0, end - start, depth))
+			elif kind == Tag.CDATA:
+				self._text(CDATATag(html, 0, end - start, depth))
 			else:
-				value = text[eq+1:end+1]
-				if value[0] in ("'", '"'): value = value[1:-1]
-				else: value = value.strip()
-				attribs[name] = value
-				return HTML.parseAttributes(text[end+1:].strip(), attribs)
+				tag = ElementTag(html, 0, end - start, attr_start - start, attr_end - start, type=kind, depth=depth, name=name)
+				if kind == Tag.CLOSE: self._close(tag)
+				else:                 self._open(tag)
+			offset = end
+		return offset
+
+	def _hasRawTextEnd( self, chunk ):
+		"""Tells if the given chunk has the closing tag of the pending raw text
+		element. The chunk is searched along with the end of the data
+		received before it, which may hold the start of the closing tag."""
+		regexp, size, tail = self._raw
+		data = tail + chunk
+		if regexp.search(data):
+			self._raw = None
+			return True
+		self._raw = (regexp, size, data[-size:])
+		return False
+
+	def _isIncomplete( self, data, token ):
+		"""Tells if the given token, which is the last one of the given data
+		(or only followed by incomplete tokens), may continue in the next
+		chunk."""
+		kind, start, end, attr_start, attr_end, name = token
+		if kind == Tag.TEXT:
+			return end == len(data)
+		elif kind == Tag.COMMENT:
+			if data.startswith("<!--", start): return not data.endswith("-->", start, end)
+			if data.startswith("<?", start):   return not data.endswith("?>", start, end)
+			return not data.endswith(">", start, end)
+		elif kind == Tag.CDATA:
+			return not data.endswith("]]>", start, end)
+		elif kind == Tag.OPEN and name.lower() in Tag.RAW_TEXT:
+			# The raw text of 'script' and 'style' must be parsed with its
+			# start tag
+			return True
+		# A tag whose attributes have unbalanced quotes is ended by its first
+		# '>', which may be a quoted one when the rest of the tag is in the
+		# next chunk: the tag is held back for as long as the data that
+		# follows may still be the rest of the tag (up to 'MAX_TAG').
+		return not RE_QUOTES.fullmatch(data, attr_start, end - 1) \
+			and len(data) - start <= self.MAX_TAG \
+			and RE_TAG_START.fullmatch(data, attr_start) is not None
+
+	def _text( self, tag ):
+		self.onText(tag, self.path)
+		if self._capturing:
+			self._nodes[-1]._adopt(TagTree(tag))
+
+	def _open( self, tag ):
+		if self.path and not self.asXML and HTML_closeWhen(tag, self.path[-1]):
+			self._end(self._implicitClose(self.path[-1]))
+		node = TagTree(tag, id=self._counter)
+		self._counter += 1
+		# Outside of the captured subtrees, nodes only know their parent
+		if self._capturing: self._nodes[-1]._adopt(node)
+		else:               node.setParent(self._nodes[-1])
+		self.onStart(tag, self.path)
+		root    = self._nodes[0]
+		matches = [_ for _ in self.bindings if _[0].match(node, root)]
+		if tag.type == Tag.EMPTY or (not self.asXML and HTML_isEmpty(tag)):
+			self.onEnd(tag, self.path)
+			self._notify(node, matches)
+		else:
+			name = tag.name() if self.asXML else tag.lname()
+			self.path.append(tag)
+			self._nodes.append(node)
+			self._names.append(name)
+			self._positions.setdefault(name, []).append(len(self.path) - 1)
+			self._matches.append(matches)
+			if matches: self._capturing += 1
+
+	def _close( self, tag ):
+		where = self._positions.get(tag.name() if self.asXML else tag.lname())
+		if not where:
+			# There is no opening tag for this tag
+			return
+		depth = where[-1]
+		while len(self.path) > depth + 1:
+			self._end(self._implicitClose(self.path[-1]))
+		self._end(tag)
+
+	def _end( self, tag ):
+		self.path.pop()
+		self._positions[self._names.pop()].pop()
+		node    = self._nodes.pop()
+		matches = self._matches.pop()
+		node.close(tag)
+		self.onEnd(tag, self.path)
+		if matches:
+			self._capturing -= 1
+			self._notify(node, matches)
+
+	def _notify( self, node, matches ):
+		for selector, callback in matches:
+			callback(node.text() if selector.steps[-1].text else node)
+
+	def _implicitClose( self, tag ):
+		"""Returns an empty end tag for the given start tag."""
+		return ElementTag("", 0, 0, 0, 0, type=Tag.CLOSE, name=tag.name())
 
 # We create a shared instance with the scraping tools
 HTML = HTMLTools()
@@ -0,0 +1,47 @@
+from os.path import join, basename, dirname, abspath
+import sys ;sys.path.append(join(dirname(dirname(abspath(__file__))), "src"))
+
+import threading
+try:
+	from http.server  import HTTPServer, BaseHTTPRequestHandler
+	from socketserver import ThreadingMixIn
+except ImportError:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+	from SocketServer   import ThreadingMixIn
+
+class Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+class Handler(BaseHTTPRequestHandler):
+	"""The base handler of the test servers, which counts the requests made
+	to each path in 'hits'."""
+
+	protocol_version = "HTTP/1.1"
+	hits             = {}
+
+	def count( self ):
+		path = self.path.split("?")[0]
+		self.hits[path] = self.hits.get(path, 0) + 1
+		return self.hits[path]
+
+	def reply( self, status=200, body=b"", headers=() ):
+		self.send_response(status)
+		for name, value in headers:
+			self.send_header(name, value)
+		if status != 304:
+			self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		if self.command != "HEAD" and status != 304:
+			self.wfile.write(body)
+
+	def log_message( self, *args ):
+		pass
+
+def start( handler ):
+	"""Starts a server for the given handler class on a free local port, and
+	returns its URL."""
+	server = Server(("127.0.0.1", 0), handler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return "http://127.0.0.1:%d" % (server.server_address[1])
@@ -0,0 +1,109 @@
+from _server import Handler, start
+
+import os, tempfile
+from wwwclient import browse, cache, defaultclient
+
+class CacheHandler(Handler):
+
+	hits = {}
+
+	def do_GET( self ):
+		self.count()
+		path = self.path
+		if path.startswith("/fresh") or path.startswith("/same"):
+			self.reply(200, b"fresh body", [("Cache-Control", "max-age=60")])
+		elif path.startswith("/etag"):
+			headers = [("Cache-Control", "max-age=0"), ("ETag", '"v1"')]
+			if self.headers.get("If-None-Match") == '"v1"':
+				self.count304()
+				self.reply(304, headers=headers)
+			else:
+				self.reply(200, b"etag body", headers)
+		elif path.startswith("/nostore"):
+			self.reply(200, b"no-store body", [("Cache-Control", "no-store, max-age=60")])
+		else:
+			self.reply(404, b"not found")
+
+	def do_HEAD( self ):
+		self.do_GET()
+
+	def do_POST( self ):
+		self.count()
+		self.rfile.read(int(self.headers.get("Content-Length") or 0))
+		self.reply(200, b"posted")
+
+	def count304( self ):
+		self.hits["304"] = self.hits.get("304", 0) + 1
+
+URL = start(CacheHandler)
+
+def hits( path ):
+	return CacheHandler.hits.get(path, 0)
+
+def request( http, method, path, headers=None ):
+	"""Does the given request, and returns the status and the body of the
+	response (which is streamed when it comes from a 'SegmentStorage')."""
+	if method == "POST":
+		http.POST(URL + path, data="a=1", headers=headers)
+	else:
+		getattr(http, method)(URL + path, headers=headers)
+	response = http.responses()[-1]
+	return response.status(), response.read()
+
+for storage in (cache.MemoryStorage(), cache.DiskStorage(tempfile.mkdtemp()), cache.SegmentStorage(tempfile.mkdtemp())):
+	name = storage.__class__.__name__
+	CacheHandler.hits.clear()
+	http = defaultclient.HTTPClient()
+	http.setCache(cache.HTTPCache(storage))
+
+	# Fresh responses are served from the cache, also for 'HEAD'
+	assert request(http, "GET", "/fresh") == (200, b"fresh body")
+	assert request(http, "GET", "/fresh") == (200, b"fresh body")
+	assert request(http, "HEAD", "/fresh") == (200, b"")
+	assert hits("/fresh") == 1, name
+
+	# Stale responses are revalidated, and a '304' gives the stored body
+	for i in range(3):
+		assert request(http, "GET", "/etag") == (200, b"etag body"), name
+	assert hits("/etag") == 3 and hits("304") == 2, name
+
+	# Requests and responses with 'no-store' are not stored
+	for i in range(2):
+		assert request(http, "GET", "/nostore") == (200, b"no-store body")
+		assert request(http, "GET", "/fresh-nostore", ["Cache-Control: no-store"]) == (200, b"fresh body")
+	assert hits("/nostore") == 2 and hits("/fresh-nostore") == 2, name
+	assert request(http, "GET", "/fresh-nostore") == (200, b"fresh body")
+	assert hits("/fresh-nostore") == 3, name
+
+	# 'no-cache' requests revalidate the stored response
+	assert request(http, "GET", "/fresh", ["Cache-Control: no-cache"]) == (200, b"fresh body")
+	assert hits("/fresh") == 2, name
+
+	# A successful 'POST' invalidates the stored response of its URL
+	assert request(http, "POST", "/fresh") == (200, b"posted")
+	assert request(http, "GET", "/fresh") == (200, b"fresh body")
+	assert request(http, "GET", "/fresh") == (200, b"fresh body")
+	assert hits("/fresh") == 4, name
+
+# The segment storage keeps identical bodies once, and collects the least
+# recently used entries
+path    = tempfile.mkdtemp()
+storage = cache.SegmentStorage(path)
+storage.GRACE = 0
+http    = defaultclient.HTTPClient()
+http.setCache(cache.HTTPCache(storage))
+for i in range(3):
+	request(http, "GET", "/same/%d" % (i))
+assert len(os.listdir(os.path.join(path, "index"))) == 3
+assert len(os.listdir(os.path.join(path, "data"))) == 1
+assert storage.size() == len(b"fresh body")
+assert storage.collect(0) == 0
+assert os.listdir(os.path.join(path, "index")) == os.listdir(os.path.join(path, "data")) == []
+
+# Sessions use the cache for their transactions
+CacheHandler.hits.clear()
+session = browse.Session(cache=cache.MemoryStorage())
+assert session.get(URL + "/fresh").data() == session.get(URL + "/fresh").data()
+assert hits("/fresh") == 1
+
+print("OK")
@@ -0,0 +1,97 @@
+from _server import Handler, start
+
+import time, email.utils
+from wwwclient import browse
+from wwwclient.scheduler import Scheduler
+
+# -----------------------------------------------------------------------------
+#
+# SCHEDULER
+#
+# -----------------------------------------------------------------------------
+
+assert Scheduler.Host("http://WWW.Example.com:8080/a?b") == "www.example.com:8080"
+assert Scheduler.RetryAfter(None) is None
+assert Scheduler.RetryAfter("not a date") is None
+assert Scheduler.RetryAfter(" 5 ") == 5
+assert 8 < Scheduler.RetryAfter(email.utils.formatdate(time.time() + 10, usegmt=True)) <= 10
+assert Scheduler.RetryAfter(email.utils.formatdate(time.time() - 10, usegmt=True)) == 0
+
+def near( value, expected ):
+	return abs(value - expected) < 0.05
+
+# Requests to a host are spaced by the delay, without affecting other hosts
+scheduler = Scheduler(0.2)
+waits     = [scheduler.reserve("a") for i in range(3)]
+assert near(waits[0], 0) and near(waits[1], 0.2) and near(waits[2], 0.4), waits
+assert scheduler.reserve("b") == 0
+
+# Up to 'burst' requests can be sent at once
+scheduler = Scheduler(0.2, burst=3)
+waits     = [scheduler.reserve("a") for i in range(5)]
+assert waits[:3] == [0, 0, 0] and near(waits[3], 0.2) and near(waits[4], 0.4), waits
+
+# The intervals are picked within the delay range
+scheduler = Scheduler((0.1, 0.3))
+for i in range(100):
+	assert 0.1 <= scheduler.interval() <= 0.3
+assert Scheduler().reserve("a") == Scheduler().reserve("a") == 0
+
+# Hosts are put on hold
+scheduler = Scheduler()
+scheduler.backoff("a", 1)
+assert near(scheduler.reserve("a"), 1) and scheduler.reserve("b") == 0
+
+# -----------------------------------------------------------------------------
+#
+# SESSIONS
+#
+# -----------------------------------------------------------------------------
+
+class RetryHandler(Handler):
+
+	hits  = {}
+	times = []
+
+	def do_GET( self ):
+		self.times.append(time.time())
+		count = self.count()
+		if self.path == "/429" and count == 1:
+			self.reply(429, b"later", [("Retry-After", "1")])
+		elif self.path == "/503-date" and count == 1:
+			self.reply(503, b"later", [("Retry-After", email.utils.formatdate(time.time() + 2, usegmt=True))])
+		elif self.path == "/429-long":
+			self.reply(429, b"much later", [("Retry-After", "3600")])
+		elif self.path == "/503":
+			self.reply(503, b"unavailable")
+		else:
+			self.reply(200, b"done")
+
+URL = start(RetryHandler)
+
+# The session retries after the given 'Retry-After', when it is not too long
+session = browse.Session()
+start_time = time.time()
+assert session.get(URL + "/429").data() == "done"
+assert RetryHandler.hits["/429"] == 2 and time.time() - start_time >= 1
+assert session.get(URL + "/503-date").data() == "done"
+assert RetryHandler.hits["/503-date"] == 2
+# Otherwise the response is returned, but the host is still put on hold
+session = browse.Session(exceptions=False)
+assert session.get(URL + "/503").response().status() == 503
+assert session.get(URL + "/429-long").response().status() == 429
+assert RetryHandler.hits["/429-long"] == RetryHandler.hits["/503"] == 1
+assert session.scheduler().reserve(Scheduler.Host(URL)) > 3500
+
+# The requests of a session, and of its workers, are spaced by its delay
+for fetch in (
+	lambda session, urls:[session.get(_) for _ in urls],
+	lambda session, urls:list(session.fetchAll(urls, workers=4)),
+):
+	session = browse.Session(delay=0.2)
+	del RetryHandler.times[:]
+	fetch(session, [URL + "/spaced/%d" % (i) for i in range(4)])
+	times = RetryHandler.times
+	assert len(times) == 4 and min(b - a for a, b in zip(times, times[1:])) > 0.15, times
+
+print("OK")
@@ -0,0 +1,76 @@
+from os.path import join, basename, dirname, abspath
+import sys ;sys.path.append(join(dirname(dirname(abspath(__file__))), "src"))
+
+import io, os, random, tracemalloc
+from wwwclient.client import ChunkedDecoder, ChunkedDecoderError
+
+BODY    = os.urandom(300000)
+ENCODED = b"%x;ext=1\r\n" % (len(BODY)) + BODY + b"\r\n3\r\nabc\r\n0\r\nX-Trailer: yes\r\n\r\nNEXT"
+
+def stream( data ):
+	return io.BufferedReader(io.BytesIO(data))
+
+def fails( data ):
+	"""Tells if decoding the given data fails, both when it is fed and when
+	it is read from a stream."""
+	failed = 0
+	try:
+		decoder = ChunkedDecoder()
+		decoder.feed(data)
+		if not decoder.isDone(): raise ChunkedDecoderError("Incomplete chunked body")
+	except ChunkedDecoderError:
+		failed += 1
+	try:
+		ChunkedDecoder().readFrom(stream(data))
+	except ChunkedDecoderError:
+		failed += 1
+	return failed == 2
+
+# -----------------------------------------------------------------------------
+#
+# DECODING
+#
+# -----------------------------------------------------------------------------
+
+decoder = ChunkedDecoder()
+assert bytes(decoder.readFrom(stream(ENCODED))) == BODY + b"abc"
+assert decoder.trailers.get("x-trailer") == "yes"
+
+# The data is fed in random pieces, and what follows the body is left
+random.seed(0)
+for i in range(20):
+	decoder  = ChunkedDecoder()
+	offset   = 0
+	consumed = 0
+	while offset < len(ENCODED):
+		size      = random.randint(1, 70000)
+		consumed += decoder.feed(ENCODED[offset:offset+size])
+		offset   += size
+	assert decoder.isDone()
+	assert bytes(decoder.data()) == BODY + b"abc"
+	assert ENCODED[consumed:] == b"NEXT"
+
+# -----------------------------------------------------------------------------
+#
+# INVALID AND OVERSIZED CHUNKS
+#
+# -----------------------------------------------------------------------------
+
+for size in (b"-5", b"+5", b"0x5", b"5_0", b"", b"zz", b"5 5"):
+	assert fails(size + b"\r\nhello\r\n0\r\n\r\n"), size
+
+# Truncated bodies
+assert fails(b"5\r\nhel")
+assert fails(b"5\r\nhello\r\n")
+assert fails(b"5\r\nhello\r\n0\r\n")
+
+# The chunk sizes announced by the server are not allocated before the data
+# is received
+tracemalloc.start()
+for size in (b"10000000", b"7FFFFFFFFF", b"FFFFFFFFFFFFFFFF"):
+	tracemalloc.reset_peak()
+	assert fails(size + b"\r\nabc")
+	assert tracemalloc.get_traced_memory()[1] < 1024 * 1024, size
+tracemalloc.stop()
+
+print("OK")
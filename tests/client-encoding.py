@@ -0,0 +1,116 @@
+from _server import Handler, start
+
+import asyncio, gzip, os, random, zlib
+from wwwclient import client, defaultclient, asyncclient
+from wwwclient.client import ContentDecoder, ContentDecoderError
+
+TEXT = b"".join(b"line %d of the body\n" % (i) for i in range(5000)) + os.urandom(1000)
+
+def deflate( data, wbits ):
+	encoder = zlib.compressobj(6, zlib.DEFLATED, wbits)
+	return encoder.compress(data) + encoder.flush()
+
+# The encoded bodies by name, with their 'Content-Encoding'
+ENCODED = {
+	"gzip"     : ("gzip",          gzip.compress(TEXT[:20000]) + gzip.compress(TEXT[20000:])),
+	"x-gzip"   : ("x-gzip",        gzip.compress(TEXT)),
+	"zlib"     : ("deflate",       deflate(TEXT, zlib.MAX_WBITS)),
+	"deflate"  : ("deflate",       deflate(TEXT, -zlib.MAX_WBITS)),
+	"stacked"  : ("deflate, gzip", gzip.compress(deflate(TEXT, -zlib.MAX_WBITS))),
+	"identity" : ("identity",      TEXT),
+}
+if client.brotli:
+	ENCODED["br"] = ("br", client.brotli.compress(TEXT))
+
+# -----------------------------------------------------------------------------
+#
+# DECODERS
+#
+# -----------------------------------------------------------------------------
+
+# The bodies are decoded at once, or fed in random pieces (as small as one byte)
+random.seed(0)
+for name, (coding, data) in ENCODED.items():
+	decoder = ContentDecoder.Create(coding)
+	if name == "identity":
+		assert decoder is None
+		continue
+	assert decoder.decode(data) == TEXT, name
+	for size in (1, 7, 1000, None):
+		decoder = ContentDecoder.Create(coding)
+		result  = []
+		offset  = 0
+		while offset < len(data):
+			step    = size or random.randint(1, 5000)
+			result.append(decoder.decompress(data[offset:offset+step]))
+			offset += step
+		result.append(decoder.flush())
+		assert b"".join(result) == TEXT, (name, size)
+
+try:
+	ContentDecoder.Create("compress")
+	assert False
+except ContentDecoderError:
+	pass
+
+# -----------------------------------------------------------------------------
+#
+# CLIENTS
+#
+# -----------------------------------------------------------------------------
+
+class EncodingHandler(Handler):
+
+	def do_GET( self ):
+		name = self.path.split("/")[-1]
+		coding, data = ENCODED[name]
+		if self.path.startswith("/chunked/"):
+			self.send_response(200)
+			self.send_header("Content-Encoding", coding)
+			self.send_header("Transfer-Encoding", "chunked")
+			self.end_headers()
+			for i in range(0, len(data), 4000):
+				self.wfile.write(b"%x\r\n%s\r\n" % (len(data[i:i+4000]), data[i:i+4000]))
+			self.wfile.write(b"0\r\n\r\n")
+		else:
+			self.reply(200, data, [("Content-Encoding", coding)])
+
+URL = start(EncodingHandler)
+
+def check( response, name ):
+	coding = ENCODED[name][0]
+	assert response.body == TEXT, name
+	# Bodies that are not encoded are left as they are
+	assert response.headers.get("Content-Encoding") in (None, "identity"), name
+	assert response.headers.get("Transfer-Encoding") is None, name
+	assert response.headers.get("Content-Length") == str(len(TEXT)), name
+	if name != "identity":
+		assert response.originalHeaders.get("Content-Encoding") == coding, name
+
+NAMES = [_ for _ in ENCODED for i in range(2)]
+URLS  = [URL + _ + name for name in ENCODED for _ in ("/", "/chunked/")]
+
+http = defaultclient.HTTPClient()
+for url, name in zip(URLS, NAMES):
+	http.GET(url)
+	check(http.responses()[-1], name)
+
+# The connections of the asyncio client are kept within a single loop
+async def fetch( urls ):
+	http = asyncclient.HTTPClient()
+	return [(await http.GET(_))[-1] for _ in urls]
+for response, name in zip(asyncio.run(fetch(URLS)), NAMES):
+	check(response, name)
+
+# The curl client, when 'pycurl' is installed
+try:
+	from wwwclient import curlclient
+except ImportError:
+	curlclient = None
+if curlclient:
+	http = curlclient.HTTPClient()
+	for url, name in zip(URLS, NAMES):
+		http.GET(url)
+		check(http.responses()[-1], name)
+
+print("OK")
@@ -0,0 +1,109 @@
+from _server import Handler, start
+
+import asyncio, hashlib, json, os, socket, tempfile
+from wwwclient import client, defaultclient, asyncclient
+
+DATA = os.urandom(3 * 1024 * 1024 + 17)
+PATH = os.path.join(tempfile.mkdtemp(), "upload.bin")
+with open(PATH, "wb") as f:
+	f.write(DATA)
+
+FIELDS = [("name", "value"), ("empty", "")]
+ATTACH = [
+	("file",    PATH, client.FILE_ATTACHMENT),
+	("content", ("notes.txt", "text/plain", "Some notes\r\n--not a boundary"), client.CONTENT_ATTACHMENT),
+]
+
+# -----------------------------------------------------------------------------
+#
+# MULTIPART BODY
+#
+# -----------------------------------------------------------------------------
+
+body, mimetype = client.HTTPClient().encode(FIELDS, ATTACH)
+assert mimetype == body.contentType()
+EXPECTED = body.read()
+assert len(body) == len(EXPECTED)
+assert DATA in EXPECTED and b'name="name"\r\n\r\nvalue\r\n' in EXPECTED
+assert EXPECTED.endswith(("--%s--\r\n" % (body.boundary)).encode("latin-1"))
+# The body is read by chunks of any size, and can be read again
+body.seek(0)
+assert b"".join(body.iterChunks(1000)) == EXPECTED
+body.seek(0)
+assert b"".join(iter(lambda:body.read(7), b"")) == EXPECTED
+assert b"".join(_ if isinstance(_, bytes) else open(_[0], "rb").read() for _ in body.parts()) == EXPECTED
+try:
+	body.seek(10)
+	assert False
+except IOError:
+	pass
+
+# -----------------------------------------------------------------------------
+#
+# UPLOADS
+#
+# -----------------------------------------------------------------------------
+
+class UploadHandler(Handler):
+
+	def do_POST( self ):
+		length = int(self.headers.get("Content-Length"))
+		data   = b""
+		while len(data) < length:
+			chunk = self.rfile.read(length - len(data))
+			if not chunk: break
+			data += chunk
+		self.reply(200, json.dumps(dict(
+			length = length,
+			read   = len(data),
+			md5    = hashlib.md5(data).hexdigest(),
+			ctype  = self.headers.get("Content-Type"),
+		)).encode("utf-8"), [("Content-Type", "application/json")])
+
+URL = start(UploadHandler)
+
+def check( response ):
+	"""Checks that the server received the whole multipart body, with its
+	announced length. The body may be a 'memoryview' (as with curl)."""
+	result = json.loads(bytes(response.body).decode("utf-8"))
+	assert result["length"] == result["read"] == len(EXPECTED), result
+	assert result["md5"] == hashlib.md5(EXPECTED).hexdigest()
+	assert result["ctype"] == mimetype
+
+# The default client, with and without 'sendfile'
+sent = []
+sendfile = socket.socket.sendfile
+def counting( self, file, offset=0, count=None ):
+	sent.append(count)
+	return sendfile(self, file, offset, count)
+socket.socket.sendfile = counting
+try:
+	for enabled in (True, False):
+		http = defaultclient.HTTPClient()
+		http.SENDFILE = enabled
+		for i in range(2):
+			http.POST(URL + "/upload", fields=FIELDS, attach=ATTACH)
+			check(http.responses()[-1])
+		assert len(sent) == (2 if enabled else 0), sent
+		del sent[:]
+finally:
+	socket.socket.sendfile = sendfile
+
+# The asyncio client
+async def upload():
+	http = asyncclient.HTTPClient()
+	return [(await http.POST(URL + "/upload", fields=FIELDS, attach=ATTACH))[-1] for i in range(2)]
+for response in asyncio.run(upload()):
+	check(response)
+
+# The curl client, when 'pycurl' is installed
+try:
+	from wwwclient import curlclient
+except ImportError:
+	curlclient = None
+if curlclient:
+	http = curlclient.HTTPClient()
+	http.POST(URL + "/upload", fields=FIELDS, attach=ATTACH)
+	check(http.responses()[-1])
+
+print("OK")
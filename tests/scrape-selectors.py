@@ -0,0 +1,169 @@
+# Encoding: utf-8
+from os.path import join, basename, dirname, abspath
+import sys ;sys.path.append(join(dirname(dirname(abspath(__file__))), "src"))
+
+import random
+from wwwclient.scrape import HTML, HTMLStream
+
+DATA = """<!DOCTYPE html>
+<html><head><title>Exports</title>
+<style>td > b { color: red }</style>
+<script>if (a < b && "</td>") { document.write("<p>") }</script>
+</head><body>
+<!-- The list of exports -->
+<div id="main" class="content wide">
+	<h1>Exports</h1>
+	<table class="export">
+		<tr><th>Name</th><th>Count</th></tr>
+		<tr class="row"><td>Apples</td><td><b>12</b></td></tr>
+		<tr class="row odd"><td>Pears</td><td>7</td></tr>
+		<tr class="row"><td>Plums</td><td data-unit="kg">3</td></tr>
+	</table>
+	<p>First <a href="/a">link</a> and <A href='/b'>second</A><br>
+	<p class=note>Unclosed paragraph
+	<ul><li>one</li><li>two</li><li class="last">three</li></ul>
+</div>
+<div class="footer"><p>&copy; 2011 <![CDATA[x < y]]></p></div>
+</body></html>"""
+
+def texts( nodes ):
+	return [_.text().strip() for _ in nodes]
+
+tree = HTML.tree(DATA)
+
+# -----------------------------------------------------------------------------
+#
+# SELECTORS
+#
+# -----------------------------------------------------------------------------
+
+# Names, ids, classes and attributes
+assert len(tree.query("tr")) == 4
+assert len(tree.query("TR")) == 4
+assert texts(tree.query("#main h1")) == ["Exports"]
+assert len(tree.query("div.content.wide")) == 1
+assert len(tree.query("div.content.narrow")) == 0
+assert texts(tree.query("tr.odd td")) == ["Pears", "7"]
+assert texts(tree.query("td[data-unit=kg]")) == ["3"]
+assert [_.attribute("href") for _ in tree.query("a[href^=/]")] == ["/a", "/b"]
+
+# Combinators: the script and style content is raw text, and has no elements
+assert len(tree.query("table td")) == 6
+assert len(tree.query("table > td")) == 0
+assert len(tree.query("tr > td > b")) == 1
+assert len(tree.query("div > p")) == 3
+assert len(tree.query("#main > p")) == 2
+assert len(tree.query("body p")) == 3
+assert texts(tree.query("ul > li")) == ["one", "two", "three"]
+
+# The n-th result, within each match of the previous step
+assert texts(tree.query("tr.row td[0]")) == ["Apples", "Pears", "Plums"]
+assert texts(tree.query("tr.row td[-1]")) == ["12", "7", "3"]
+assert texts(tree.query("table[0] tr.row[-1] td")) == ["3"]
+assert texts(tree.query("tr.row[-1] td")) == ["3"]
+assert tree.query("tr.row td[10]") == [None, None, None]
+assert tree.query("tr.row[1] td:text") == ["12"]
+
+# Texts
+assert tree.query("tr.row td:text") == ["Apples", "12", "Pears", "7", "Plums", "3"]
+assert tree.query("h1:text") == ["Exports"]
+
+# Position among the siblings
+assert texts(tree.query("li:first-child")) == ["one"]
+assert texts(tree.query("li:nth-child(2)")) == ["two"]
+assert texts(tree.query("li:nth-child(odd)")) == ["one", "three"]
+assert texts(tree.query("tr:nth-child(2n+3) td")) == ["Pears", "7"]
+
+# Lists give the same (simple) results as the tree, and accept predicates
+tags = HTML.list(DATA)
+assert [_.html() for _ in tags.find("li")] == [_.startTag.html() for _ in tree.query("li")]
+assert [_.html() for _ in tags.find("tr > td")] == [_.startTag.html() for _ in tree.query("tr > td")]
+assert len(tags.find(lambda _:_.isElement() and _.name() == "A")) == 2
+
+# -----------------------------------------------------------------------------
+#
+# HTML ROUND-TRIP
+#
+# -----------------------------------------------------------------------------
+
+assert HTML.list(DATA).html() == DATA
+assert "".join(DATA[start:end] for kind, start, end, a, b, name in HTML.tokenize(DATA)) == DATA
+assert tree.query("script")[0].html() == """<script>if (a < b && "</td>") { document.write("<p>") }</script>"""
+assert tree.query("table")[0].html() == DATA[DATA.index("<table"):DATA.index("</table>") + len("</table>")]
+
+# The tags of a list and of its tree are the same, so that changes made
+# through either one show in both
+tags  = HTML.list(DATA)
+index = [i for i, _ in enumerate(tags) if _.isElement() and _.name() == "a"][0]
+assert tags[index] is tags[index]
+links = tags.tagtree()
+tags[index].set("href", "/z")
+links.first("a").startTag.set("title", "z")
+assert tags.html() == links.html()
+assert '<a href="/z" title="z">link</a>' in tags.html()
+
+# -----------------------------------------------------------------------------
+#
+# STREAM
+#
+# -----------------------------------------------------------------------------
+
+class Events(HTMLStream):
+
+	def __init__( self, *args, **kwargs ):
+		HTMLStream.__init__(self, *args, **kwargs)
+		self.events = []
+
+	def onStart( self, tag, path ):
+		self.events.append(("start", len(path), tag.html()))
+
+	def onEnd( self, tag, path ):
+		self.events.append(("end", len(path), tag.html()))
+
+	def onText( self, tag, path ):
+		self.events.append(("text", len(path), tag.html()))
+
+def parse( chunks ):
+	rows  = []
+	links = []
+	stream = Events()
+	stream.bind("table.export tr.row", lambda _:rows.append(_.query("td:text")))
+	stream.bind("a", lambda _:links.append(_.html()))
+	stream.parse(chunks)
+	return stream.events, rows, links
+
+events, rows, links = parse([DATA])
+assert rows  == [_.query("td:text") for _ in tree.query("table.export tr.row")]
+assert links == [_.html() for _ in tree.query("a")]
+assert "".join(_[2] for _ in events if _[0] != "end" or _[2][1:2] == "/") == DATA
+
+# The chunk boundaries do not change the events, even within tags, comments,
+# entities and raw text
+random.seed(0)
+for i in range(500):
+	cuts   = sorted(random.sample(range(1, len(DATA)), random.randint(1, 40)))
+	chunks = [DATA[a:b] for a, b in zip([0] + cuts, cuts + [len(DATA)])]
+	assert parse(chunks) == (events, rows, links), chunks
+# Bytes are decoded as they arrive, even when a character is split
+data = DATA.replace("Pears", u"Poires à cuire").encode("utf-8")
+assert parse([data[i:i+3] for i in range(0, len(data), 3)]) == parse([data])
+assert parse([DATA[i:i+1] for i in range(len(DATA))]) == (events, rows, links)
+# Quoted '>' in attribute values do not end the tags, wherever the chunks end
+QUOTED = """<table><tr><td title="a>b">2</td><td title='x>y' data-z="1>2"/>3</td>
+<td alt=don't>4</td><td a="<b>">5</td></tr></table>"""
+cells  = HTML.tree(QUOTED).query("td:text")
+assert cells == ["2", "", "4", "5"]
+for size in range(1, 40):
+	for data in (QUOTED, QUOTED.encode("utf-8")):
+		stream = HTMLStream()
+		result = []
+		stream.bind("td:text", result.append)
+		stream.parse([data[i:i+size] for i in range(0, len(data), size)])
+		assert result == cells, (size, result)
+# Elements are parsed as soon as they are complete, even with raw text
+stream = Events()
+for c in DATA[:DATA.index("</head>")]:
+	stream.feed(c)
+assert [_ for _ in stream.events if _[0] == "end"][-1][2] == "</script>"
+
+print("OK")